@@ -0,0 +1,52 @@
+"""
+Shared setup for the benchmark / stress scripts in this directory.
+
+main.py reads its configuration from the environment at import time, so this module points it at
+a throwaway SQLite database and a dummy bot token before importing it. To compare against an
+older revision, check it out somewhere (git worktree add /tmp/before <rev>) and run the script
+with BENCH_TREE=/tmp/before.
+"""
+import hashlib
+import hmac
+import json
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+from urllib.parse import urlencode
+
+REPO = Path(__file__).resolve().parent.parent
+TREE = Path(os.getenv("BENCH_TREE") or REPO).resolve()
+BENCH_DIR = Path(tempfile.mkdtemp(prefix="bench-"))
+
+BOT_TOKEN = "123456:ABCdefGhIJKlmnoPQRstuVWXyz"
+ENV = {
+    "BOT_TOKEN": BOT_TOKEN,
+    "DB_BACKEND": "sqlite",
+    "MYSQL_HOST": "",
+    "DB_PATH": str(BENCH_DIR / "bench.db"),
+    "API_HOST": "127.0.0.1",
+    "API_PORT": os.getenv("API_PORT", "18080"),
+    # Benchmarks hammer one user; the limiter would turn that into 429s
+    "API_RATE_READ_PER_MIN": "0",
+    "API_RATE_WRITE_PER_MIN": "0",
+}
+for _k, _v in ENV.items():
+    os.environ.setdefault(_k, _v)
+
+sys.path.insert(0, str(TREE))
+import main  # noqa: E402
+
+
+def init_data(user_id: int, bot_token: str = BOT_TOKEN) -> str:
+    """Signed WebApp initData for `user_id`, as Telegram would send it."""
+    data = {"auth_date": str(int(time.time())), "user": json.dumps({"id": int(user_id), "first_name": "bench"})}
+    check = "\n".join(f"{k}={v}" for k, v in sorted(data.items()))
+    secret = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+    data["hash"] = hmac.new(secret, check.encode(), hashlib.sha256).hexdigest()
+    return urlencode(data)
+
+
+def api_url(path: str = "") -> str:
+    return f"http://127.0.0.1:{main.API_PORT}{path}"
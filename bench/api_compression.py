@@ -0,0 +1,50 @@
+"""
+Bytes on the wire and latency of /orders/list (200 orders) per Accept-Encoding, as negotiated by
+the API's compression middleware (br only when the brotli module is installed).
+
+    python bench/api_compression.py
+    BENCH_TREE=/tmp/before python bench/api_compression.py   # an older revision, for comparison
+"""
+import asyncio
+import time
+
+import aiohttp
+
+from _common import api_url, init_data, main
+from json_backend import N_ORDERS, USER_ID, make_order
+
+ENCODINGS = ["identity", "gzip", "deflate", "gzip, deflate, br"]
+REQUESTS = 300
+
+
+async def run() -> None:
+    with main._db_transaction():
+        for i in range(N_ORDERS):
+            main._create_order(USER_ID, make_order(i), 100)
+    runner = await main.start_api_server()
+    url = api_url(f"{main.API_BASE_PATH}/orders/list")
+    try:
+        # auto_decompress=False: count what actually crosses the wire
+        async with aiohttp.ClientSession(auto_decompress=False) as session:
+            for accept in ENCODINGS:
+                headers = {"X-Tg-Init-Data": init_data(USER_ID), "Accept-Encoding": accept}
+
+                async def once():
+                    async with session.post(url, json={"limit": N_ORDERS}, headers=headers) as r:
+                        return len(await r.read()), r.headers.get("Content-Encoding") or "identity"
+
+                for _ in range(20):
+                    await once()
+                t0 = time.perf_counter()
+                for _ in range(REQUESTS):
+                    size, coding = await once()
+                ms = (time.perf_counter() - t0) / REQUESTS * 1000
+                print(f"Accept-Encoding {accept!r:22} -> {coding:8} {size:7d} B  {ms:.2f} ms/request")
+    finally:
+        await runner.cleanup()
+    print(main._collect_metrics().get("http"))
+
+
+if __name__ == "__main__":
+    print(f"{main.__file__}")
+    asyncio.run(run())
@@ -0,0 +1,93 @@
+"""
+Double-spend stress test: several API processes share one SQLite database and every order is
+posted to all of them at once (main and accounts endpoints alternately).
+
+The user starts with BALANCE_RUB and every order costs PRICE_RUB, so at most BALANCE/PRICE orders
+can be paid. Afterwards the balance must equal the start minus PRICE times the orders recorded in
+processed_orders, and never go below zero.
+
+    python bench/double_spend.py                       # PROCS=4 ORDERS=60 PRICE_RUB=10 BALANCE_RUB=300
+    python bench/double_spend.py 8 200 5 400
+    BENCH_TREE=/tmp/before python bench/double_spend.py  # an older revision, for comparison
+"""
+import asyncio
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+
+import aiohttp
+
+from _common import api_url, init_data, main
+
+USER_ID = 777001
+BASE_PORT = 18100
+
+
+def serve(index: int, ready) -> None:
+    """Child process: one API server on BASE_PORT + index, same DB_PATH as the parent."""
+    main.API_PORT = BASE_PORT + index
+
+    async def run() -> None:
+        await main.start_api_server()
+        ready.release()
+        await asyncio.Event().wait()
+
+    asyncio.run(run())
+
+
+async def post_order(session: aiohttp.ClientSession, port: int, path: str, order_id: str, price_rub: int) -> str:
+    url = api_url(path).replace(f":{main.API_PORT}", f":{port}")
+    body = {"order": {"order_id": order_id, "title": "bench", "total_price": str(price_rub)}, "pay_method": "balance"}
+    async with session.post(url, json=body, headers={"X-Tg-Init-Data": init_data(USER_ID)}) as resp:
+        data = await resp.json(content_type=None)
+    return str(data.get("result") or data.get("error") or resp.status)
+
+
+async def hammer(procs: int, orders: int, price_rub: int) -> dict:
+    paths = [f"{main.API_BASE_PATH}/orders/create", f"{main.ACCOUNTS_API_BASE_PATH}/orders/create"]
+    results: dict = {}
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=60)) as session:
+        requests = []
+        for n in range(orders):
+            # The same order id goes to every process
+            order_id = f"bench-{n}-{uuid.uuid4().hex[:6]}"
+            requests += [post_order(session, BASE_PORT + p, paths[(n + p) % 2], order_id, price_rub) for p in range(procs)]
+        for result in await asyncio.gather(*requests):
+            results[result] = results.get(result, 0) + 1
+    return results
+
+
+def main_bench() -> None:
+    args = [int(a) for a in sys.argv[1:]]
+    procs, orders, price_rub, balance_rub = (args + [4, 60, 10, 300][len(args):])[:4]
+
+    main._set_balance_kopecks(USER_ID, balance_rub * 100)
+    ctx = multiprocessing.get_context("spawn")
+    ready = ctx.Semaphore(0)
+    children = [ctx.Process(target=serve, args=(i, ready), daemon=True) for i in range(procs)]
+    for child in children:
+        child.start()
+    for _ in children:
+        ready.acquire(timeout=60)
+
+    started = time.perf_counter()
+    results = asyncio.run(hammer(procs, orders, price_rub))
+    elapsed = time.perf_counter() - started
+    for child in children:
+        child.terminate()
+
+    balance = main._get_balance_kopecks(USER_ID)
+    paid = main._conn.execute("SELECT COUNT(*) FROM processed_orders WHERE user_id = ?", (USER_ID,)).fetchone()[0]
+    expected = balance_rub * 100 - paid * price_rub * 100
+    print(f"{main.__file__}")
+    print(f"{procs} processes x {orders} orders in {elapsed:.2f}s, responses {results}")
+    print(f"paid orders {paid} (at most {balance_rub // price_rub}), balance {balance / 100:.2f} RUB, expected {expected / 100:.2f} RUB")
+    ok = balance == expected and balance >= 0 and paid <= balance_rub // price_rub
+    print("OK" if ok else "DOUBLE SPEND")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -0,0 +1,100 @@
+"""
+JSON cost on the order paths: the stdlib against the backend main.py picked (JSON_BACKEND), per
+operation and end to end for /orders/list with 200 orders.
+
+    python bench/json_backend.py                     # orjson when installed
+    JSON_BACKEND=json python bench/json_backend.py   # stdlib everywhere, for the endpoint numbers
+"""
+import asyncio
+import json
+import random
+import time
+import uuid
+
+import aiohttp
+
+from _common import api_url, init_data, main
+
+USER_ID = 990001
+N_ORDERS = 200
+
+
+def make_order(i: int) -> dict:
+    return {
+        "order_id": uuid.uuid4().hex,
+        "category_name": "Telegram — подписчики",
+        "service": "Подписчики в канал (живые, RU)",
+        "link": f"https://t.me/channel_{i}",
+        "quantity": random.randint(100, 10000),
+        "total_price": f"{random.randint(100, 9000)}.00",
+        "discount_applied": False,
+        "comment": "Пожалуйста, плавно в течение суток 🙏",
+        "options": {"speed": "slow", "refill": True, "geo": ["RU", "KZ"]},
+        "created_from": "webapp",
+    }
+
+
+def per_call_us(fn, n: int) -> float:
+    fn()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    return (time.perf_counter() - t0) / n * 1e6
+
+
+def micro(orders: list) -> None:
+    rows = [json.dumps(o, ensure_ascii=False) for o in orders]
+    listing = {
+        "ok": True,
+        "orders": [
+            {"order_id": o["order_id"], "created_at": "2026-10-19 03:07:16", "category_name": o["category_name"], "status": "new"}
+            for o in orders
+        ],
+    }
+    detail = {"ok": True, "order": orders[0]}
+    cases = [
+        ("dumps 1 order (store)", lambda: json.dumps(orders[0], ensure_ascii=False), lambda: main._json_dumps(orders[0]), 20000),
+        ("loads 200 order rows", lambda: [json.loads(r) for r in rows], lambda: [main._json_loads(r) for r in rows], 300),
+        ("encode 200-order list response", lambda: json.dumps(listing, ensure_ascii=False).encode(), lambda: main._json_dumpb(listing), 2000),
+        ("encode order detail response", lambda: json.dumps(detail, ensure_ascii=False).encode(), lambda: main._json_dumpb(detail), 20000),
+    ]
+    backend = main._collect_metrics()["json"]["backend"]
+    for label, stdlib, active, n in cases:
+        a, b = per_call_us(stdlib, n), per_call_us(active, n)
+        print(f"{label:34s} json {a:8.1f} us   {backend} {b:8.1f} us   x{a / b:.1f}")
+
+
+async def endpoint(orders: list, requests: int = 300) -> None:
+    with main._db_transaction():
+        for o in orders:
+            main._create_order(USER_ID, o, 100)
+    runner = await main.start_api_server()
+    headers = {"X-Tg-Init-Data": init_data(USER_ID)}
+    try:
+        async with aiohttp.ClientSession() as session:
+
+            async def once() -> int:
+                async with session.post(api_url(f"{main.API_BASE_PATH}/orders/list"), json={"limit": N_ORDERS}, headers=headers) as r:
+                    return len(await r.read())
+
+            for _ in range(20):
+                await once()
+            t0 = time.perf_counter()
+            for _ in range(requests):
+                size = await once()
+            ms = (time.perf_counter() - t0) / requests * 1000
+    finally:
+        await runner.cleanup()
+    print(f"/orders/list limit={N_ORDERS}: {ms:.2f} ms/request, {size} B ({main._collect_metrics()['json']['backend']})")
+
+
+def main_bench() -> None:
+    random.seed(1)
+    orders = [make_order(i) for i in range(N_ORDERS)]
+    print(f"{main.__file__}")
+    micro(orders)
+    asyncio.run(endpoint(orders))
+
+
+if __name__ == "__main__":
+    main_bench()
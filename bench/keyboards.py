@@ -0,0 +1,74 @@
+"""
+Per-update cost of the menu keyboards: time and Telegram objects built per update.
+
+    python bench/keyboards.py
+    BENCH_TREE=/tmp/before python bench/keyboards.py   # same numbers for an older revision
+"""
+import time
+import tracemalloc
+
+from _common import main
+
+from aiogram.types import base as tg_base
+
+N = 20000
+
+
+def per_update() -> None:
+    # Keyboards the hot menu screens build while handling one update each
+    main.topup_amounts_kb(need_rub=0)
+    main.topup_amounts_kb(need_rub=150)
+    main.crypto_amounts_kb(need_rub=150)
+    main.main_reply_kb(1)
+    main.main_menu_kb(1)
+
+
+def count_objects() -> int:
+    built = [0]
+    init = tg_base.TelegramObject.__init__
+
+    def counting(self, *a, **kw):
+        built[0] += 1
+        init(self, *a, **kw)
+
+    classes = [tg_base.TelegramObject] + [
+        getattr(main, name)
+        for name in ("InlineKeyboardMarkup", "InlineKeyboardButton", "ReplyKeyboardMarkup", "KeyboardButton", "WebAppInfo")
+        if hasattr(main, name)
+    ]
+    saved = [(cls, cls.__dict__.get("__init__")) for cls in classes]
+    for cls in classes:
+        cls.__init__ = counting
+    try:
+        per_update()
+    finally:
+        for cls, orig in saved:
+            if orig is None:
+                del cls.__init__
+            else:
+                cls.__init__ = orig
+    return built[0]
+
+
+def main_bench() -> None:
+    for _ in range(100):
+        per_update()
+    t0 = time.perf_counter()
+    for _ in range(N):
+        per_update()
+    us = (time.perf_counter() - t0) / N * 1e6
+
+    tracemalloc.start()
+    base = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    for _ in range(200):
+        per_update()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    print(f"{main.__file__}")
+    print(f"{us:.1f} us/update, {count_objects()} telegram objects/update, transient peak {(peak - base) / 200:.0f} B/update")
+
+
+if __name__ == "__main__":
+    main_bench()
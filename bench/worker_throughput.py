@@ -0,0 +1,164 @@
+"""
+Update throughput with BOT_WORKERS=0/1/2/4/8 against a fake Bot API.
+
+The fake API serves K text updates from USERS users via getUpdates and answers every other method
+after LAT_MS (Telegram's round trip). The bot runs as a real `main.py` process; the run ends when
+K replies were sent. The confirmed getUpdates offset should then reach K + 1: the bot polls from
+the newest update fetched and keeps the unacked ones itself. Kill a `main.py --worker` process
+mid-run to watch the supervisor resend its unacked updates to the replacement (see the bot.log it
+leaves behind).
+
+    python bench/worker_throughput.py                 # K=3000 USERS=500 LAT_MS=30, workers 0 1 2 4 8
+    python bench/worker_throughput.py 5000 1000 50 1 4
+"""
+import asyncio
+import os
+import signal
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from aiohttp import web
+
+REPO = Path(__file__).resolve().parent.parent
+TREE = Path(os.getenv("BENCH_TREE") or REPO).resolve()
+API_PORT = 18091
+BOT_TOKEN = "123456:ABCdefGhIJKlmnoPQRstuVWXyz"
+TEXTS = ["📜 Правила", "💳 Баланс"]
+
+
+class FakeBotApi:
+    def __init__(self, k: int, users: int, latency: float):
+        self.k = k
+        self.latency = latency
+        self.updates = [
+            {
+                "update_id": i,
+                "message": {
+                    "message_id": i,
+                    "date": int(time.time()),
+                    "chat": {"id": (i * 7919) % users + 1, "type": "private"},
+                    "from": {"id": (i * 7919) % users + 1, "is_bot": False, "first_name": "bench"},
+                    "text": TEXTS[i % 2],
+                },
+            }
+            for i in range(1, k + 1)
+        ]
+        self.confirmed = 0
+        self.replies = 0
+        self.message_id = 0
+        self.started = None
+        self.warm = None
+        self.finished = asyncio.Event()
+
+    async def _payload(self, request: web.Request) -> dict:
+        if request.content_type.startswith("multipart"):
+            data = {}
+            async for part in await request.multipart():
+                data[part.name] = "<file>" if part.filename else (await part.read()).decode(errors="ignore")
+            return data
+        if request.content_type == "application/json":
+            return await request.json()
+        return dict(await request.post()) if request.can_read_body else {}
+
+    def _message(self, chat_id, photo: bool) -> dict:
+        self.message_id += 1
+        msg = {"message_id": self.message_id, "date": int(time.time()), "chat": {"id": int(chat_id), "type": "private"}}
+        if photo:
+            msg["photo"] = [{"file_id": "FILE", "file_unique_id": "U", "width": 1, "height": 1}]
+        else:
+            msg["text"] = "x"
+        return msg
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"].lower()
+        data = await self._payload(request)
+        if method == "getupdates":
+            if self.started is None:
+                self.started = time.perf_counter()
+            offset = int(data.get("offset") or 0)
+            self.confirmed = max(self.confirmed, offset)
+            first = max(offset, 1)
+            result = self.updates[first - 1:first - 1 + int(data.get("limit") or 100)]
+            if not result:
+                await asyncio.sleep(min(float(data.get("timeout") or 0), 1.0))
+            return web.json_response({"ok": True, "result": result})
+        await asyncio.sleep(self.latency)
+        if method in ("sendmessage", "sendphoto"):
+            self.replies += 1
+            if self.replies == self.k // 10:
+                self.warm = time.perf_counter()
+            if self.replies >= self.k:
+                self.finished.set()
+            return web.json_response({"ok": True, "result": self._message(data.get("chat_id", 1), method == "sendphoto")})
+        if method == "getme":
+            return web.json_response({"ok": True, "result": {"id": 123456, "is_bot": True, "first_name": "b", "username": "benchbot"}})
+        if method == "getwebhookinfo":
+            info = {"url": "", "has_custom_certificate": False, "pending_update_count": self.k}
+            return web.json_response({"ok": True, "result": info})
+        return web.json_response({"ok": True, "result": True})
+
+
+async def run_once(workers: int, k: int, users: int, latency_ms: float) -> str:
+    api = FakeBotApi(k, users, latency_ms / 1000)
+    app = web.Application(client_max_size=50 * 2**20)
+    app.router.add_post("/bot{token}/{method}", api.handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "127.0.0.1", API_PORT).start()
+
+    workdir = Path(tempfile.mkdtemp(prefix="bench-workers-"))
+    env = dict(
+        os.environ,
+        BOT_TOKEN=BOT_TOKEN,
+        TELEGRAM_API_URL=f"http://127.0.0.1:{API_PORT}",
+        BOT_WORKERS=str(workers),
+        DB_BACKEND="sqlite",
+        MYSQL_HOST="",
+        DB_PATH=str(workdir / "bench.db"),
+        API_HOST="127.0.0.1",
+        API_PORT="18092",
+        SEND_GLOBAL_RATE="0",
+        SEND_CHAT_RATE="0",
+    )
+    with open(workdir / "bot.log", "wb") as log:
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable, str(TREE / "main.py"), env=env, stdout=log, stderr=log, start_new_session=True
+        )
+        try:
+            await asyncio.wait_for(api.finished.wait(), timeout=300)
+            elapsed = time.perf_counter() - api.started
+            steady = 0.9 * k / (time.perf_counter() - api.warm)
+            # The last page is confirmed by the next getUpdates
+            deadline = time.monotonic() + 5
+            while api.confirmed < k + 1 and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+            await asyncio.sleep(0.5)
+            result = (
+                f"workers={workers}: steady {steady:.0f} updates/s, {k} in {elapsed:.2f}s, "
+                f"replies {api.replies}, confirmed offset {api.confirmed} (want {k + 1})"
+            )
+        except asyncio.TimeoutError:
+            result = f"workers={workers}: TIMEOUT ({api.replies}/{k} replies), log in {workdir / 'bot.log'}"
+        finally:
+            proc.send_signal(signal.SIGINT)
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=20)
+            except asyncio.TimeoutError:
+                os.killpg(proc.pid, signal.SIGKILL)
+    await runner.cleanup()
+    return result
+
+
+def main_bench() -> None:
+    args = [int(a) for a in sys.argv[1:]]
+    k, users, latency_ms = (args + [3000, 500, 30][len(args):])[:3]
+    counts = args[3:] or [0, 1, 2, 4, 8]
+    print(f"{TREE / 'main.py'}: K={k} USERS={users} LAT_MS={latency_ms}")
+    for workers in counts:
+        print(asyncio.run(run_once(workers, k, users, latency_ms)), flush=True)
+
+
+if __name__ == "__main__":
+    main_bench()
@@ -1,17 +1,31 @@
 import asyncio
 import base64
+import bisect
+import collections
+import contextvars
+import itertools
 import json
 import logging
+import math
 import os
 import sqlite3
+import sys
 import threading
 import uuid
 import time
+import random
+import re
+import weakref
+import zlib
 import hashlib
+import heapq
 import hmac
+import inspect
+from contextlib import contextmanager
+from functools import lru_cache, partial
 from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 from pathlib import Path
-from typing import Optional, Tuple, List, Dict, Any
+from typing import Optional, Tuple, List, Dict, Any, Callable, Awaitable
 from urllib.parse import urlencode, parse_qsl
 
 from dotenv import load_dotenv
@@ -24,8 +38,16 @@ import ssl
 import certifi
 
 from aiogram import Bot, Dispatcher, F, types
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 from aiogram.filters import Command
+from aiogram.fsm.context import FSMContext
+from aiogram.fsm.state import State, StatesGroup
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StorageKey
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from aiogram.types import (
     InlineKeyboardButton,
     InlineKeyboardMarkup,
@@ -59,10 +81,94 @@ API_HOST = os.getenv("API_HOST", "0.0.0.0")
 API_PORT = int(os.getenv("API_PORT", "8080"))
 API_BASE_PATH = os.getenv("API_BASE_PATH", "/api").rstrip("/")
 ACCOUNTS_API_BASE_PATH = os.getenv("ACCOUNTS_API_BASE_PATH", "/api-accounts").rstrip("/")
+# HTTP: responses from API_COMPRESS_MIN_BYTES up are compressed (br if the brotli package is
+# installed, else gzip/deflate); idle keep-alive connections close after API_KEEPALIVE_SEC
+API_COMPRESS_MIN_BYTES = int(os.getenv("API_COMPRESS_MIN_BYTES", "1024"))
+API_COMPRESS_LEVEL = int(os.getenv("API_COMPRESS_LEVEL", "5"))  # zlib 1..9; brotli quality = min(level, 11)
+API_KEEPALIVE_SEC = float(os.getenv("API_KEEPALIVE_SEC", "75"))
+# Access log: this share of requests is logged, plus every 5xx and every request slower than API_SLOW_REQUEST_MS
+API_ACCESS_LOG_SAMPLE = float(os.getenv("API_ACCESS_LOG_SAMPLE", "0.01"))
+API_SLOW_REQUEST_MS = float(os.getenv("API_SLOW_REQUEST_MS", "1000"))
+# Most order ids one /orders/batch call may ask for
+API_ORDERS_BATCH_MAX = int(os.getenv("API_ORDERS_BATCH_MAX", "50"))
+# Largest request body accepted (WebApp JSON and Telegram webhook updates); bigger ones get 413
+API_MAX_BODY_BYTES = int(os.getenv("API_MAX_BODY_BYTES", str(256 * 1024)))
+# Rate limits per user (per client IP before initData validates), token buckets per route class;
+# a *_PER_MIN of 0 disables that class. "write" = orders/create, "read" = the rest of the WebApp API.
+API_RATE_WRITE_PER_MIN = float(os.getenv("API_RATE_WRITE_PER_MIN", "30"))
+API_RATE_WRITE_BURST = int(os.getenv("API_RATE_WRITE_BURST", "5"))
+API_RATE_READ_PER_MIN = float(os.getenv("API_RATE_READ_PER_MIN", "300"))
+API_RATE_READ_BURST = int(os.getenv("API_RATE_READ_BURST", "30"))
+# Set to 1 behind a proxy (e.g. the Scalingo router): the client address is then the last X-Forwarded-For
+# hop. Off by default, otherwise any client could pick its own rate-limit bucket with that header.
+API_TRUST_PROXY = os.getenv("API_TRUST_PROXY", "0").strip().lower() in ("1", "true", "yes", "on")
+# WebApp initData older than this (by auth_date) is rejected; 0 = no limit
+INIT_DATA_MAX_AGE_SEC = int(os.getenv("INIT_DATA_MAX_AGE_SEC", "86400"))
+INIT_DATA_CACHE_SIZE = int(os.getenv("INIT_DATA_CACHE_SIZE", "10000"))  # validated initData strings kept
+# orders/create: successful responses are replayed for retries of the same (user, order_id) this long
+ORDER_IDEMPOTENCY_TTL_SEC = int(os.getenv("ORDER_IDEMPOTENCY_TTL_SEC", "3600"))
+ORDER_IDEMPOTENCY_CACHE_SIZE = int(os.getenv("ORDER_IDEMPOTENCY_CACHE_SIZE", "10000"))
 
 # Минимальная сумма для пополнения картой (Telegram Payments)
 MIN_CARD_TOPUP_RUB = int(os.getenv("MIN_CARD_TOPUP_RUB", "100"))
 
+# Token for GET {API_BASE_PATH}/metrics (sent as X-Metrics-Token); without it the endpoint is disabled
+METRICS_TOKEN = (os.getenv("METRICS_TOKEN") or "").strip()
+
+# JSON library: "auto" uses orjson when installed, "json" forces the stdlib
+JSON_BACKEND = (os.getenv("JSON_BACKEND") or "auto").strip().lower()
+
+# Outbound pacing (Telegram flood limits). Rates <= 0 disable the bucket.
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))  # messages/sec across all chats
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # messages/sec per private chat
+SEND_CHAT_BURST = float(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_GROUP_RATE_PER_MIN = float(os.getenv("SEND_GROUP_RATE_PER_MIN", "20"))  # messages/min per group/channel
+SEND_GROUP_BURST = float(os.getenv("SEND_GROUP_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "5"))  # re-sends after TelegramRetryAfter
+
+# Notification outbox (durable, at-least-once delivery)
+OUTBOX_WORKERS = int(os.getenv("OUTBOX_WORKERS", "4"))
+OUTBOX_POLL_SEC = float(os.getenv("OUTBOX_POLL_SEC", "5"))
+OUTBOX_LEASE_SEC = int(os.getenv("OUTBOX_LEASE_SEC", "120"))  # a claimed row is retried after this if the worker died
+OUTBOX_MAX_BACKOFF_SEC = int(os.getenv("OUTBOX_MAX_BACKOFF_SEC", "600"))
+# A row still undelivered after this many attempts (~4h with the default backoff) is given up
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "30"))
+# Manager digest: events within this window are merged into one message (0 = send each event separately)
+MANAGER_DIGEST_WINDOW_SEC = max(0, min(int(os.getenv("MANAGER_DIGEST_WINDOW_SEC", "0")), OUTBOX_LEASE_SEC // 2))
+
+# Background follow-up actions registered by handlers via _on_commit()
+POST_COMMIT_CONCURRENCY = int(os.getenv("POST_COMMIT_CONCURRENCY", "8"))
+
+# WebApp push (GET {API_BASE_PATH}/events, Server-Sent Events)
+EVENTS_QUEUE_SIZE = int(os.getenv("EVENTS_QUEUE_SIZE", "64"))  # undelivered events per connection
+EVENTS_HEARTBEAT_SEC = float(os.getenv("EVENTS_HEARTBEAT_SEC", "15"))
+EVENTS_MAX_CONNECTIONS = int(os.getenv("EVENTS_MAX_CONNECTIONS", "10000"))
+
+# Update delivery: "polling" (default) or "webhook" (served by the API aiohttp app on WEBHOOK_PATH)
+BOT_DELIVERY = (os.getenv("BOT_DELIVERY") or "polling").strip().lower()
+WEBHOOK_URL = (os.getenv("WEBHOOK_URL") or "").strip().rstrip("/")  # public base URL, e.g. https://bot.example.com
+WEBHOOK_PATH = "/" + (os.getenv("WEBHOOK_PATH") or "/tg/webhook").strip().strip("/")
+# Required in webhook mode, checked against X-Telegram-Bot-Api-Secret-Token (1-256 of A-Z a-z 0-9 _ -)
+WEBHOOK_SECRET = (os.getenv("WEBHOOK_SECRET") or "").strip()
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv("WEBHOOK_MAX_CONNECTIONS", "40"))
+
+# Update handling (per process): at most UPDATE_CONCURRENCY handlers run at once, updates of one
+# user strictly one after another; intake (polling/webhook/worker pipe) pauses at UPDATE_MAX_PENDING
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+UPDATE_MAX_PENDING = int(os.getenv("UPDATE_MAX_PENDING", "1000"))
+
+# Multi-process mode: this process receives updates (polling or webhook) and routes them by user id
+# to BOT_WORKERS worker processes (0 = handle updates in this process)
+BOT_WORKERS = int(os.getenv("BOT_WORKERS", "0"))
+# Custom Bot API server (self-hosted telegram-bot-api, test doubles); empty = api.telegram.org
+TELEGRAM_API_URL = (os.getenv("TELEGRAM_API_URL") or "").strip().rstrip("/")
+
+# Short-lived per-user state (FSM, last invoice): "memory" (one process) or "db" (shared by several workers)
+STATE_BACKEND = (os.getenv("STATE_BACKEND") or "memory").strip().lower()
+STATE_TTL_SEC = int(os.getenv("STATE_TTL_SEC", "3600"))  # FSM state/data expire after this
+STATE_INVOICE_TTL_SEC = int(os.getenv("STATE_INVOICE_TTL_SEC", "86400"))
+STATE_MEMORY_MAX_KEYS = int(os.getenv("STATE_MEMORY_MAX_KEYS", "100000"))
+
 
 WELCOME_PHOTO = os.getenv("WELCOME_PHOTO", "photo_welcome.jpg")
 PHOTO_BOOST_MENU = os.getenv("PHOTO_BOOST_MENU", "photo_boost_menu.jpg")
@@ -104,9 +210,290 @@ logger = logging.getLogger(__name__)
 # =========================
 # BOT
 # =========================
-bot = Bot(token=BOT_TOKEN)
+if TELEGRAM_API_URL:
+    bot = Bot(token=BOT_TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)))
+else:
+    bot = Bot(token=BOT_TOKEN)
 dp = Dispatcher()
 
+# =========================
+# METRICS
+# =========================
+_METRIC_SOURCES: Dict[str, Callable[[], Dict[str, Any]]] = {}
+
+
+def _register_metrics(name: str, source: Callable[[], Dict[str, Any]]) -> None:
+    """Registers a snapshot callable exposed via GET {API_BASE_PATH}/metrics."""
+    _METRIC_SOURCES[str(name)] = source
+
+
+def _collect_metrics() -> Dict[str, Any]:
+    out: Dict[str, Any] = {}
+    for name, source in _METRIC_SOURCES.items():
+        try:
+            out[name] = source()
+        except Exception as e:
+            out[name] = {"error": str(e)}
+    return out
+
+
+# =========================
+# JSON
+# =========================
+# One place for (de)serialization of API responses, request bodies and JSON stored in the DB.
+# Output is compact UTF-8 either way, so both backends produce interchangeable data.
+orjson = None
+if JSON_BACKEND != "json":
+    try:
+        import orjson  # type: ignore
+    except Exception:
+        if JSON_BACKEND == "orjson":
+            raise RuntimeError("JSON_BACKEND=orjson but orjson is not installed. Install: pip install orjson")
+
+if orjson is not None:
+
+    def _json_dumpb(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    _json_loads = orjson.loads
+else:
+
+    def _json_dumpb(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    _json_loads = json.loads
+
+
+def _json_dumps(obj: Any) -> str:
+    return _json_dumpb(obj).decode("utf-8")
+
+
+_register_metrics("json", lambda: {"backend": "orjson" if orjson is not None else "json"})
+
+
+# =========================
+# SEND SCHEDULER (Telegram rate limits)
+# =========================
+# Lower value = sent first when the global budget is contended.
+SEND_PRIORITY_PAYMENT = 0  # payment / purchase confirmations
+SEND_PRIORITY_INTERACTIVE = 1  # replies to user actions (default)
+SEND_PRIORITY_NOTIFY = 2  # manager and referral notices
+SEND_PRIORITY_MARKETING = 3
+
+_send_priority: contextvars.ContextVar[int] = contextvars.ContextVar(
+    "send_priority", default=SEND_PRIORITY_INTERACTIVE
+)
+
+# Bot API methods that count against Telegram's per-chat / global message limits
+_RATE_LIMITED_METHOD_PREFIXES = ("Send", "Copy", "Forward", "EditMessage")
+
+
+@contextmanager
+def _send_priority_scope(priority: int):
+    """Sets the send priority for Bot API calls awaited inside the block."""
+    token = _send_priority.set(int(priority))
+    try:
+        yield
+    finally:
+        _send_priority.reset(token)
+
+
+class _TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "updated", "blocked_until")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = float(rate)
+        self.capacity = max(1.0, float(capacity))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until one token is available (0 if it can be taken now)."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        if self.rate <= 0:
+            return 0.0
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now: float) -> None:
+        if self.rate <= 0:
+            return
+        self._refill(now)
+        self.tokens -= 1
+
+    def block(self, now: float, seconds: float) -> None:
+        self.blocked_until = max(self.blocked_until, now + max(0.0, float(seconds)))
+
+    def idle(self, now: float) -> bool:
+        if now < self.blocked_until:
+            return False
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _SendScheduler:
+    """
+    Paces outgoing Bot API calls with token buckets (global + per chat) and
+    grants slots in priority order. Waiters are kept sorted by (priority, seq);
+    a single pump task hands out slots as buckets refill.
+    """
+
+    _PRUNE_EVERY_SEC = 60.0
+
+    def __init__(self) -> None:
+        self._global = _TokenBucket(SEND_GLOBAL_RATE, SEND_GLOBAL_RATE)
+        self._chats: Dict[Any, _TokenBucket] = {}
+        self._waiters: List[Tuple[int, int, Any, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._pump_task: Optional[asyncio.Task] = None
+        self._last_prune = time.monotonic()
+        self.sent = 0
+        self.retry_after = 0
+        self.max_queue_depth = 0
+
+    def set_global_rate(self, rate: float) -> None:
+        """Used by worker processes, which share SEND_GLOBAL_RATE between them."""
+        self._global = _TokenBucket(rate, rate)
+
+    @staticmethod
+    def _is_group_chat(chat_id: Any) -> bool:
+        if isinstance(chat_id, str):
+            return chat_id.startswith("@") or chat_id.startswith("-")
+        try:
+            return int(chat_id) < 0
+        except Exception:
+            return False
+
+    def _chat_bucket(self, chat_id: Any) -> _TokenBucket:
+        b = self._chats.get(chat_id)
+        if b is None:
+            if self._is_group_chat(chat_id):
+                b = _TokenBucket(SEND_GROUP_RATE_PER_MIN / 60.0, SEND_GROUP_BURST)
+            else:
+                b = _TokenBucket(SEND_CHAT_RATE, SEND_CHAT_BURST)
+            self._chats[chat_id] = b
+        return b
+
+    def _ensure_pump(self) -> None:
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.get_running_loop().create_task(self._pump())
+
+    async def acquire(self, chat_id: Any, priority: int) -> None:
+        fut = asyncio.get_running_loop().create_future()
+        bisect.insort(self._waiters, (int(priority), next(self._seq), chat_id, fut))
+        self.max_queue_depth = max(self.max_queue_depth, len(self._waiters))
+        self._ensure_pump()
+        self._wakeup.set()
+        await fut
+
+    def penalize(self, chat_id: Any, seconds: float) -> None:
+        """Applies a Telegram retry_after to the chat (or globally if unknown)."""
+        now = time.monotonic()
+        if chat_id is None:
+            self._global.block(now, seconds)
+        else:
+            self._chat_bucket(chat_id).block(now, seconds)
+
+    def _grant_ready(self) -> Optional[float]:
+        now = time.monotonic()
+        next_delay: Optional[float] = None
+        i = 0
+        while i < len(self._waiters):
+            global_wait = self._global.wait_time(now)
+            if global_wait > 0:
+                return global_wait
+            _prio, _seq, chat_id, fut = self._waiters[i]
+            if fut.done():
+                del self._waiters[i]
+                continue
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            wait = bucket.wait_time(now) if bucket else 0.0
+            if wait <= 0:
+                self._global.take(now)
+                if bucket:
+                    bucket.take(now)
+                del self._waiters[i]
+                fut.set_result(None)
+                continue
+            next_delay = wait if next_delay is None else min(next_delay, wait)
+            i += 1
+
+        if now - self._last_prune >= self._PRUNE_EVERY_SEC:
+            self._last_prune = now
+            waiting = {w[2] for w in self._waiters}
+            for cid in [c for c, b in self._chats.items() if c not in waiting and b.idle(now)]:
+                self._chats.pop(cid, None)
+        return next_delay
+
+    async def _pump(self) -> None:
+        while True:
+            self._wakeup.clear()
+            delay = self._grant_ready()
+            try:
+                if delay is None:
+                    await self._wakeup.wait()
+                else:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=delay)
+            except asyncio.TimeoutError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "queue_depth": len(self._waiters),
+            "max_queue_depth": self.max_queue_depth,
+            "sent": self.sent,
+            "retry_after": self.retry_after,
+            "chats_tracked": len(self._chats),
+        }
+
+
+_send_scheduler = _SendScheduler()
+_register_metrics("send_scheduler", _send_scheduler.stats)
+
+
+class _SendRateMiddleware(BaseRequestMiddleware):
+    """Routes message-producing Bot API calls through the send scheduler."""
+
+    async def __call__(self, make_request, bot, method):
+        if not type(method).__name__.startswith(_RATE_LIMITED_METHOD_PREFIXES):
+            return await make_request(bot, method)
+
+        chat_id = getattr(method, "chat_id", None)
+        priority = _send_priority.get()
+        attempt = 0
+        while True:
+            await _send_scheduler.acquire(chat_id, priority)
+            try:
+                result = await make_request(bot, method)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                _send_scheduler.retry_after += 1
+                _send_scheduler.penalize(chat_id, e.retry_after)
+                if attempt > SEND_MAX_RETRIES:
+                    raise
+                logger.warning(
+                    f"Flood control on {type(method).__name__} (chat {chat_id}): "
+                    f"retry in {e.retry_after}s, attempt {attempt}/{SEND_MAX_RETRIES}"
+                )
+                continue
+            _send_scheduler.sent += 1
+            return result
+
+
+bot.session.middleware(_SendRateMiddleware())
+
 # =========================
 # DB (MySQL or SQLite)
 # =========================
@@ -203,14 +590,6 @@ if _DB_KIND == "mysql":
                 affected = cur.rowcount
             return int(affected or 0)
 
-    def _db_commit() -> None:
-        with _db_lock:
-            _conn.commit()
-
-    def _db_rollback() -> None:
-        with _db_lock:
-            _conn.rollback()
-
     # Schema (InnoDB)
     with _db_lock:
         _db_ping()
@@ -285,8 +664,10 @@ if _DB_KIND == "mysql":
                   order_json LONGTEXT NOT NULL,
                   category_name VARCHAR(255),
                   status VARCHAR(16) NOT NULL DEFAULT 'new',
+                  change_seq BIGINT NOT NULL DEFAULT 0,
                   created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-                  KEY idx_orders_user_created (user_id, created_at)
+                  KEY idx_orders_user_created (user_id, created_at),
+                  KEY idx_orders_user_change (user_id, change_seq)
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
                 """
             )
@@ -332,6 +713,50 @@ if _DB_KIND == "mysql":
                 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
                 """
             )
+            # Durable notification outbox (drained by outbox workers)
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS notification_outbox (
+                  id BIGINT AUTO_INCREMENT PRIMARY KEY,
+                  kind VARCHAR(16) NOT NULL DEFAULT 'message',
+                  chat_id VARCHAR(64) NOT NULL DEFAULT '',
+                  payload LONGTEXT NOT NULL,
+                  priority INT NOT NULL DEFAULT 2,
+                  attempts INT NOT NULL DEFAULT 0,
+                  next_attempt_at BIGINT NOT NULL,
+                  created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+                  KEY idx_outbox_due (next_attempt_at, priority)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS kv_state (
+                  `key` VARCHAR(191) PRIMARY KEY,
+                  value TEXT NOT NULL,
+                  expires_at BIGINT NOT NULL,
+                  KEY idx_kv_state_expires (expires_at)
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """
+            )
+            cur.execute(
+                """
+                CREATE TABLE IF NOT EXISTS user_versions (
+                  user_id BIGINT PRIMARY KEY,
+                  version BIGINT NOT NULL DEFAULT 0
+                ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4;
+                """
+            )
+            # orders created before change_seq existed
+            cur.execute(
+                "SELECT COUNT(*) FROM information_schema.COLUMNS "
+                "WHERE TABLE_SCHEMA=DATABASE() AND TABLE_NAME='orders' AND COLUMN_NAME='change_seq'"
+            )
+            if not cur.fetchone()[0]:
+                cur.execute(
+                    "ALTER TABLE orders ADD COLUMN change_seq BIGINT NOT NULL DEFAULT 0, "
+                    "ADD KEY idx_orders_user_change (user_id, change_seq)"
+                )
 
         _conn.commit()
 
@@ -343,9 +768,13 @@ else:
     db_file = Path(DB_PATH)
     db_file.parent.mkdir(parents=True, exist_ok=True)
 
-    _conn = sqlite3.connect(str(db_file), check_same_thread=False)
+    # Other processes (BOT_WORKERS, a second instance) may hold the write lock: wait instead of failing
+    SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+
+    _conn = sqlite3.connect(str(db_file), check_same_thread=False, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000)
     _conn.execute("PRAGMA journal_mode=WAL;")
     _conn.execute("PRAGMA synchronous=NORMAL;")
+    _conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS};")
 
     with _db_lock:
         _conn.execute(
@@ -415,6 +844,7 @@ else:
               order_json TEXT NOT NULL,
               category_name TEXT,
               status TEXT NOT NULL DEFAULT 'new',
+              change_seq INTEGER NOT NULL DEFAULT 0,
               created_at TEXT NOT NULL DEFAULT (datetime('now'))
             )
             """
@@ -458,6 +888,42 @@ else:
             )
             """
         )
+        # Durable notification outbox (drained by outbox workers)
+        _conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS notification_outbox (
+              id INTEGER PRIMARY KEY AUTOINCREMENT,
+              kind TEXT NOT NULL DEFAULT 'message',
+              chat_id TEXT NOT NULL DEFAULT '',
+              payload TEXT NOT NULL,
+              priority INTEGER NOT NULL DEFAULT 2,
+              attempts INTEGER NOT NULL DEFAULT 0,
+              next_attempt_at INTEGER NOT NULL,
+              created_at TEXT NOT NULL DEFAULT (datetime('now'))
+            )
+            """
+        )
+        _conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_outbox_due ON notification_outbox (next_attempt_at, priority)"
+        )
+        _conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS kv_state (
+              key TEXT PRIMARY KEY,
+              value TEXT NOT NULL,
+              expires_at INTEGER NOT NULL
+            )
+            """
+        )
+        _conn.execute("CREATE INDEX IF NOT EXISTS idx_kv_state_expires ON kv_state (expires_at)")
+        _conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS user_versions (
+              user_id INTEGER PRIMARY KEY,
+              version INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
 
         _conn.commit()
 
@@ -476,12 +942,258 @@ else:
                     _conn.execute("ALTER TABLE orders ADD COLUMN status TEXT NOT NULL DEFAULT 'new'")
                 except Exception:
                     pass
+            if "change_seq" not in cols:
+                try:
+                    _conn.execute("ALTER TABLE orders ADD COLUMN change_seq INTEGER NOT NULL DEFAULT 0")
+                except Exception:
+                    pass
+            _conn.execute("CREATE INDEX IF NOT EXISTS idx_orders_user_change ON orders (user_id, change_seq)")
             _conn.commit()
 
 
     _ensure_orders_schema()
 
 
+# =========================
+# TRANSACTIONS
+# =========================
+_tx_depth = 0  # >0 while inside _db_transaction(); only touched under _db_lock
+_tx_hooks: List[Tuple[str, Callable[[], Any]]] = []  # post-commit hooks of the open transaction
+
+
+def _db_commit() -> None:
+    """Commits, unless an enclosing _db_transaction() will commit on exit."""
+    with _db_lock:
+        if _tx_depth:
+            return
+        _conn.commit()
+
+
+def _sqlite_begin_immediate() -> None:
+    """
+    Opens a write transaction right away (SQLite), so a read-then-write sequence can't interleave
+    with another process. Inside an already open transaction this is a no-op: its owner commits.
+    """
+    if _DB_KIND == "sqlite" and not _conn.in_transaction:
+        _conn.execute("BEGIN IMMEDIATE")
+
+
+def _db_rollback() -> None:
+    """Rolls back, unless an enclosing _db_transaction() owns the transaction."""
+    with _db_lock:
+        if _tx_depth:
+            return
+        _conn.rollback()
+
+
+@contextmanager
+def _db_transaction():
+    """
+    Groups several DB helpers into one transaction: inner commits are deferred
+    and the whole block is committed (or rolled back on error) on exit.
+
+    The block must not contain awaits: _db_lock is re-entrant per thread, so
+    another coroutine could otherwise interleave statements into it.
+    """
+    global _tx_depth
+    with _db_lock:
+        if _tx_depth == 0:
+            _sqlite_begin_immediate()
+        _tx_depth += 1
+        try:
+            yield
+        except BaseException:
+            _tx_depth -= 1
+            if _tx_depth == 0:
+                _tx_hooks.clear()
+                _conn.rollback()
+            raise
+        _tx_depth -= 1
+        if _tx_depth == 0:
+            try:
+                _conn.commit()
+            except BaseException:
+                _tx_hooks.clear()
+                raise
+            hooks = list(_tx_hooks)
+            _tx_hooks.clear()
+            for name, hook in hooks:
+                _post_commit.submit(hook, name)
+
+
+def _on_commit(hook: Callable[[], Any], name: str = "") -> None:
+    """
+    Registers a follow-up action (sync or async callable) that runs in the
+    background once the enclosing _db_transaction() commits. It is dropped on
+    rollback; outside a transaction it is scheduled right away.
+    """
+    name = name or getattr(hook, "__name__", "hook")
+    with _db_lock:
+        if _tx_depth:
+            _tx_hooks.append((name, hook))
+            return
+    _post_commit.submit(hook, name)
+
+
+class _PostCommitRunner:
+    """Runs post-commit hooks as background tasks, at most `concurrency` at a time."""
+
+    def __init__(self, concurrency: int) -> None:
+        self._concurrency = max(1, int(concurrency))
+        self._sem: Optional[asyncio.Semaphore] = None
+        self._tasks: set = set()
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+
+    def submit(self, hook: Callable[[], Any], name: str) -> None:
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No event loop (startup / scripts): run sync hooks inline
+            try:
+                res = hook()
+                if asyncio.iscoroutine(res):
+                    res.close()
+                    logger.warning(f"Post-commit hook {name} skipped: no running event loop")
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Post-commit hook {name} failed: {e}")
+            return
+        if self._sem is None:
+            self._sem = asyncio.Semaphore(self._concurrency)
+        task = loop.create_task(self._run(hook, name))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, hook: Callable[[], Any], name: str) -> None:
+        async with self._sem:
+            self.running += 1
+            try:
+                res = hook()
+                if inspect.isawaitable(res):
+                    await res
+                self.done += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Post-commit hook {name} failed: {e}", exc_info=True)
+            finally:
+                self.running -= 1
+
+    async def drain(self, timeout: float) -> None:
+        """Waits (bounded) for queued hooks, e.g. on shutdown."""
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "pending": len(self._tasks),
+            "running": self.running,
+            "done": self.done,
+            "failed": self.failed,
+        }
+
+
+_post_commit = _PostCommitRunner(POST_COMMIT_CONCURRENCY)
+_register_metrics("post_commit", _post_commit.stats)
+
+
+# =========================
+# EVENTS (WebApp push)
+# =========================
+class _EventHub:
+    """
+    In-process pub/sub of per-user events for the SSE endpoints. Every connection has a bounded
+    queue; when a slow client lets it fill up, its backlog is replaced by a single "resync"
+    event (the client then refetches via /bootstrap) instead of growing without limit.
+    Connections are keyed by API ("main" / "accounts"), so an event can skip a WebApp that
+    doesn't show it.
+    """
+
+    def __init__(self, queue_size: int):
+        self._queue_size = max(2, int(queue_size))
+        self._subs: Dict[int, Dict[asyncio.Queue, str]] = {}  # user -> {queue: api}
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self.connections = 0
+        self.published = 0
+        self.resyncs = 0
+
+    def has_subscribers(self, user_id: int) -> bool:
+        return int(user_id) in self._subs
+
+    def subscribe(self, user_id: int, api: str) -> asyncio.Queue:
+        self._loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(self._queue_size)
+        self._subs.setdefault(int(user_id), {})[queue] = api
+        self.connections += 1
+        return queue
+
+    def unsubscribe(self, user_id: int, queue: asyncio.Queue) -> None:
+        subs = self._subs.get(int(user_id))
+        if subs is not None and queue in subs:
+            del subs[queue]
+            self.connections -= 1
+            if not subs:
+                self._subs.pop(int(user_id), None)
+
+    def publish(self, user_id: int, event: str, data: Dict[str, Any], apis: Optional[Tuple[str, ...]] = None) -> None:
+        """Queues the event for the user's connections to `apis` (None = all of them)."""
+        loop = self._loop
+        if loop is None or not self.has_subscribers(user_id):
+            return
+        try:
+            on_loop = asyncio.get_running_loop() is loop
+        except RuntimeError:
+            on_loop = False
+        if not on_loop:
+            loop.call_soon_threadsafe(self.publish, user_id, event, data, apis)
+            return
+        self.published += 1
+        for queue, api in list(self._subs.get(int(user_id), {}).items()):
+            if apis is not None and api not in apis:
+                continue
+            try:
+                queue.put_nowait((event, data))
+            except asyncio.QueueFull:
+                self.resyncs += 1
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(("resync", {}))
+
+    def close_all(self) -> None:
+        """Ends every open stream (API server shutdown); None is the stop marker."""
+        for subs in list(self._subs.values()):
+            for queue in list(subs):
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "connections": self.connections,
+            "users": len(self._subs),
+            "published": self.published,
+            "resyncs": self.resyncs,
+        }
+
+
+_events = _EventHub(EVENTS_QUEUE_SIZE)
+_register_metrics("events", _events.stats)
+
+
+def _publish_user_event(
+    user_id: int, event: str, data: Dict[str, Any], apis: Optional[Tuple[str, ...]] = None
+) -> None:
+    """Pushes an event to the user's open WebApps (of `apis`, default all) once the enclosing transaction commits."""
+    if not _events.has_subscribers(user_id):
+        return
+
+    def _publish() -> None:
+        _events.publish(user_id, event, {**data, "version": _get_user_version(user_id)}, apis)
+
+    _on_commit(_publish, f"event_{event}")
+
+
 # =========================
 # SETTINGS (runtime config)
 # =========================
@@ -517,7 +1229,70 @@ def _set_setting(key: str, value: str) -> None:
                 "INSERT INTO settings (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
                 (key, v),
             )
-            _conn.commit()
+            _db_commit()
+
+
+def _get_user_version(user_id: int) -> int:
+    """Bumped on every balance/order change of the user; API responses use it as ETag."""
+    if _DB_KIND == "mysql":
+        row = _db_fetchone("SELECT version FROM user_versions WHERE user_id=%s", (int(user_id),))
+    else:
+        with _db_lock:
+            row = _conn.execute("SELECT version FROM user_versions WHERE user_id=?", (int(user_id),)).fetchone()
+    return int(row[0]) if row else 0
+
+
+def _bump_user_version(user_id: int) -> int:
+    """
+    Call before the mutation's commit, so nobody sees the new data under the old version. Returns
+    the new version; the row stays locked until commit, so versions follow commit order per user
+    and double as the orders change_seq.
+    """
+    if _DB_KIND == "mysql":
+        with _db_lock:
+            _db_exec(
+                "INSERT INTO user_versions (user_id, version) VALUES (%s, 1) ON DUPLICATE KEY UPDATE version=version+1",
+                (int(user_id),),
+            )
+            row = _db_fetchone("SELECT version FROM user_versions WHERE user_id=%s", (int(user_id),))
+        return int(row[0]) if row else 0
+    with _db_lock:
+        _conn.execute(
+            "INSERT INTO user_versions (user_id, version) VALUES (?, 1) "
+            "ON CONFLICT(user_id) DO UPDATE SET version=version+1",
+            (int(user_id),),
+        )
+        row = _conn.execute("SELECT version FROM user_versions WHERE user_id=?", (int(user_id),)).fetchone()
+    return int(row[0]) if row else 0
+
+
+def _backfill_order_change_seq() -> None:
+    """
+    Orders created before change_seq existed all have 0, so a full sync of more than one page of
+    them could never move its cursor. Gives each of them its own user version, oldest first.
+    """
+    with _db_transaction():
+        # Processes starting together: SQLite serializes them here (BEGIN IMMEDIATE); on MySQL the
+        # change_seq=0 condition of the UPDATE keeps the first value, the other only skips versions
+        if _DB_KIND == "mysql":
+            rows = _db_fetchall(
+                "SELECT order_id, user_id FROM orders WHERE change_seq=0 ORDER BY user_id, created_at, order_id", ()
+            )
+        else:
+            rows = _conn.execute(
+                "SELECT order_id, user_id FROM orders WHERE change_seq=0 ORDER BY user_id, datetime(created_at), order_id"
+            ).fetchall()
+        for order_id, user_id in rows:
+            seq = _bump_user_version(int(user_id))
+            if _DB_KIND == "mysql":
+                _db_exec("UPDATE orders SET change_seq=%s WHERE order_id=%s AND change_seq=0", (seq, str(order_id)))
+            else:
+                _conn.execute("UPDATE orders SET change_seq=? WHERE order_id=? AND change_seq=0", (seq, str(order_id)))
+    if rows:
+        logger.info(f"Backfilled change_seq of {len(rows)} orders")
+
+
+_backfill_order_change_seq()
 
 
 def _get_balance_kopecks(user_id: int) -> int:
@@ -540,7 +1315,9 @@ def _set_balance_kopecks(user_id: int, value: int) -> None:
             "ON DUPLICATE KEY UPDATE balance_kopecks=VALUES(balance_kopecks)",
             (int(user_id), value),
         )
+        _bump_user_version(user_id)
         _db_commit()
+        _publish_balance(user_id, value)
         return
     with _db_lock:
         _conn.execute(
@@ -548,7 +1325,17 @@ def _set_balance_kopecks(user_id: int, value: int) -> None:
             "ON CONFLICT(user_id) DO UPDATE SET balance_kopecks=excluded.balance_kopecks",
             (int(user_id), value),
         )
-        _conn.commit()
+        _bump_user_version(user_id)
+        _db_commit()
+    _publish_balance(user_id, value)
+
+
+def _publish_balance(user_id: int, balance_kopecks: int) -> None:
+    _publish_user_event(
+        user_id,
+        "balance",
+        {"balance_kopecks": int(balance_kopecks), "balance_rub": f"{int(balance_kopecks)/100:.2f}"},
+    )
 
 
 def _calc_referral_reward(amount_kopecks: int) -> int:
@@ -586,7 +1373,7 @@ def _set_referrer(user_id: int, referrer_id: int) -> bool:
             "INSERT OR IGNORE INTO referrals (user_id, referrer_id) VALUES (?, ?)",
             (user_id, referrer_id),
         )
-        _conn.commit()
+        _db_commit()
         return cur.rowcount > 0
 
 
@@ -617,7 +1404,7 @@ def _record_referral_reward(
             "VALUES (?, ?, ?, ?, ?)",
             (order_id, int(referrer_id), int(referred_id), int(amount_kopecks), int(reward_kopecks)),
         )
-        _conn.commit()
+        _db_commit()
         return cur.rowcount > 0
 
 
@@ -639,18 +1426,31 @@ def _add_balance_kopecks(user_id: int, delta: int) -> int:
                         "ON DUPLICATE KEY UPDATE balance_kopecks=VALUES(balance_kopecks)",
                         (int(user_id), int(new_val)),
                     )
-                _conn.commit()
+                _bump_user_version(user_id)
+                _db_commit()
+                _publish_balance(user_id, new_val)
                 return int(new_val)
             except Exception:
-                _conn.rollback()
+                _db_rollback()
                 raise
 
+    # SQLite: one upsert in a write transaction, safe against other processes
     with _db_lock:
-        cur = _get_balance_kopecks(user_id)
-        new_val = cur + int(delta)
-        if new_val < 0:
-            new_val = 0
-        _set_balance_kopecks(user_id, new_val)
+        try:
+            _sqlite_begin_immediate()
+            _conn.execute(
+                "INSERT INTO balances (user_id, balance_kopecks) VALUES (?, MAX(0, ?)) "
+                "ON CONFLICT(user_id) DO UPDATE SET balance_kopecks = MAX(0, balance_kopecks + ?)",
+                (int(user_id), int(delta), int(delta)),
+            )
+            _bump_user_version(user_id)
+            row = _conn.execute("SELECT balance_kopecks FROM balances WHERE user_id = ?", (int(user_id),)).fetchone()
+            _db_commit()
+        except Exception:
+            _db_rollback()
+            raise
+    new_val = int(row[0]) if row else 0
+    _publish_balance(user_id, new_val)
     return new_val
 
 
@@ -659,12 +1459,12 @@ def _try_debit_balance_kopecks(user_id: int, amount: int) -> Tuple[bool, int, in
     Возвращает: ok, balance_before, balance_after
 
     ВАЖНО: amount должен быть строго > 0 (иначе это путь к накрутке).
-    Для MySQL списание выполняется в транзакции с SELECT ... FOR UPDATE.
+    Для MySQL списание выполняется в транзакции с SELECT ... FOR UPDATE,
+    для SQLite — условным UPDATE внутри BEGIN IMMEDIATE.
     """
     amount = int(amount)
-    before = _get_balance_kopecks(user_id)
-
     if amount <= 0:
+        before = _get_balance_kopecks(user_id)
         return False, before, before
 
     if _DB_KIND == "mysql":
@@ -676,7 +1476,7 @@ def _try_debit_balance_kopecks(user_id: int, amount: int) -> Tuple[bool, int, in
                     row = cur.fetchone()
                     cur_bal = int(row[0]) if row else 0
                     if cur_bal < amount:
-                        _conn.rollback()
+                        _db_rollback()
                         return False, cur_bal, cur_bal
                     new_val = cur_bal - amount
                     cur.execute(
@@ -684,20 +1484,49 @@ def _try_debit_balance_kopecks(user_id: int, amount: int) -> Tuple[bool, int, in
                         "ON DUPLICATE KEY UPDATE balance_kopecks=VALUES(balance_kopecks)",
                         (int(user_id), int(new_val)),
                     )
-                _conn.commit()
+                _bump_user_version(user_id)
+                _db_commit()
+                _publish_balance(user_id, new_val)
                 return True, cur_bal, int(new_val)
             except Exception:
-                _conn.rollback()
+                _db_rollback()
                 raise
 
-    # SQLite
+    # SQLite: the balance check is part of the UPDATE, so two debits can't both pass it
     with _db_lock:
-        cur_bal = _get_balance_kopecks(user_id)
-        if cur_bal < amount:
-            return False, cur_bal, cur_bal
-        new_val = cur_bal - amount
-        _set_balance_kopecks(user_id, new_val)
-        return True, cur_bal, int(new_val)
+        try:
+            _sqlite_begin_immediate()
+            debited = _conn.execute(
+                "UPDATE balances SET balance_kopecks = balance_kopecks - ? WHERE user_id = ? AND balance_kopecks >= ?",
+                (amount, int(user_id), amount),
+            ).rowcount
+            if debited:
+                _bump_user_version(user_id)
+            row = _conn.execute("SELECT balance_kopecks FROM balances WHERE user_id = ?", (int(user_id),)).fetchone()
+            _db_commit()
+        except Exception:
+            _db_rollback()
+            raise
+    cur_bal = int(row[0]) if row else 0
+    if debited != 1:
+        return False, cur_bal, cur_bal
+    _publish_balance(user_id, cur_bal)
+    return True, cur_bal + amount, cur_bal
+
+
+_balance_locks: "weakref.WeakValueDictionary[int, asyncio.Lock]" = weakref.WeakValueDictionary()
+
+
+def _balance_lock(user_id: int) -> asyncio.Lock:
+    """
+    Per-user lock for check-order / debit / record-order sequences in this process. Other users
+    don't wait on it; the lock is dropped once nobody holds a reference.
+    """
+    lock = _balance_locks.get(int(user_id))
+    if lock is None:
+        lock = asyncio.Lock()
+        _balance_locks[int(user_id)] = lock
+    return lock
 
 
 def _format_rub_from_kopecks(v: int) -> str:
@@ -723,7 +1552,7 @@ def _apply_discount_kopecks(user_id: int, amount_kopecks: int, discount_applied:
 
 
 def _b64url_encode_json(obj: Dict[str, Any]) -> str:
-    raw = json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    raw = _json_dumpb(obj)
     return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
 
 
@@ -796,56 +1625,77 @@ def _mark_tg_payment_processed(telegram_charge_id: str, provider_charge_id: str,
             "VALUES (?, ?, ?, ?)",
             (telegram_charge_id, provider_charge_id, user_id, int(amount_kopecks)),
         )
-        _conn.commit()
+        _db_commit()
 
 
 # =========================
 # PENDING / PROCESSED ORDERS
 # =========================
-def _is_order_processed(order_id: str) -> bool:
+def _mark_order_processed(order_id: str, user_id: int, amount_kopecks: int, order_json: str) -> bool:
+    """Records the order; False if it was already recorded (by this or another process)."""
     if not order_id:
         return False
     if _DB_KIND == "mysql":
-        row = _db_fetchone("SELECT 1 FROM processed_orders WHERE order_id=%s", (str(order_id),))
-        return bool(row)
-    with _db_lock:
-        row = _conn.execute("SELECT 1 FROM processed_orders WHERE order_id=?", (str(order_id),)).fetchone()
-    return bool(row)
-
-
-def _mark_order_processed(order_id: str, user_id: int, amount_kopecks: int, order_json: str) -> None:
-    if not order_id:
-        return
-    if _DB_KIND == "mysql":
-        _db_exec(
+        inserted = _db_exec(
             "INSERT IGNORE INTO processed_orders (order_id, user_id, amount_kopecks, order_json) VALUES (%s, %s, %s, %s)",
             (str(order_id), int(user_id), int(amount_kopecks), str(order_json)),
         )
         _db_commit()
-        return
+        return inserted == 1
     with _db_lock:
-        _conn.execute(
+        inserted = _conn.execute(
             "INSERT OR IGNORE INTO processed_orders (order_id, user_id, amount_kopecks, order_json) VALUES (?, ?, ?, ?)",
             (str(order_id), int(user_id), int(amount_kopecks), str(order_json)),
-        )
-        _conn.commit()
+        ).rowcount
+        _db_commit()
+    return inserted == 1
 
 
-def _set_pending_order(user_id: int, order_id: str, amount_kopecks: int, order_json: str) -> None:
+def _unmark_order_processed(order_id: str) -> None:
     if _DB_KIND == "mysql":
-        _db_exec(
-            "INSERT INTO pending_orders (user_id, order_id, amount_kopecks, order_json) VALUES (%s, %s, %s, %s) "
-            "ON DUPLICATE KEY UPDATE order_id=VALUES(order_id), amount_kopecks=VALUES(amount_kopecks), order_json=VALUES(order_json)",
-            (int(user_id), str(order_id), int(amount_kopecks), str(order_json)),
-        )
+        _db_exec("DELETE FROM processed_orders WHERE order_id=%s", (str(order_id),))
         _db_commit()
         return
     with _db_lock:
-        _conn.execute(
+        _conn.execute("DELETE FROM processed_orders WHERE order_id=?", (str(order_id),))
+        _db_commit()
+
+
+def _pay_order_from_balance(user_id: int, order_id: str, amount_kopecks: int, order_json: str) -> Tuple[str, int, int]:
+    """
+    Records the order in processed_orders and debits its amount, all in the caller's
+    _db_transaction() (or its own). Returns (status, balance_before, balance_after), status one of
+    "paid", "duplicate" (already paid, nothing debited) or "insufficient" (nothing recorded).
+
+    The row is inserted before the debit: a concurrent payment of the same order in another
+    process blocks on its key until this transaction ends and then sees a duplicate.
+    """
+    with _db_transaction():
+        if not _mark_order_processed(order_id, user_id, amount_kopecks, order_json):
+            bal = _get_balance_kopecks(user_id)
+            return "duplicate", bal, bal
+        ok, before, after = _try_debit_balance_kopecks(user_id, amount_kopecks)
+        if not ok:
+            _unmark_order_processed(order_id)
+            return "insufficient", before, after
+        return "paid", before, after
+
+
+def _set_pending_order(user_id: int, order_id: str, amount_kopecks: int, order_json: str) -> None:
+    if _DB_KIND == "mysql":
+        _db_exec(
+            "INSERT INTO pending_orders (user_id, order_id, amount_kopecks, order_json) VALUES (%s, %s, %s, %s) "
+            "ON DUPLICATE KEY UPDATE order_id=VALUES(order_id), amount_kopecks=VALUES(amount_kopecks), order_json=VALUES(order_json)",
+            (int(user_id), str(order_id), int(amount_kopecks), str(order_json)),
+        )
+        _db_commit()
+        return
+    with _db_lock:
+        _conn.execute(
             "INSERT OR REPLACE INTO pending_orders (user_id, order_id, amount_kopecks, order_json) VALUES (?, ?, ?, ?)",
             (int(user_id), str(order_id), int(amount_kopecks), str(order_json)),
         )
-        _conn.commit()
+        _db_commit()
 
 
 def _get_pending_order(user_id: int) -> Optional[Dict[str, Any]]:
@@ -863,7 +1713,7 @@ def _get_pending_order(user_id: int) -> Optional[Dict[str, Any]]:
     if not row:
         return None
     try:
-        payload = json.loads(str(row[3]))
+        payload = _json_loads(str(row[3]))
     except Exception:
         payload = {}
     return {
@@ -882,7 +1732,7 @@ def _clear_pending_order(user_id: int) -> None:
         return
     with _db_lock:
         _conn.execute("DELETE FROM pending_orders WHERE user_id=?", (int(user_id),))
-        _conn.commit()
+        _db_commit()
 
 
 # =========================
@@ -902,20 +1752,26 @@ def _create_order(user_id: int, order: Dict[str, Any], amount_kopecks: int) -> s
         or "—"
     )
     try:
-        order_json = json.dumps(order, ensure_ascii=False)
+        order_json = _json_dumps(order)
     except Exception:
         order_json = "{}"
 
     if _DB_KIND == "mysql":
         # Preserve current status by not updating it in ON DUPLICATE KEY UPDATE
-        _db_exec(
-            "INSERT INTO orders (order_id, user_id, amount_kopecks, order_json, category_name, status) "
-            "VALUES (%s, %s, %s, %s, %s, %s) "
-            "ON DUPLICATE KEY UPDATE "
-            "user_id=VALUES(user_id), amount_kopecks=VALUES(amount_kopecks), order_json=VALUES(order_json), category_name=VALUES(category_name)",
-            (order_id, int(user_id), int(amount_kopecks), order_json, category_name, "new"),
+        with _db_lock:
+            seq = _bump_user_version(user_id)
+            _db_exec(
+                "INSERT INTO orders (order_id, user_id, amount_kopecks, order_json, category_name, status, change_seq) "
+                "VALUES (%s, %s, %s, %s, %s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE "
+                "user_id=VALUES(user_id), amount_kopecks=VALUES(amount_kopecks), order_json=VALUES(order_json), "
+                "category_name=VALUES(category_name), change_seq=VALUES(change_seq)",
+                (order_id, int(user_id), int(amount_kopecks), order_json, category_name, "new", seq),
+            )
+            _db_commit()
+        _publish_user_event(
+            user_id, "order", {"order_id": order_id, "category_name": category_name}, _order_event_apis(order)
         )
-        _db_commit()
         return order_id
 
     with _db_lock:
@@ -926,37 +1782,78 @@ def _create_order(user_id: int, order: Dict[str, Any], amount_kopecks: int) -> s
         except Exception:
             cur_status = "new"
 
+        seq = _bump_user_version(user_id)
         try:
             _conn.execute(
-                "INSERT INTO orders (order_id, user_id, amount_kopecks, order_json, category_name, status) "
-                "VALUES (?, ?, ?, ?, ?, ?) "
+                "INSERT INTO orders (order_id, user_id, amount_kopecks, order_json, category_name, status, change_seq) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?) "
                 "ON CONFLICT(order_id) DO UPDATE SET "
                 "user_id=excluded.user_id, "
                 "amount_kopecks=excluded.amount_kopecks, "
                 "order_json=excluded.order_json, "
-                "category_name=excluded.category_name",
-                (order_id, int(user_id), int(amount_kopecks), order_json, category_name, cur_status),
+                "category_name=excluded.category_name, "
+                "change_seq=excluded.change_seq",
+                (order_id, int(user_id), int(amount_kopecks), order_json, category_name, cur_status, seq),
             )
         except Exception:
             # Fallback for very old SQLite builds
             _conn.execute(
-                "INSERT OR REPLACE INTO orders (order_id, user_id, amount_kopecks, order_json, category_name, status) "
-                "VALUES (?, ?, ?, ?, ?, ?)",
-                (order_id, int(user_id), int(amount_kopecks), order_json, category_name, cur_status),
+                "INSERT OR REPLACE INTO orders (order_id, user_id, amount_kopecks, order_json, category_name, status, change_seq) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (order_id, int(user_id), int(amount_kopecks), order_json, category_name, cur_status, seq),
             )
-        _conn.commit()
+        _db_commit()
+    _publish_user_event(
+        user_id,
+        "order",
+        {"order_id": order_id, "category_name": category_name, "status": cur_status},
+        _order_event_apis(order),
+    )
     return order_id
 
 
 def _set_order_status(order_id: str, status: str) -> None:
     status = str(status or "").strip() or "new"
     if _DB_KIND == "mysql":
-        _db_exec("UPDATE orders SET status=%s WHERE order_id=%s", (status, str(order_id)))
-        _db_commit()
-        return
-    with _db_lock:
-        _conn.execute("UPDATE orders SET status=? WHERE order_id=?", (status, str(order_id)))
-        _conn.commit()
+        with _db_lock:
+            row = _db_fetchone("SELECT user_id, order_json FROM orders WHERE order_id=%s", (str(order_id),))
+            if row:
+                seq = _bump_user_version(int(row[0]))
+                _db_exec("UPDATE orders SET status=%s, change_seq=%s WHERE order_id=%s", (status, seq, str(order_id)))
+            _db_commit()
+    else:
+        with _db_lock:
+            row = _conn.execute("SELECT user_id, order_json FROM orders WHERE order_id=?", (str(order_id),)).fetchone()
+            if row:
+                seq = _bump_user_version(int(row[0]))
+                _conn.execute("UPDATE orders SET status=?, change_seq=? WHERE order_id=?", (status, seq, str(order_id)))
+            _db_commit()
+    if row:
+        try:
+            payload = _json_loads(str(row[1] or "{}"))
+        except Exception:
+            payload = {}
+        _publish_user_event(
+            int(row[0]), "order_status", {"order_id": str(order_id), "status": status}, _order_event_apis(payload)
+        )
+
+
+def _order_from_row(row: tuple) -> Dict[str, Any]:
+    """(order_id, amount_kopecks, order_json, created_at, category_name, status) -> order dict."""
+    try:
+        payload = _json_loads(str(row[2]))
+    except Exception:
+        payload = {}
+    category_name = str(row[4] or payload.get("category_name") or payload.get("categoryName") or payload.get("category") or "—")
+    status = str(row[5] or "new")
+    return {
+        "order_id": str(row[0]),
+        "amount_kopecks": int(row[1]),
+        "created_at": str(row[3]),
+        "category_name": category_name,
+        "status": status,
+        "order": payload,
+    }
 
 
 def _list_orders(user_id: int, limit: int = 50) -> List[Dict[str, Any]]:
@@ -973,25 +1870,37 @@ def _list_orders(user_id: int, limit: int = 50) -> List[Dict[str, Any]]:
                 "FROM orders WHERE user_id=? ORDER BY datetime(created_at) DESC LIMIT ?",
                 (int(user_id), int(limit)),
             ).fetchall()
-    out: List[Dict[str, Any]] = []
-    for r in rows:
-        try:
-            payload = json.loads(str(r[2]))
-        except Exception:
-            payload = {}
-        category_name = str(r[4] or payload.get("category_name") or payload.get("categoryName") or payload.get("category") or "—")
-        status = str(r[5] or "new")
-        out.append(
-            {
-                "order_id": str(r[0]),
-                "amount_kopecks": int(r[1]),
-                "created_at": str(r[3]),
-                "category_name": category_name,
-                "status": status,
-                "order": payload,
-            }
+    return [_order_from_row(r) for r in rows]
+
+
+def _list_order_changes(user_id: int, since: int, limit: int = 200) -> Tuple[List[Dict[str, Any]], int, bool]:
+    """
+    Orders changed after the cursor (change_seq > since), oldest change first.
+    Returns (orders, next cursor, has_more); pass since=-1 for a full sync.
+    """
+    if _DB_KIND == "mysql":
+        rows = _db_fetchall(
+            "SELECT order_id, amount_kopecks, order_json, created_at, category_name, status, change_seq "
+            "FROM orders WHERE user_id=%s AND change_seq>%s ORDER BY change_seq LIMIT %s",
+            (int(user_id), int(since), int(limit) + 1),
         )
-    return out
+    else:
+        with _db_lock:
+            rows = _conn.execute(
+                "SELECT order_id, amount_kopecks, order_json, created_at, category_name, status, change_seq "
+                "FROM orders WHERE user_id=? AND change_seq>? ORDER BY change_seq LIMIT ?",
+                (int(user_id), int(since), int(limit) + 1),
+            ).fetchall()
+    has_more = len(rows) > int(limit)
+    rows = rows[: int(limit)]
+    cursor = max([int(since), 0] + [int(r[6]) for r in rows])
+    return [_order_from_row(r) for r in rows], cursor, has_more
+
+
+def _list_order_changes_accounts(user_id: int, since: int, limit: int = 200) -> Tuple[List[Dict[str, Any]], int, bool]:
+    # The cursor still moves past filtered-out rows
+    orders, cursor, has_more = _list_order_changes(user_id, since, limit)
+    return [o for o in orders if _is_accounts_order_payload(o.get("order") or {})], cursor, has_more
 
 
 def _list_orders_accounts(user_id: int, limit: int = 50) -> List[Dict[str, Any]]:
@@ -1018,7 +1927,7 @@ def _list_all_orders(limit: int = 50) -> List[Dict[str, Any]]:
     out: List[Dict[str, Any]] = []
     for r in rows:
         try:
-            payload = json.loads(str(r[3]))
+            payload = _json_loads(str(r[3]))
         except Exception:
             payload = {}
         category_name = str(r[5] or payload.get("category_name") or payload.get("categoryName") or payload.get("category") or "—")
@@ -1053,20 +1962,34 @@ def _get_order(user_id: int, order_id: str) -> Optional[Dict[str, Any]]:
             ).fetchone()
     if not row:
         return None
-    try:
-        payload = json.loads(str(row[2]))
-    except Exception:
-        payload = {}
-    category_name = str(row[4] or payload.get("category_name") or payload.get("categoryName") or payload.get("category") or "—")
-    status = str(row[5] or "new")
-    return {
-        "order_id": str(row[0]),
-        "amount_kopecks": int(row[1]),
-        "created_at": str(row[3]),
-        "category_name": category_name,
-        "status": status,
-        "order": payload,
-    }
+    return _order_from_row(row)
+
+
+def _get_orders(user_id: int, order_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """The user's orders among order_ids, in one IN (...) query; unknown ids are simply absent."""
+    if not order_ids:
+        return {}
+    if _DB_KIND == "mysql":
+        marks = ",".join(["%s"] * len(order_ids))
+        rows = _db_fetchall(
+            "SELECT order_id, amount_kopecks, order_json, created_at, category_name, status "
+            f"FROM orders WHERE user_id=%s AND order_id IN ({marks})",
+            (int(user_id), *map(str, order_ids)),
+        )
+    else:
+        marks = ",".join(["?"] * len(order_ids))
+        with _db_lock:
+            rows = _conn.execute(
+                "SELECT order_id, amount_kopecks, order_json, created_at, category_name, status "
+                f"FROM orders WHERE user_id=? AND order_id IN ({marks})",
+                (int(user_id), *map(str, order_ids)),
+            ).fetchall()
+    return {str(r[0]): _order_from_row(r) for r in rows}
+
+
+def _get_orders_accounts(user_id: int, order_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    rows = _get_orders(user_id, order_ids)
+    return {oid: o for oid, o in rows.items() if _is_accounts_order_payload(o.get("order") or {})}
 
 
 def _get_order_accounts(user_id: int, order_id: str) -> Optional[Dict[str, Any]]:
@@ -1097,7 +2020,7 @@ def _get_order_by_id(order_id: str) -> Optional[Dict[str, Any]]:
     if not row:
         return None
     try:
-        payload = json.loads(str(row[3]))
+        payload = _json_loads(str(row[3]))
     except Exception:
         payload = {}
     category_name = str(row[5] or payload.get("category_name") or payload.get("categoryName") or payload.get("category") or "—")
@@ -1115,10 +2038,175 @@ def _get_order_by_id(order_id: str) -> Optional[Dict[str, Any]]:
 # =========================
 # STATE
 # =========================
-awaiting_custom_topup_card = set()  # user_id awaiting_custom_topup_card
-awaiting_custom_topup_crypto = set()  # user_id
+class _MemoryStateStore:
+    """Process-local key/value store with TTL; the least recently used keys are evicted above max_keys."""
+
+    def __init__(self, max_keys: int):
+        self._data: "collections.OrderedDict[str, Tuple[float, Any]]" = collections.OrderedDict()
+        self._max_keys = max(1, int(max_keys))
+        self.evicted = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[0] <= time.time():
+            self._data.pop(key, None)
+            return None
+        self._data.move_to_end(key)
+        return item[1]
+
+    def set(self, key: str, value: Any, ttl: int) -> None:
+        self._data[key] = (time.time() + max(1, int(ttl)), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self._max_keys:
+            self._data.popitem(last=False)
+            self.evicted += 1
+
+    def delete(self, key: str) -> None:
+        self._data.pop(key, None)
+
+    def purge(self) -> int:
+        now = time.time()
+        expired = [k for k, (exp, _) in self._data.items() if exp <= now]
+        for k in expired:
+            self._data.pop(k, None)
+        return len(expired)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "memory", "keys": len(self._data), "evicted": self.evicted}
+
+
+class _DbStateStore:
+    """kv_state table; lets several bot workers see the same per-user state."""
+
+    def get(self, key: str) -> Optional[Any]:
+        now = int(time.time())
+        if _DB_KIND == "mysql":
+            row = _db_fetchone("SELECT value FROM kv_state WHERE `key`=%s AND expires_at>%s", (key, now))
+        else:
+            with _db_lock:
+                row = _conn.execute("SELECT value FROM kv_state WHERE key=? AND expires_at>?", (key, now)).fetchone()
+        if not row:
+            return None
+        try:
+            return _json_loads(row[0])
+        except Exception:
+            return None
+
+    def set(self, key: str, value: Any, ttl: int) -> None:
+        value_json = _json_dumps(value)
+        expires_at = int(time.time()) + max(1, int(ttl))
+        if _DB_KIND == "mysql":
+            _db_exec(
+                "INSERT INTO kv_state (`key`, value, expires_at) VALUES (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE value=VALUES(value), expires_at=VALUES(expires_at)",
+                (key, value_json, expires_at),
+            )
+            _db_commit()
+        else:
+            with _db_lock:
+                _conn.execute(
+                    "INSERT INTO kv_state (key, value, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value=excluded.value, expires_at=excluded.expires_at",
+                    (key, value_json, expires_at),
+                )
+                _db_commit()
+
+    def delete(self, key: str) -> None:
+        if _DB_KIND == "mysql":
+            _db_exec("DELETE FROM kv_state WHERE `key`=%s", (key,))
+            _db_commit()
+        else:
+            with _db_lock:
+                _conn.execute("DELETE FROM kv_state WHERE key=?", (key,))
+                _db_commit()
+
+    def purge(self) -> int:
+        now = int(time.time())
+        if _DB_KIND == "mysql":
+            n = _db_exec("DELETE FROM kv_state WHERE expires_at<=%s", (now,))
+            _db_commit()
+            return int(n or 0)
+        with _db_lock:
+            n = _conn.execute("DELETE FROM kv_state WHERE expires_at<=?", (now,)).rowcount
+            _db_commit()
+        return int(n or 0)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"backend": "db"}
+
+
+_state_store = _DbStateStore() if STATE_BACKEND == "db" else _MemoryStateStore(STATE_MEMORY_MAX_KEYS)
+_register_metrics("state_store", lambda: _state_store.stats())
+
+
+class _StateFSMStorage(BaseStorage):
+    """aiogram FSM storage on top of _state_store; state and data expire after STATE_TTL_SEC."""
+
+    def __init__(self, store: Any, ttl: int):
+        self._store = store
+        self._ttl = ttl
+        self._keys = DefaultKeyBuilder(prefix="fsm", with_bot_id=True)
+
+    async def set_state(self, key: StorageKey, state: Any = None) -> None:
+        k = self._keys.build(key, "state")
+        value = state.state if isinstance(state, State) else state
+        if value is None:
+            self._store.delete(k)
+        else:
+            self._store.set(k, str(value), self._ttl)
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        return self._store.get(self._keys.build(key, "state"))
+
+    async def set_data(self, key: StorageKey, data: Any) -> None:
+        k = self._keys.build(key, "data")
+        if data:
+            self._store.set(k, dict(data), self._ttl)
+        else:
+            self._store.delete(k)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        return dict(self._store.get(self._keys.build(key, "data")) or {})
+
+    async def close(self) -> None:
+        pass
+
+
+dp.fsm.storage = _StateFSMStorage(_state_store, STATE_TTL_SEC)
+
+
+class TopupStates(StatesGroup):
+    custom_card = State()  # waiting for a custom card top-up amount
+    custom_crypto = State()  # waiting for a custom crypto top-up amount
+
+
+async def _leave_topup_state(state: FSMContext, *states: State) -> None:
+    """Clears the FSM state if it is one of `states` (any top-up state when none given)."""
+    current = await state.get_state()
+    if current is None:
+        return
+    names = {s.state for s in (states or (TopupStates.custom_card, TopupStates.custom_crypto))}
+    if current in names:
+        await state.clear()
+
+
 # последний инвойс по карте на пользователя (чтобы удалять старый)
-_last_tg_invoice: Dict[int, Dict[str, Any]] = {}
+def _last_tg_invoice_key(user_id: int) -> str:
+    return f"tg_invoice:{int(user_id)}"
+
+
+async def state_janitor() -> None:
+    """Drops expired state entries (memory backend expires lazily too, this keeps it bounded)."""
+    while True:
+        await asyncio.sleep(600)
+        try:
+            removed = _state_store.purge()
+            if removed:
+                logger.info(f"State store: {removed} expired keys removed")
+        except Exception as e:
+            logger.error(f"State janitor error: {e}")
 
 
 # =========================
@@ -1220,7 +2308,7 @@ def _store_crypto_invoice(invoice_id: int, user_id: int, amount_kopecks: int, am
             """,
             (invoice_id, user_id, int(amount_kopecks), amount_rub_str, pay_url, invoice_id),
         )
-        _conn.commit()
+        _db_commit()
 
 def _get_active_crypto_invoice_ids(limit: int = 200) -> List[int]:
     if _DB_KIND == "mysql":
@@ -1248,10 +2336,10 @@ def _mark_crypto_paid_if_first(invoice_id: int) -> bool:
                         (int(invoice_id),),
                     )
                     changed = int(cur.rowcount or 0)
-                _conn.commit()
+                _db_commit()
                 return changed > 0
             except Exception:
-                _conn.rollback()
+                _db_rollback()
                 raise
 
     with _db_lock:
@@ -1261,7 +2349,7 @@ def _mark_crypto_paid_if_first(invoice_id: int) -> bool:
         if str(row[0]) == "paid":
             return False
         _conn.execute("UPDATE crypto_invoices SET status='paid' WHERE invoice_id=?", (int(invoice_id),))
-        _conn.commit()
+        _db_commit()
     return True
 
 
@@ -1298,7 +2386,7 @@ def _add_ref_balance(user_id: int, amount_kopecks: int) -> None:
                 "updated_at=datetime('now')",
                 (int(user_id), int(amount_kopecks)),
             )
-            _conn.commit()
+            _db_commit()
 
 def _get_crypto_invoice_meta(invoice_id: int) -> Optional[Dict[str, Any]]:
     if _DB_KIND == "mysql":
@@ -1343,90 +2431,520 @@ def _resolve_manager_target() -> Optional[Any]:
     return None
 
 
-async def _notify_manager(text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
-    target = _resolve_manager_target()
-    if not target:
+def _notify_manager_bg(
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    urgent: bool = False,
+) -> None:
+    """
+    Queues a manager notification in the durable outbox (target resolved at send time).
+    With MANAGER_DIGEST_WINDOW_SEC > 0 the event waits for the digest unless urgent=True.
+    """
+    if not _resolve_manager_target():
         logger.warning("Manager target is not configured (set MANAGER_CHAT_ID or use /manager_set).")
-        return
-
-    try:
-        await bot.send_message(
-            target,
+    if MANAGER_DIGEST_WINDOW_SEC > 0 and not urgent:
+        _outbox_enqueue(
+            None,
             text,
-            parse_mode=ParseMode.HTML,
-            disable_web_page_preview=True,
             reply_markup=reply_markup,
+            priority=SEND_PRIORITY_NOTIFY,
+            kind=_OUTBOX_KIND_MANAGER_DIGEST,
+            delay_sec=MANAGER_DIGEST_WINDOW_SEC,
         )
-    except Exception as e:
-        logger.error(f"Failed to notify manager ({target}): {e}")
-
-
-def _notify_manager_bg(text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
-    """Fire-and-forget manager notification using asyncio."""
-    try:
-        loop = asyncio.get_running_loop()
-    except RuntimeError:
         return
-    loop.create_task(_notify_manager(text, reply_markup=reply_markup))
+    _outbox_enqueue(None, text, reply_markup=reply_markup, priority=SEND_PRIORITY_NOTIFY, kind=_OUTBOX_KIND_MANAGER)
 
 
-def _user_link(user_id: int, display: str = "пользователь") -> str:
-    return f"<a href=\"tg://user?id={int(user_id)}\">{display}</a>"
+# =========================
+# NOTIFICATION OUTBOX
+# =========================
+_OUTBOX_KIND_MESSAGE = "message"
+_OUTBOX_KIND_MANAGER = "manager"  # chat_id is resolved via _resolve_manager_target() when sending
+_OUTBOX_KIND_MANAGER_DIGEST = "manager_digest"  # same target, merged with other events of the window
 
+TG_MESSAGE_LIMIT = 4096  # UTF-16 code units, see _tg_len()
 
-def _order_text_block(order: Dict[str, Any]) -> str:
-    # Унифицируем поля
-    order_id = order.get("order_id") or order.get("orderId") or order.get("id") or "—"
-    title = order.get("title") or "Заказ"
-    platform = order.get("platform") or "—"
-    service = order.get("service") or "—"
-    category_name = order.get("category_name") or order.get("categoryName") or order.get("category") or "—"
-    qty = order.get("quantity") or order.get("qty") or "—"
-    total = order.get("total_price") or order.get("total") or "0"
-    link = order.get("link") or order.get("target") or order.get("url") or ""
-    link_line = f"\nСсылка: <code>{link}</code>" if link else ""
+_outbox_wakeup: Optional[asyncio.Event] = None
+_outbox_in_flight = 0
+_outbox_stats: Dict[str, int] = {"sent": 0, "failed": 0, "dropped": 0, "given_up": 0, "digests": 0, "digest_events": 0}
 
-    return (
-        f"Заказ: <b>{title}</b>\n"
-        f"ID: <code>{order_id}</code>\n"
-        f"Платформа: <b>{platform}</b>\n"
-        f"Услуга: <b>{service}</b>\n"
-        f"Категория: <b>{category_name}</b>\n"
-        f"Кол-во: <b>{qty}</b>\n"
-        f"Сумма: <b>{total} ₽</b>"
-        f"{link_line}"
-    )
 
+def _outbox_notify() -> None:
+    if _outbox_wakeup is not None:
+        _outbox_wakeup.set()
 
-def _order_success_param(order: Dict[str, Any]) -> Dict[str, str]:
-    # То, что webapp покажет на экране успеха
-    payload = {
-        "order_id": order.get("order_id") or order.get("orderId") or order.get("id"),
-        "title": order.get("title"),
-        "platform": order.get("platform"),
-        "service": order.get("service"),
-        "category_name": order.get("category_name") or order.get("categoryName") or order.get("category"),
-        "quantity": order.get("quantity") or order.get("qty"),
-        "total_price": order.get("total_price") or order.get("total"),
+
+def _outbox_enqueue(
+    chat_id: Any,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    priority: int = SEND_PRIORITY_NOTIFY,
+    kind: str = _OUTBOX_KIND_MESSAGE,
+    delay_sec: int = 0,
+) -> None:
+    """
+    Stores a message in the outbox. Inside _db_transaction() the row is
+    committed together with the order/payment writes of the same block.
+    """
+    payload: Dict[str, Any] = {
+        "text": str(text),
+        "parse_mode": ParseMode.HTML.value,
+        "disable_web_page_preview": True,
     }
-    return {WEBAPP_SUCCESS_PARAM: _b64url_encode_json(payload)}
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.model_dump(mode="json", exclude_none=True)
+    payload_json = _json_dumps(payload)
+    chat = "" if chat_id is None else str(chat_id)
+    now = int(time.time()) + max(0, int(delay_sec))
+    if _DB_KIND == "mysql":
+        _db_exec(
+            "INSERT INTO notification_outbox (kind, chat_id, payload, priority, next_attempt_at) "
+            "VALUES (%s, %s, %s, %s, %s)",
+            (str(kind), chat, payload_json, int(priority), now),
+        )
+        _db_commit()
+    else:
+        with _db_lock:
+            _conn.execute(
+                "INSERT INTO notification_outbox (kind, chat_id, payload, priority, next_attempt_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (str(kind), chat, payload_json, int(priority), now),
+            )
+            _db_commit()
+    _on_commit(_outbox_notify, "outbox_notify")
 
 
-_ACCOUNTS_CATEGORIES = {"us_plus1", "ru_plus7", "ca_plus1", "in_plus95"}
-_ACCOUNTS_SERVICES = {"tg_accounts", "telegram_accounts"}
-_ACCOUNTS_ACTIONS = {"tg_account_order", "telegram_accounts_order", "tg_accounts"}
+def _outbox_claim(limit: int, kind: Optional[str] = None, due_until: Optional[int] = None) -> List[Dict[str, Any]]:
+    """
+    Leases up to `limit` due rows; a lease that is never released expires after OUTBOX_LEASE_SEC.
+    `kind` restricts the claim to one row kind, `due_until` also takes rows that become due
+    before that moment (used to pull the rest of a manager digest window).
+    """
+    now = int(time.time())
+    due = now if due_until is None else max(now, int(due_until))
+    lease_until = now + OUTBOX_LEASE_SEC
+    where = "next_attempt_at<=%s"
+    args: Tuple[Any, ...] = (due,)
+    if kind is not None:
+        where += " AND kind=%s"
+        args += (str(kind),)
+    if _DB_KIND != "mysql":
+        where = where.replace("%s", "?")
+    claimed: List[Dict[str, Any]] = []
+    with _db_transaction():
+        if _DB_KIND == "mysql":
+            rows = _db_fetchall(
+                "SELECT id, kind, chat_id, payload, priority, attempts FROM notification_outbox "
+                f"WHERE {where} ORDER BY priority, id LIMIT %s",
+                args + (int(limit),),
+            )
+        else:
+            rows = _conn.execute(
+                "SELECT id, kind, chat_id, payload, priority, attempts FROM notification_outbox "
+                f"WHERE {where} ORDER BY priority, id LIMIT ?",
+                args + (int(limit),),
+            ).fetchall()
+        for r in rows:
+            if _DB_KIND == "mysql":
+                changed = _db_exec(
+                    "UPDATE notification_outbox SET next_attempt_at=%s WHERE id=%s AND next_attempt_at<=%s",
+                    (lease_until, int(r[0]), due),
+                )
+            else:
+                changed = _conn.execute(
+                    "UPDATE notification_outbox SET next_attempt_at=? WHERE id=? AND next_attempt_at<=?",
+                    (lease_until, int(r[0]), due),
+                ).rowcount
+            if changed:
+                claimed.append(
+                    {
+                        "id": int(r[0]),
+                        "kind": str(r[1]),
+                        "chat_id": str(r[2] or ""),
+                        "payload": str(r[3]),
+                        "priority": int(r[4]),
+                        "attempts": int(r[5]),
+                    }
+                )
+    return claimed
 
 
-def _is_accounts_order_payload(order: Dict[str, Any]) -> bool:
-    if not isinstance(order, dict):
-        return False
-    svc = str(order.get("service") or order.get("service_name") or "").strip().lower()
-    action = str(order.get("action") or "").strip().lower()
-    category = str(
-        order.get("category")
-        or order.get("category_name")
-        or order.get("categoryName")
-        or ""
+def _outbox_delete(outbox_id: int) -> None:
+    if _DB_KIND == "mysql":
+        _db_exec("DELETE FROM notification_outbox WHERE id=%s", (int(outbox_id),))
+        _db_commit()
+        return
+    with _db_lock:
+        _conn.execute("DELETE FROM notification_outbox WHERE id=?", (int(outbox_id),))
+        _db_commit()
+
+
+def _outbox_retry_later(outbox_id: int, attempts: int) -> None:
+    """Reschedules the row with exponential backoff, or deletes it after OUTBOX_MAX_ATTEMPTS."""
+    if OUTBOX_MAX_ATTEMPTS > 0 and int(attempts) >= OUTBOX_MAX_ATTEMPTS:
+        # e.g. manager notices while no manager target is configured: don't let them pile up forever
+        _outbox_stats["given_up"] += 1
+        logger.error(f"Outbox message {outbox_id} given up after {attempts} attempts")
+        _outbox_delete(outbox_id)
+        return
+    delay = min(OUTBOX_MAX_BACKOFF_SEC, 2 ** min(int(attempts), 16))
+    next_at = int(time.time()) + int(delay)
+    if _DB_KIND == "mysql":
+        _db_exec(
+            "UPDATE notification_outbox SET attempts=%s, next_attempt_at=%s WHERE id=%s",
+            (int(attempts), next_at, int(outbox_id)),
+        )
+        _db_commit()
+        return
+    with _db_lock:
+        _conn.execute(
+            "UPDATE notification_outbox SET attempts=?, next_attempt_at=? WHERE id=?",
+            (int(attempts), next_at, int(outbox_id)),
+        )
+        _db_commit()
+
+
+def _outbox_pending_count() -> int:
+    if _DB_KIND == "mysql":
+        row = _db_fetchone("SELECT COUNT(*) FROM notification_outbox", ())
+    else:
+        with _db_lock:
+            row = _conn.execute("SELECT COUNT(*) FROM notification_outbox").fetchone()
+    return int(row[0]) if row else 0
+
+
+async def _outbox_deliver(item: Dict[str, Any]) -> None:
+    """Sends one outbox row; the row is deleted only after Telegram accepted it."""
+    try:
+        payload = _json_loads(item["payload"])
+    except Exception:
+        payload = {}
+    text = str(payload.get("text") or "")
+    if not text:
+        _outbox_delete(item["id"])
+        return
+    # Over the limit Telegram answers BadRequest and the row would be dropped
+    text = _truncate_html(text)
+
+    if item["kind"] == _OUTBOX_KIND_MANAGER:
+        chat_id = _resolve_manager_target()
+    else:
+        chat_id = item["chat_id"]
+        try:
+            chat_id = int(chat_id)
+        except Exception:
+            pass
+    attempts = int(item["attempts"]) + 1
+    if not chat_id:
+        logger.warning(f"Outbox message {item['id']}: no target chat yet, retry #{attempts} later")
+        _outbox_retry_later(item["id"], attempts)
+        return
+
+    reply_markup = None
+    if payload.get("reply_markup"):
+        reply_markup = InlineKeyboardMarkup.model_validate(payload["reply_markup"])
+    try:
+        with _send_priority_scope(item["priority"]):
+            await bot.send_message(
+                chat_id,
+                text,
+                parse_mode=payload.get("parse_mode") or ParseMode.HTML,
+                disable_web_page_preview=bool(payload.get("disable_web_page_preview", True)),
+                reply_markup=reply_markup,
+            )
+    except (TelegramForbiddenError, TelegramBadRequest) as e:
+        # Permanent: bot blocked, chat not found, bad markup...
+        _outbox_stats["dropped"] += 1
+        logger.error(f"Outbox message {item['id']} to {chat_id} dropped: {e}")
+        _outbox_delete(item["id"])
+        return
+    except Exception as e:
+        _outbox_stats["failed"] += 1
+        logger.warning(f"Outbox message {item['id']} to {chat_id} failed (attempt {attempts}): {e}")
+        _outbox_retry_later(item["id"], attempts)
+        return
+    _outbox_stats["sent"] += 1
+    _outbox_delete(item["id"])
+
+
+def _tg_len(text: str) -> int:
+    """Message length the way Telegram counts it (UTF-16 code units)."""
+    return len(text.encode("utf-16-le")) // 2
+
+
+_HTML_TOKEN_RE = re.compile(r"<[^<>]*>|&#?\w+;|[^<&]+|[<&]")
+
+
+def _truncate_html(text: str, limit: int = TG_MESSAGE_LIMIT) -> str:
+    """
+    Cuts Telegram-HTML text to `limit` UTF-16 units without splitting a tag or an entity;
+    tags left open are closed after the "…", so the result still parses.
+    """
+    if _tg_len(text) <= limit:
+        return text
+    out: List[str] = []
+    open_tags: List[str] = []
+    used = 0
+    for tok in _HTML_TOKEN_RE.findall(text):
+        room = limit - used - 1 - sum(len(t) + 3 for t in open_tags)  # "…" and the closing tags
+        tok_len = _tg_len(tok)
+        if tok.startswith("<") and tok.endswith(">"):
+            closing = tok.startswith("</")
+            name = tok.strip("</>").split(" ", 1)[0].lower()
+            if tok_len + (0 if closing else len(name) + 3) > room:
+                break
+            if closing:
+                if open_tags and open_tags[-1] == name:
+                    open_tags.pop()
+            else:
+                open_tags.append(name)
+        elif tok_len > room:
+            if not tok.startswith("&"):
+                cut = ""
+                for ch in tok:
+                    if _tg_len(cut + ch) > room:
+                        break
+                    cut += ch
+                out.append(cut)
+            break
+        out.append(tok)
+        used += tok_len
+    return "".join(out) + "…" + "".join(f"</{t}>" for t in reversed(open_tags))
+
+
+_DIGEST_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+_DIGEST_HEADER_RESERVE = 96  # header with "часть N/M" always fits into this
+_DIGEST_MAX_BUTTONS = 100  # Telegram rejects inline keyboards with more buttons
+
+
+def _digest_chunks(blocks: List[str], buttons: List[int]) -> List[List[int]]:
+    """
+    Greedily packs digest blocks (each already within the limit) into groups that fit one
+    Telegram message, with at most _DIGEST_MAX_BUTTONS buttons between them.
+    """
+    limit = TG_MESSAGE_LIMIT - _DIGEST_HEADER_RESERVE
+    sep_len = _tg_len(_DIGEST_SEPARATOR)
+    chunks: List[List[int]] = []
+    cur: List[int] = []
+    cur_len = 0
+    cur_buttons = 0
+    for idx, block in enumerate(blocks):
+        block_len = _tg_len(block)
+        if cur and (cur_len + sep_len + block_len > limit or cur_buttons + buttons[idx] > _DIGEST_MAX_BUTTONS):
+            chunks.append(cur)
+            cur, cur_len, cur_buttons = [], 0, 0
+        cur_len += block_len + (sep_len if cur else 0)
+        cur_buttons += buttons[idx]
+        cur.append(idx)
+    if cur:
+        chunks.append(cur)
+    return chunks
+
+
+async def _outbox_deliver_digest(items: List[Dict[str, Any]]) -> None:
+    """
+    Sends the manager events of one digest window as few messages as possible.
+    Buttons of every event (e.g. order confirmation) are kept, prefixed with the event number.
+    Rows are deleted per sent message, so a failure only retries the unsent part; a message
+    Telegram rejects (one event's bad markup...) is resent event by event, so only the
+    offending event is dropped.
+    """
+    entries: List[Tuple[Dict[str, Any], str, List[List[InlineKeyboardButton]]]] = []
+    for item in items:
+        try:
+            payload = _json_loads(item["payload"])
+        except Exception:
+            payload = {}
+        text = str(payload.get("text") or "")
+        if not text:
+            _outbox_delete(item["id"])
+            continue
+        rows: List[List[InlineKeyboardButton]] = []
+        if payload.get("reply_markup"):
+            rows = InlineKeyboardMarkup.model_validate(payload["reply_markup"]).inline_keyboard
+        entries.append((item, text, rows))
+    if not entries:
+        return
+    if len(entries) == 1:
+        await _outbox_deliver({**entries[0][0], "kind": _OUTBOX_KIND_MANAGER})
+        return
+
+    chat_id = _resolve_manager_target()
+    if not chat_id:
+        for item, _, _ in entries:
+            _outbox_retry_later(item["id"], int(item["attempts"]) + 1)
+        logger.warning(f"Manager digest ({len(entries)} events): no target chat yet, retry later")
+        return
+
+    # A single oversized event is cut to fit one message on its own
+    block_limit = TG_MESSAGE_LIMIT - _DIGEST_HEADER_RESERVE
+    blocks = [_truncate_html(f"<b>#{n}</b>\n{text}", block_limit) for n, (_, text, _) in enumerate(entries, start=1)]
+    chunks = _digest_chunks(blocks, [sum(len(row) for row in rows) for _, _, rows in entries])
+    for part, chunk in enumerate(chunks, start=1):
+        header = f"🗂 <b>Сводка событий</b> ({len(entries)})"
+        if len(chunks) > 1:
+            header += f" · часть {part}/{len(chunks)}"
+        text = header + "\n\n" + _DIGEST_SEPARATOR.join(blocks[i] for i in chunk)
+        keyboard: List[List[InlineKeyboardButton]] = []
+        for i in chunk:
+            for row in entries[i][2]:
+                keyboard.append([b.model_copy(update={"text": f"#{i + 1} · {b.text}"}) for b in row])
+        try:
+            with _send_priority_scope(SEND_PRIORITY_NOTIFY):
+                await bot.send_message(
+                    chat_id,
+                    text,
+                    parse_mode=ParseMode.HTML,
+                    disable_web_page_preview=True,
+                    reply_markup=InlineKeyboardMarkup(inline_keyboard=keyboard) if keyboard else None,
+                )
+        except TelegramBadRequest as e:
+            logger.warning(
+                f"Manager digest part {part}/{len(chunks)} to {chat_id} rejected, sending events one by one: {e}"
+            )
+            for i in chunk:
+                await _outbox_deliver({**entries[i][0], "kind": _OUTBOX_KIND_MANAGER})
+            continue
+        except TelegramForbiddenError as e:
+            _outbox_stats["dropped"] += len(chunk)
+            logger.error(f"Manager digest part {part}/{len(chunks)} to {chat_id} dropped: {e}")
+        except Exception as e:
+            _outbox_stats["failed"] += 1
+            logger.warning(f"Manager digest part {part}/{len(chunks)} to {chat_id} failed: {e}")
+            for rest in chunks[part - 1:]:
+                for i in rest:
+                    item = entries[i][0]
+                    _outbox_retry_later(item["id"], int(item["attempts"]) + 1)
+            return
+        else:
+            _outbox_stats["sent"] += 1
+            _outbox_stats["digests"] += 1
+            _outbox_stats["digest_events"] += len(chunk)
+        for i in chunk:
+            _outbox_delete(entries[i][0]["id"])
+
+
+async def outbox_dispatcher() -> None:
+    """Claims due outbox rows and delivers them with at most OUTBOX_WORKERS sends in flight."""
+    global _outbox_wakeup, _outbox_in_flight
+    _outbox_wakeup = asyncio.Event()
+    workers = max(1, OUTBOX_WORKERS)
+    running: set = set()
+
+    def _done(task: asyncio.Task) -> None:
+        global _outbox_in_flight
+        running.discard(task)
+        _outbox_in_flight = len(running)
+        if not task.cancelled() and task.exception():
+            logger.error(f"Outbox worker error: {task.exception()}")
+        _outbox_notify()
+
+    try:
+        while True:
+            _outbox_wakeup.clear()
+            free = workers - len(running)
+            if free > 0:
+                try:
+                    batch = _outbox_claim(free)
+                except Exception as e:
+                    logger.error(f"Outbox claim error: {e}")
+                    batch = []
+                claimed = len(batch)
+                digest = [item for item in batch if item["kind"] == _OUTBOX_KIND_MANAGER_DIGEST]
+                if digest:
+                    # The oldest event of the window is due: take the whole window in one message
+                    batch = [item for item in batch if item["kind"] != _OUTBOX_KIND_MANAGER_DIGEST]
+                    try:
+                        digest += _outbox_claim(
+                            500,
+                            kind=_OUTBOX_KIND_MANAGER_DIGEST,
+                            due_until=int(time.time()) + MANAGER_DIGEST_WINDOW_SEC,
+                        )
+                    except Exception as e:
+                        logger.error(f"Outbox digest claim error: {e}")
+                    task = asyncio.create_task(_outbox_deliver_digest(digest))
+                    running.add(task)
+                    task.add_done_callback(_done)
+                for item in batch:
+                    task = asyncio.create_task(_outbox_deliver(item))
+                    running.add(task)
+                    task.add_done_callback(_done)
+                _outbox_in_flight = len(running)
+                if claimed == free:
+                    # Possibly more due rows: claim again as soon as a worker frees up
+                    continue
+            try:
+                await asyncio.wait_for(_outbox_wakeup.wait(), timeout=OUTBOX_POLL_SEC)
+            except asyncio.TimeoutError:
+                pass
+    finally:
+        for task in list(running):
+            task.cancel()
+
+
+_register_metrics(
+    "outbox",
+    lambda: {**_outbox_stats, "in_flight": _outbox_in_flight, "pending": _outbox_pending_count()},
+)
+
+
+def _user_link(user_id: int, display: str = "пользователь") -> str:
+    return f"<a href=\"tg://user?id={int(user_id)}\">{display}</a>"
+
+
+def _order_text_block(order: Dict[str, Any]) -> str:
+    # Унифицируем поля
+    order_id = order.get("order_id") or order.get("orderId") or order.get("id") or "—"
+    title = order.get("title") or "Заказ"
+    platform = order.get("platform") or "—"
+    service = order.get("service") or "—"
+    category_name = order.get("category_name") or order.get("categoryName") or order.get("category") or "—"
+    qty = order.get("quantity") or order.get("qty") or "—"
+    total = order.get("total_price") or order.get("total") or "0"
+    link = order.get("link") or order.get("target") or order.get("url") or ""
+    link_line = f"\nСсылка: <code>{link}</code>" if link else ""
+
+    return (
+        f"Заказ: <b>{title}</b>\n"
+        f"ID: <code>{order_id}</code>\n"
+        f"Платформа: <b>{platform}</b>\n"
+        f"Услуга: <b>{service}</b>\n"
+        f"Категория: <b>{category_name}</b>\n"
+        f"Кол-во: <b>{qty}</b>\n"
+        f"Сумма: <b>{total} ₽</b>"
+        f"{link_line}"
+    )
+
+
+def _order_success_param(order: Dict[str, Any]) -> Dict[str, str]:
+    # То, что webapp покажет на экране успеха
+    payload = {
+        "order_id": order.get("order_id") or order.get("orderId") or order.get("id"),
+        "title": order.get("title"),
+        "platform": order.get("platform"),
+        "service": order.get("service"),
+        "category_name": order.get("category_name") or order.get("categoryName") or order.get("category"),
+        "quantity": order.get("quantity") or order.get("qty"),
+        "total_price": order.get("total_price") or order.get("total"),
+    }
+    return {WEBAPP_SUCCESS_PARAM: _b64url_encode_json(payload)}
+
+
+_ACCOUNTS_CATEGORIES = {"us_plus1", "ru_plus7", "ca_plus1", "in_plus95"}
+_ACCOUNTS_SERVICES = {"tg_accounts", "telegram_accounts"}
+_ACCOUNTS_ACTIONS = {"tg_account_order", "telegram_accounts_order", "tg_accounts"}
+
+
+def _is_accounts_order_payload(order: Dict[str, Any]) -> bool:
+    if not isinstance(order, dict):
+        return False
+    svc = str(order.get("service") or order.get("service_name") or "").strip().lower()
+    action = str(order.get("action") or "").strip().lower()
+    category = str(
+        order.get("category")
+        or order.get("category_name")
+        or order.get("categoryName")
+        or ""
     ).strip().lower()
     if svc in _ACCOUNTS_SERVICES:
         return True
@@ -1437,6 +2955,11 @@ def _is_accounts_order_payload(order: Dict[str, Any]) -> bool:
     return False
 
 
+def _order_event_apis(order: Dict[str, Any]) -> Tuple[str, ...]:
+    """SSE streams an order event goes to: the main WebApp lists every order, the accounts one only its own."""
+    return ("main", "accounts") if _is_accounts_order_payload(order) else ("main",)
+
+
 def _force_accounts_order_fields(order: Dict[str, Any]) -> Dict[str, Any]:
     """Ensure accounts order has consistent fields for API filtering and display."""
     if not isinstance(order, dict):
@@ -1452,95 +2975,86 @@ def _force_accounts_order_fields(order: Dict[str, Any]) -> Dict[str, Any]:
     return out
 
 async def _finalize_pending_order_if_possible(user_id: int, source: str) -> bool:
-    pending = _get_pending_order(user_id)
-    if not pending:
-        return False
-
-    order = pending["order"] if isinstance(pending.get("order"), dict) else {}
-    order_id = str(pending.get("order_id") or order.get("order_id") or order.get("orderId") or "")
-    amount_need = int(pending.get("amount_kopecks") or 0)
+    async with _balance_lock(user_id):
+        pending = _get_pending_order(user_id)
+        if not pending:
+            return False
 
-    # Apply discount for special user if not already applied in payload
-    if _is_discount_user(user_id) and not bool(order.get("discount_applied")):
-        amount_need = _apply_discount_kopecks(user_id, amount_need, discount_applied=False)
-        order["discount_applied"] = True
-        order["total_price"] = _kopecks_to_rub_str(amount_need)
-        if order_id:
-            try:
-                _set_pending_order(user_id, order_id, amount_need, json.dumps(order, ensure_ascii=False))
-            except Exception:
-                pass
+        order = pending["order"] if isinstance(pending.get("order"), dict) else {}
+        order_id = str(pending.get("order_id") or order.get("order_id") or order.get("orderId") or "")
+        amount_need = int(pending.get("amount_kopecks") or 0)
 
-    # Если вдруг уже обработан — очищаем pending
-    if order_id and _is_order_processed(order_id):
-        _clear_pending_order(user_id)
-        return True
+        # Apply discount for special user if not already applied in payload
+        if _is_discount_user(user_id) and not bool(order.get("discount_applied")):
+            amount_need = _apply_discount_kopecks(user_id, amount_need, discount_applied=False)
+            order["discount_applied"] = True
+            order["total_price"] = _kopecks_to_rub_str(amount_need)
+            if order_id:
+                try:
+                    _set_pending_order(user_id, order_id, amount_need, _json_dumps(order))
+                except Exception:
+                    pass
 
-    ok, before, after = _try_debit_balance_kopecks(user_id, amount_need)
-    if not ok:
-        need_more = max(0, amount_need - before)
-        need_rub = int((need_more + 99) // 100)
-        txt = (
-            "ℹ️ <b>Баланс пополнен</b>, но для покупки всё ещё не хватает средств.\n\n"
-            f"Не хватает: <b>{need_rub} ₽</b>\n"
-            f"Текущий баланс: <b>{_format_rub_from_kopecks(before)}</b>\n\n"
-            "Пополните ещё раз — заказ будет оформлен автоматически."
-        )
+        final_order_id = order_id or f"auto-{uuid.uuid4().hex}"
+        order["order_id"] = final_order_id
         try:
-            await bot.send_message(user_id, txt, parse_mode=ParseMode.HTML, reply_markup=topup_amounts_kb(need_rub))
+            order_json = _json_dumps(order)
         except Exception:
-            pass
-        return False
-
-    # Успешно списали -> фиксируем
-    _clear_pending_order(user_id)
-    try:
-        order_json = json.dumps(order, ensure_ascii=False)
-    except Exception:
-        order_json = "{}"
-    final_order_id = order_id or f"auto-{uuid.uuid4().hex}"
-    _mark_order_processed(final_order_id, user_id, amount_need, order_json)
-
-    # История заказов (WebApp «Профиль»)
-    try:
-        order["order_id"] = final_order_id
-        _create_order(user_id, order, amount_need)
-    except Exception as e:
-        logger.warning(f"Failed to store order in history (auto-finalize): {e}")
+            order_json = "{}"
 
-    try:
-        await _apply_referral_reward(user_id, final_order_id, amount_need)
-    except Exception:
-        pass
+        # Списание и фиксация (заказ + уведомления) в одной транзакции
+        with _db_transaction():
+            status, before, after = _pay_order_from_balance(user_id, final_order_id, amount_need, order_json)
+            if status == "duplicate":
+                # Если вдруг уже обработан — очищаем pending
+                _clear_pending_order(user_id)
+            elif status == "paid":
+                text_user = (
+                    "✅ <b>Покупка оплачена!</b>\n\n"
+                    f"{_order_text_block(order)}\n\n"
+                    f"Списано: <b>{_format_rub_from_kopecks(amount_need)}</b>\n"
+                    f"Баланс: <b>{_format_rub_from_kopecks(after)}</b>\n\n"
+                    f"Источник: <b>{source}</b>\n"
+                    "Откройте приложение — увидите экран «успешная покупка»."
+                )
+                text_mgr = (
+                    "🧾 <b>Новый оплаченный заказ</b>\n\n"
+                    f"Покупатель: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
+                    f"Оплата: <b>{source}</b>\n\n"
+                    f"{_order_text_block(order)}"
+                )
+                _clear_pending_order(user_id)
 
-    # Пользователь
-    text_user = (
-        "✅ <b>Покупка оплачена!</b>\n\n"
-        f"{_order_text_block(order)}\n\n"
-        f"Списано: <b>{_format_rub_from_kopecks(amount_need)}</b>\n"
-        f"Баланс: <b>{_format_rub_from_kopecks(after)}</b>\n\n"
-        f"Источник: <b>{source}</b>\n"
-        "Откройте приложение — увидите экран «успешная покупка»."
-    )
-    try:
-        await bot.send_message(
-            user_id,
-            text_user,
-            parse_mode=ParseMode.HTML,
-            reply_markup=open_webapp_kb(user_id, success_order=order),
-        )
-    except Exception:
-        pass
+                # История заказов (WebApp «Профиль»)
+                try:
+                    _create_order(user_id, order, amount_need)
+                except Exception as e:
+                    logger.warning(f"Failed to store order in history (auto-finalize): {e}")
 
-    # Менеджер
-    text_mgr = (
-        "🧾 <b>Новый оплаченный заказ</b>\n\n"
-        f"Покупатель: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
-        f"Оплата: <b>{source}</b>\n\n"
-        f"{_order_text_block(order)}"
-    )
-    _notify_manager_bg(text_mgr, reply_markup=_mgr_confirm_kb(final_order_id))
-    return True
+                _outbox_enqueue(
+                    user_id,
+                    text_user,
+                    reply_markup=open_webapp_kb(user_id, success_order=order),
+                    priority=SEND_PRIORITY_PAYMENT,
+                )
+                _notify_manager_bg(text_mgr, reply_markup=_mgr_confirm_kb(final_order_id))
+                _apply_referral_reward(user_id, final_order_id, amount_need)
+
+        if status == "insufficient":
+            need_more = max(0, amount_need - before)
+            need_rub = int((need_more + 99) // 100)
+            txt = (
+                "ℹ️ <b>Баланс пополнен</b>, но для покупки всё ещё не хватает средств.\n\n"
+                f"Не хватает: <b>{need_rub} ₽</b>\n"
+                f"Текущий баланс: <b>{_format_rub_from_kopecks(before)}</b>\n\n"
+                "Пополните ещё раз — заказ будет оформлен автоматически."
+            )
+            try:
+                await bot.send_message(user_id, txt, parse_mode=ParseMode.HTML, reply_markup=topup_amounts_kb(need_rub))
+            except Exception:
+                pass
+            return False
+        return True
 
 
 async def _process_paid_crypto_invoice(invoice_id: int) -> None:
@@ -1548,33 +3062,33 @@ async def _process_paid_crypto_invoice(invoice_id: int) -> None:
     if not meta:
         return
 
-    if not _mark_crypto_paid_if_first(invoice_id):
-        return
-
     user_id = meta["user_id"]
     amount_kopecks = meta["amount_kopecks"]
-    new_bal = _add_balance_kopecks(user_id, amount_kopecks)
 
-    # Попытаемся автоматически завершить ожидающую покупку
-    await _finalize_pending_order_if_possible(user_id, source="Крипто")
+    # Статус счёта, зачисление и уведомления — одной транзакцией
+    with _db_transaction():
+        if not _mark_crypto_paid_if_first(invoice_id):
+            return
+        new_bal = _add_balance_kopecks(user_id, amount_kopecks)
 
-    text = (
-        "✅ <b>Крипто-оплата получена!</b>\n\n"
-        f"Сумма: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>\n"
-        f"Текущий баланс: <b>{_format_rub_from_kopecks(new_bal)}</b>\n\n"
-        "Откройте приложение — баланс обновится."
-    )
-    try:
-        await bot.send_message(user_id, text, reply_markup=open_webapp_kb(user_id), parse_mode=ParseMode.HTML)
-    except Exception as e:
-        logger.error(f"Failed to notify user about crypto payment: {e}")
+        text = (
+            "✅ <b>Крипто-оплата получена!</b>\n\n"
+            f"Сумма: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>\n"
+            f"Текущий баланс: <b>{_format_rub_from_kopecks(new_bal)}</b>\n\n"
+            "Откройте приложение — баланс обновится."
+        )
+        _outbox_enqueue(user_id, text, reply_markup=open_webapp_kb(user_id), priority=SEND_PRIORITY_PAYMENT)
+
+        # Нотификация менеджеру (о факте оплаты)
+        _notify_manager_bg(
+            "🪙 <b>Пополнение криптой</b>\n\n"
+            f"Пользователь: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
+            f"Сумма: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>",
+            urgent=True,
+        )
 
-    # Нотификация менеджеру (о факте оплаты)
-    _notify_manager_bg(
-        "🪙 <b>Пополнение криптой</b>\n\n"
-        f"Пользователь: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
-        f"Сумма: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>"
-    )
+    # Попытаемся автоматически завершить ожидающую покупку
+    await _finalize_pending_order_if_possible(user_id, source="Крипто")
 
 
 async def crypto_invoices_watcher() -> None:
@@ -1603,6 +3117,91 @@ async def crypto_invoices_watcher() -> None:
             logger.error(f"Crypto watcher error: {e}")
 
 
+# =========================
+# MEDIA CACHE (Telegram file_id by content hash)
+# =========================
+_MEDIA_SETTING_PREFIX = "media_file_id:"
+_MEDIA_UNIQUE_SETTING_PREFIX = "media_file_uid:"
+
+_media_digests: Dict[str, Tuple[int, int, str]] = {}  # path -> (mtime_ns, size, sha256)
+_media_file_ids: Dict[str, str] = {}  # sha256 -> file_id (mirror of the settings table)
+# sha256 -> file_unique_id: file_id differs between sends of the same file, this one doesn't
+_media_unique_ids: Dict[str, str] = {}
+_media_stats: Dict[str, int] = {"hits": 0, "uploads": 0, "stale": 0, "failed": 0}
+
+
+def _media_digest(path: str) -> Optional[str]:
+    """sha256 of the file; re-hashed only when mtime/size change."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    cached = _media_digests.get(path)
+    if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+        return cached[2]
+    h = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(65536), b""):
+                h.update(chunk)
+    except OSError:
+        return None
+    digest = h.hexdigest()
+    _media_digests[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def _media_file_id(digest: str) -> Optional[str]:
+    file_id = _media_file_ids.get(digest)
+    if file_id is None:
+        file_id = _get_setting(_MEDIA_SETTING_PREFIX + digest)
+        if file_id:
+            _media_file_ids[digest] = file_id
+    return file_id
+
+
+def _media_unique_id(digest: str) -> Optional[str]:
+    unique_id = _media_unique_ids.get(digest)
+    if unique_id is None:
+        unique_id = _get_setting(_MEDIA_UNIQUE_SETTING_PREFIX + digest)
+        if unique_id:
+            _media_unique_ids[digest] = unique_id
+    return unique_id
+
+
+def _is_stale_file_id_error(e: TelegramBadRequest) -> bool:
+    """BadRequest caused by the file_id itself (as opposed to caption, markup, chat...)."""
+    msg = str(getattr(e, "message", "") or e).lower()
+    return any(s in msg for s in ("wrong file identifier", "file_id", "wrong remote file", "file reference"))
+
+
+def _media_remember(digest: str, message: Optional[types.Message]) -> None:
+    if message is None or not message.photo:
+        return
+    file_id = message.photo[-1].file_id
+    unique_id = message.photo[-1].file_unique_id
+    _media_file_ids[digest] = file_id
+    _media_unique_ids[digest] = unique_id
+    try:
+        _set_setting(_MEDIA_SETTING_PREFIX + digest, file_id)
+        _set_setting(_MEDIA_UNIQUE_SETTING_PREFIX + digest, unique_id)
+    except Exception as e:
+        logger.warning(f"Media cache persist error: {e}")
+
+
+def _media_forget(digest: str) -> None:
+    _media_file_ids.pop(digest, None)
+    _media_unique_ids.pop(digest, None)
+    try:
+        _set_setting(_MEDIA_SETTING_PREFIX + digest, "")
+        _set_setting(_MEDIA_UNIQUE_SETTING_PREFIX + digest, "")
+    except Exception as e:
+        logger.warning(f"Media cache reset error: {e}")
+
+
+_register_metrics("media_cache", lambda: {**_media_stats, "cached_files": len(_media_file_ids)})
+
+
 # =========================
 # UI BUILDERS
 # =========================
@@ -1614,23 +3213,136 @@ async def _send_photo_or_text(
     parse_mode: Optional[str] = ParseMode.HTML,
     disable_web_page_preview: bool = True,
 ) -> None:
+    async def _send_text_fallback() -> None:
+        await bot.send_message(
+            chat_id,
+            text,
+            reply_markup=reply_markup,
+            parse_mode=parse_mode,
+            disable_web_page_preview=disable_web_page_preview,
+        )
+
+    digest = _media_digest(photo_path)
+    file_id = _media_file_id(digest) if digest else None
+    if file_id:
+        try:
+            await bot.send_photo(
+                chat_id=chat_id,
+                photo=file_id,
+                caption=text,
+                reply_markup=reply_markup,
+                parse_mode=parse_mode,
+            )
+            _media_stats["hits"] += 1
+            return
+        except TelegramBadRequest as e:
+            if not _is_stale_file_id_error(e):
+                # Caption / markup problem, not the picture: a re-upload would fail the same way
+                logger.error(f"Photo send error ({photo_path}): {e}")
+                await _send_text_fallback()
+                return
+            # file_id no longer accepted (other bot token, file expired...): upload again
+            _media_stats["stale"] += 1
+            logger.warning(f"Cached file_id rejected ({photo_path}): {e}")
+            _media_forget(digest)
+        except Exception as e:
+            # Timeout, connection error, RetryAfter retries used up: the screen must still reach
+            # the user, so drop the file_id (it may be what failed) and upload like an uncached one
+            _media_stats["failed"] += 1
+            logger.warning(f"Photo send by file_id failed ({photo_path}), uploading instead: {e}")
+            _media_forget(digest)
     try:
-        await bot.send_photo(
+        sent = await bot.send_photo(
             chat_id=chat_id,
             photo=types.FSInputFile(photo_path),
             caption=text,
             reply_markup=reply_markup,
             parse_mode=parse_mode,
         )
+        _media_stats["uploads"] += 1
+        if digest:
+            _media_remember(digest, sent)
     except Exception as e:
         logger.error(f"Photo send error ({photo_path}): {e}")
-        await bot.send_message(
-            chat_id,
-            text,
-            reply_markup=reply_markup,
+        await _send_text_fallback()
+
+_screen_stats: Dict[str, int] = {"caption_edits": 0, "media_edits": 0, "not_modified": 0, "sent": 0}
+_register_metrics("screens", lambda: dict(_screen_stats))
+
+
+async def _edit_screen(
+    message: types.Message,
+    photo_path: str,
+    text: str,
+    reply_markup: Optional[InlineKeyboardMarkup],
+    parse_mode: Optional[str],
+) -> None:
+    digest = _media_digest(photo_path)
+    file_id = _media_file_id(digest) if digest else None
+    unique_id = _media_unique_id(digest) if digest else None
+    if unique_id and message.photo and message.photo[-1].file_unique_id == unique_id:
+        # Same picture already shown: only caption and buttons change
+        await bot.edit_message_caption(
+            chat_id=message.chat.id,
+            message_id=message.message_id,
+            caption=text,
             parse_mode=parse_mode,
-            disable_web_page_preview=disable_web_page_preview,
+            reply_markup=reply_markup,
         )
+        _screen_stats["caption_edits"] += 1
+        return
+    edited = await bot.edit_message_media(
+        chat_id=message.chat.id,
+        message_id=message.message_id,
+        media=types.InputMediaPhoto(
+            media=file_id or types.FSInputFile(photo_path),
+            caption=text,
+            parse_mode=parse_mode,
+        ),
+        reply_markup=reply_markup,
+    )
+    _screen_stats["media_edits"] += 1
+    if digest and not (file_id and unique_id) and isinstance(edited, types.Message):
+        _media_remember(digest, edited)
+
+
+async def _render_screen(
+    chat_id: int,
+    photo_path: str,
+    text: str,
+    reply_markup: Optional[Any] = None,
+    parse_mode: Optional[str] = ParseMode.HTML,
+    disable_web_page_preview: bool = True,
+    edit_message: Optional[Any] = None,
+) -> None:
+    """
+    Shows a photo menu screen. When `edit_message` is the bot's photo menu the callback came from,
+    that message is edited in place; otherwise (text message, reply keyboard, edit refused) a new one is sent.
+    """
+    if (
+        isinstance(edit_message, types.Message)
+        and edit_message.photo
+        and (reply_markup is None or isinstance(reply_markup, InlineKeyboardMarkup))
+    ):
+        try:
+            await _edit_screen(edit_message, photo_path, text, reply_markup, parse_mode)
+            return
+        except TelegramBadRequest as e:
+            if "message is not modified" in str(e):
+                _screen_stats["not_modified"] += 1
+                return
+            logger.info(f"Screen edit failed, sending new message ({photo_path}): {e}")
+        except Exception as e:
+            logger.warning(f"Screen edit error ({photo_path}): {e}")
+    _screen_stats["sent"] += 1
+    await _send_photo_or_text(
+        chat_id=chat_id,
+        photo_path=photo_path,
+        text=text,
+        reply_markup=reply_markup,
+        parse_mode=parse_mode,
+        disable_web_page_preview=disable_web_page_preview,
+    )
 
 async def _get_bot_username() -> Optional[str]:
     global _BOT_USERNAME_CACHE
@@ -1654,74 +3366,154 @@ async def _build_ref_link(user_id: int) -> Optional[str]:
     return f"https://t.me/{username}?start=ref_{int(user_id)}"
 
 
-async def _apply_referral_reward(user_id: int, order_id: str, amount_kopecks: int) -> None:
+def _apply_referral_reward(user_id: int, order_id: str, amount_kopecks: int) -> None:
+    """Credits the referrer once per order; the reward and both notices share one transaction."""
     referrer_id = _get_referrer(user_id)
     if not referrer_id or int(referrer_id) == int(user_id):
         return
     reward = _calc_referral_reward(amount_kopecks)
     if reward <= 0:
         return
-    created = _record_referral_reward(order_id, referrer_id, user_id, amount_kopecks, reward)
-    if not created:
-        return
-    _add_ref_balance(referrer_id, reward)
-
-    ref_text = (
-        "🎉 <b>Новый доход по партнёрке</b>\n\n"
-        f"Клиент: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
-        f"Сумма покупки: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>\n"
-        f"Ваш доход (40%): <b>{_format_rub_from_kopecks(reward)}</b>\n"
-        f"Заказ: <code>{order_id}</code>"
-    )
-    try:
-        await bot.send_message(int(referrer_id), ref_text, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-    except Exception:
-        pass
+    with _db_transaction():
+        created = _record_referral_reward(order_id, referrer_id, user_id, amount_kopecks, reward)
+        if not created:
+            return
+        _add_ref_balance(referrer_id, reward)
+
+        ref_text = (
+            "🎉 <b>Новый доход по партнёрке</b>\n\n"
+            f"Клиент: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
+            f"Сумма покупки: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>\n"
+            f"Ваш доход (40%): <b>{_format_rub_from_kopecks(reward)}</b>\n"
+            f"Заказ: <code>{order_id}</code>"
+        )
+        _outbox_enqueue(int(referrer_id), ref_text, priority=SEND_PRIORITY_NOTIFY)
+
+        _notify_manager_bg(
+            "🤝 <b>Партнёрская программа</b>\n\n"
+            f"Реферер: {_user_link(referrer_id, 'профиль')} (ID <code>{referrer_id}</code>)\n"
+            f"Клиент: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
+            f"Сумма покупки: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>\n"
+            f"Начисление 40%: <b>{_format_rub_from_kopecks(reward)}</b>\n"
+            f"Заказ: <code>{order_id}</code>"
+        )
 
-    _notify_manager_bg(
-        "🤝 <b>Партнёрская программа</b>\n\n"
-        f"Реферер: {_user_link(referrer_id, 'профиль')} (ID <code>{referrer_id}</code>)\n"
-        f"Клиент: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
-        f"Сумма покупки: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>\n"
-        f"Начисление 40%: <b>{_format_rub_from_kopecks(reward)}</b>\n"
-        f"Заказ: <code>{order_id}</code>"
-    )
 
+# =========================
+# STATIC SCREENS
+# =========================
+# Telegram objects are immutable, so markups that don't depend on the user are built once
+# and shared; per-amount variants go through a bounded lru_cache.
+_KB_CACHE_SIZE = 256
 
-def main_reply_kb(user_id: int) -> ReplyKeyboardMarkup:
-    return ReplyKeyboardMarkup(
-        keyboard=[
-            [
-                KeyboardButton(text="🚀 Накрутка и аккаунты"),
-                KeyboardButton(text="➕ Пополнить баланс 💳"),
-            ],
-            [
-                KeyboardButton(text="🤝 Партнерская программа"),
-                KeyboardButton(text="🆘 Поддержка"),
-                KeyboardButton(text="📜 Правила"),
-            ],
+_MAIN_REPLY_KB = ReplyKeyboardMarkup(
+    keyboard=[
+        [
+            KeyboardButton(text="🚀 Накрутка и аккаунты"),
+            KeyboardButton(text="➕ Пополнить баланс 💳"),
         ],
-        resize_keyboard=True,
-    )
+        [
+            KeyboardButton(text="🤝 Партнерская программа"),
+            KeyboardButton(text="🆘 Поддержка"),
+            KeyboardButton(text="📜 Правила"),
+        ],
+    ],
+    resize_keyboard=True,
+)
+
+_POLICY_URL = "https://telegra.ph/Politika-ispolzovaniya-01-31"
+
+_SUPPORT_TEXT = (
+    "🆘 <b>Поддержка</b>\n\n"
+    "Напишите менеджеру, он поможет с любыми вопросами:\n"
+    f"@{MANAGER_USERNAME}"
+)
+_SUPPORT_KB = InlineKeyboardMarkup(
+    inline_keyboard=[[InlineKeyboardButton(text="💬 Написать в поддержку", url=f"https://t.me/{MANAGER_USERNAME}")]]
+)
+
+_RULES_TEXT = (
+    "📜 <b>Правила и соглашения</b>\n\n"
+    "Уважаемый пользователь! Ознакомьтесь с нашими правилами и соглашениями магазина.\n\n"
+    "✅ <b>Boost Shop гарантирует:</b>\n"
+    "• Работоспособность аккаунтов в течение 48 часов при АКТИВНОЙ гарантии.\n"
+    "• Продажу аккаунтов только в «одни руки».\n"
+    "• Замену аккаунтов при их невалидности по вине поставщика при АКТИВНОЙ гарантии.\n"
+    "• Возврат средств, если аккаунт заменить невозможно. Возврат осуществляется только на платежные системы:\n"
+    "◦ CryptoBot\n\n"
+    "⏳ Время выдачи товара в нашем магазине — до 24 часов.\n"
+    "⚠️ Обмен или возврат товара, если он вам не подошел или не устроил, невозможен.\n\n"
+    "📋 <b>Общие правила:</b>\n"
+    "• Мы не раздаем товары бесплатно.\n"
+    "• Администрация сервиса оставляет за собой право отказать в обслуживании и поддержке клиенту без объяснения причин.\n"
+    "• Сервис не несет ответственности за ваши действия.\n"
+    "• Совершая покупку, вы автоматически соглашаетесь со всеми правилами сервиса.\n\n"
+    "<b>Обратите внимание:</b>\n"
+    "Наши прокси не гарантируют доступ к ресурсам: Банки, Госуслуги, Авито."
+)
+_RULES_KB = InlineKeyboardMarkup(
+    inline_keyboard=[[InlineKeyboardButton(text="🔐 Политика использования", url=_POLICY_URL)]]
+)
+_POLICY_KB = InlineKeyboardMarkup(
+    inline_keyboard=[[InlineKeyboardButton(text="🔐 Открыть политику", url=_POLICY_URL)]]
+)
+
+_PARTNER_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [InlineKeyboardButton(text="💡 Советы", callback_data="ref_tips")],
+        [InlineKeyboardButton(text="📋 Скопировать ссылку", callback_data="ref_copy")],
+        [InlineKeyboardButton(text="💸 Вывести", callback_data="ref_withdraw")],
+    ]
+)
+_REF_TIPS_TEXT = (
+    "💡 <b>Советы для партнёров</b>\n\n"
+    "Мы собрали лучшие советы для начинающих партнёров, очень рекомендуем с ними ознакомиться."
+)
+_REF_TIPS_KB = InlineKeyboardMarkup(
+    inline_keyboard=[
+        [
+            InlineKeyboardButton(
+                text="📘 Открыть советы",
+                url="https://telegra.ph/TOP-sposobov-privlekat-klientov-02-07",
+            )
+        ],
+        [InlineKeyboardButton(text="◀️ Назад", callback_data="ref_tips_back")],
+    ]
+)
+_REF_WITHDRAW_KB = InlineKeyboardMarkup(
+    inline_keyboard=[[InlineKeyboardButton(text="◀️ Назад", callback_data="ref_back")]]
+)
+_CANCEL_TO_MAIN_KB = InlineKeyboardMarkup(
+    inline_keyboard=[[InlineKeyboardButton(text="Отмена", callback_data="back_main")]]
+)
+_BACK_TO_MAIN_KB = InlineKeyboardMarkup(
+    inline_keyboard=[[InlineKeyboardButton(text="◀️ Назад", callback_data="back_main")]]
+)
+
+
+def main_reply_kb(user_id: int) -> ReplyKeyboardMarkup:
+    return _MAIN_REPLY_KB
+
+
+_TOPUP_ROW = [InlineKeyboardButton(text="➕ Пополнить баланс 💳", callback_data="balance_topup")]
+_ACCOUNTS_BOT_BTN = (
+    InlineKeyboardButton(text="📱 Telegram аккаунты", url=f"https://t.me/{ACCOUNTS_BOT_USERNAME}")
+    if ACCOUNTS_BOT_USERNAME
+    else None
+)
+
 
 def main_menu_kb(user_id: int) -> InlineKeyboardMarkup:
-    webapp_url = _webapp_url_for_user(user_id)
-    accounts_url = _webapp_accounts_url_for_user(user_id)
-    if ACCOUNTS_BOT_USERNAME:
-        accounts_btn = InlineKeyboardButton(
-            text="📱 Telegram аккаунты",
-            url=f"https://t.me/{ACCOUNTS_BOT_USERNAME}",
-        )
-    else:
-        accounts_btn = InlineKeyboardButton(
-            text="📱 Telegram аккаунты",
-            web_app=WebAppInfo(url=accounts_url),
-        )
+    # WebApp URLs carry the current balance, so only those buttons are built per call
+    accounts_btn = _ACCOUNTS_BOT_BTN or InlineKeyboardButton(
+        text="📱 Telegram аккаунты",
+        web_app=WebAppInfo(url=_webapp_accounts_url_for_user(user_id)),
+    )
     return InlineKeyboardMarkup(
         inline_keyboard=[
-            [InlineKeyboardButton(text="📈 Накрутка", web_app=WebAppInfo(url=webapp_url))],
+            [InlineKeyboardButton(text="📈 Накрутка", web_app=WebAppInfo(url=_webapp_url_for_user(user_id)))],
             [accounts_btn],
-            [InlineKeyboardButton(text="➕ Пополнить баланс 💳", callback_data="balance_topup")],
+            _TOPUP_ROW,
         ]
     )
 
@@ -1737,8 +3529,11 @@ def open_webapp_kb(user_id: int, success_order: Optional[Dict[str, Any]] = None)
 
 
 def topup_amounts_kb(need_rub: int = 0) -> InlineKeyboardMarkup:
-    need = int(need_rub or 0)
+    return _topup_amounts_kb(int(need_rub or 0))
+
 
+@lru_cache(maxsize=_KB_CACHE_SIZE)
+def _topup_amounts_kb(need: int) -> InlineKeyboardMarkup:
     rows = []
     if need > 0:
         rows.append(
@@ -1767,7 +3562,11 @@ def topup_amounts_kb(need_rub: int = 0) -> InlineKeyboardMarkup:
 
 
 def crypto_amounts_kb(need_rub: int = 0) -> InlineKeyboardMarkup:
-    need = int(need_rub or 0)
+    return _crypto_amounts_kb(int(need_rub or 0))
+
+
+@lru_cache(maxsize=_KB_CACHE_SIZE)
+def _crypto_amounts_kb(need: int) -> InlineKeyboardMarkup:
     row0 = []
     if need > 0:
         row0 = [InlineKeyboardButton(text=f"Рекомендовано: {need} ₽", callback_data=f"crypto_amount_{need}")]
@@ -1791,7 +3590,23 @@ def crypto_amounts_kb(need_rub: int = 0) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup(inline_keyboard=rows)
 
 
-async def show_topup_amounts(chat_id: int, user_id: int, need_rub: int = 0) -> None:
+@lru_cache(maxsize=_KB_CACHE_SIZE)
+def topup_methods_kb(need: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(
+        inline_keyboard=[
+            [InlineKeyboardButton(text=f"💳 Картой / ЮKassa — {need} ₽", callback_data=f"topup_amount_{need}")],
+            [InlineKeyboardButton(text=f"🪙 Криптой — {need} ₽", callback_data=f"crypto_amount_{need}")],
+            [InlineKeyboardButton(text="◀️ Назад", callback_data=f"back_topup_{need}")],
+        ]
+    )
+
+
+async def show_topup_amounts(
+    chat_id: int,
+    user_id: int,
+    need_rub: int = 0,
+    edit_message: Optional[types.Message] = None,
+) -> None:
     bal = _get_balance_kopecks(user_id)
     need = int(need_rub or 0)
 
@@ -1806,16 +3621,22 @@ async def show_topup_amounts(chat_id: int, user_id: int, need_rub: int = 0) -> N
         f"{need_line}\n\n"
         "Выберите сумму пополнения:"
     )
-    await _send_photo_or_text(
+    await _render_screen(
         chat_id=chat_id,
         photo_path=PHOTO_TOPUP_MENU,
         text=text,
         reply_markup=topup_amounts_kb(need_rub=need),
         parse_mode=ParseMode.HTML,
+        edit_message=edit_message,
     )
 
 
-async def send_welcome(chat_id: int, user_id: int, include_greeting: bool = True) -> None:
+async def send_welcome(
+    chat_id: int,
+    user_id: int,
+    include_greeting: bool = True,
+    edit_message: Optional[types.Message] = None,
+) -> None:
     bal = _format_rub_from_kopecks(_get_balance_kopecks(user_id))
     greeting = (
         "👋 <b>Здравствуйте!</b>\n\n"
@@ -1828,12 +3649,14 @@ async def send_welcome(chat_id: int, user_id: int, include_greeting: bool = True
         "Чтобы продолжить, нажмите на «🚀 Накрутка и аккаунты»."
     )
 
-    await _send_photo_or_text(
+    await _render_screen(
         chat_id=chat_id,
         photo_path=WELCOME_PHOTO,
         text=welcome_text,
-        reply_markup=main_reply_kb(user_id),
+        # A reply keyboard can't be attached to an edited message; the one sent with /start stays on screen
+        reply_markup=None if edit_message is not None else main_reply_kb(user_id),
         parse_mode=ParseMode.HTML,
+        edit_message=edit_message,
     )
 
 
@@ -1857,16 +3680,13 @@ async def send_quick_menu(chat_id: int, user_id: int) -> None:
     )
 
 
-async def _notify_new_referral(referrer_id: int, referred_id: int) -> None:
+def _notify_new_referral(referrer_id: int, referred_id: int) -> None:
     text_ref = (
         "✅ <b>Новый реферал</b>\n\n"
         f"Клиент: {_user_link(referred_id, 'профиль')} (ID <code>{referred_id}</code>)\n"
         "Источник: реф‑ссылка"
     )
-    try:
-        await bot.send_message(int(referrer_id), text_ref, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-    except Exception:
-        pass
+    _outbox_enqueue(int(referrer_id), text_ref, priority=SEND_PRIORITY_NOTIFY)
 
     _notify_manager_bg(
         "👥 <b>Новый реферал</b>\n\n"
@@ -1905,9 +3725,10 @@ async def cmd_start(message: types.Message):
         except Exception:
             ref_id = 0
         if ref_id > 0 and ref_id != user_id:
-            created = _set_referrer(user_id, ref_id)
-            if created:
-                await _notify_new_referral(ref_id, user_id)
+            with _db_transaction():
+                created = _set_referrer(user_id, ref_id)
+                if created:
+                    _notify_new_referral(ref_id, user_id)
 
     await send_welcome(message.chat.id, user_id)
 
@@ -2006,29 +3827,117 @@ async def cmd_manager_set(message: types.Message):
         parse_mode=ParseMode.HTML,
     )
 
+# =========================
+# CALLBACK ROUTER
+# =========================
+class _CallbackRouter:
+    """
+    Routes callback_data with one walk over a character trie of the registered prefixes instead
+    of trying every handler's filter in turn. A route is a prefix plus typed fields
+    ("topup_amount_" + amount): the remainder is split and parsed once and the values are passed
+    to the handler as keyword arguments. The longest prefix whose fields parse wins.
+    """
+
+    def __init__(self):
+        self._root: Dict[Optional[str], Any] = {}
+        self.routed = 0
+        self.unmatched = 0
+
+    def route(self, prefix: str, *fields: Tuple[str, Callable[[str], Any]], sep: str = "_"):
+        def decorator(handler: Callable[..., Any]) -> Callable[..., Any]:
+            node = self._root
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            if None in node:
+                raise ValueError(f"callback prefix {prefix!r} is already routed")
+            # Parameters after the callback and the fields are taken from aiogram's context (state, ...)
+            params = list(inspect.signature(handler).parameters)[1:]
+            node[None] = (handler, tuple(fields), sep, tuple(p for p in params if p not in dict(fields)))
+            return handler
+
+        return decorator
+
+    @staticmethod
+    def _parse(rest: str, fields: Tuple[Tuple[str, Callable[[str], Any]], ...], sep: str) -> Optional[Dict[str, Any]]:
+        if not fields:
+            return {} if not rest else None
+        parts = rest.split(sep, len(fields) - 1)
+        if len(parts) != len(fields):
+            return None
+        try:
+            return {name: parse(part) for (name, parse), part in zip(fields, parts)}
+        except (TypeError, ValueError):
+            return None
+
+    def resolve(self, data: str) -> Tuple[Optional[Tuple[Any, ...]], Dict[str, Any]]:
+        node = self._root
+        found = [(0, node[None])] if None in node else []
+        for i, ch in enumerate(data):
+            node = node.get(ch)
+            if node is None:
+                break
+            if None in node:
+                found.append((i + 1, node[None]))
+        for end, entry in reversed(found):
+            values = self._parse(data[end:], entry[1], entry[2])
+            if values is not None:
+                return entry, values
+        return None, {}
+
+    async def dispatch(self, callback: types.CallbackQuery, **data: Any) -> Any:
+        entry, values = self.resolve(callback.data or "")
+        if entry is None:
+            self.unmatched += 1
+            await callback.answer()
+            return None
+        self.routed += 1
+        handler, _, _, wants = entry
+        return await handler(callback, **values, **{k: data[k] for k in wants if k in data})
+
+    def stats(self) -> Dict[str, Any]:
+        return {"routed": self.routed, "unmatched": self.unmatched}
+
+
+def _need_field(value: str) -> int:
+    """Recommended top-up in rubles; a missing or garbled value means "no recommendation" (0)."""
+    try:
+        return int(value or 0)
+    except ValueError:
+        return 0
+
+
+def _amount_field(value: str) -> Any:
+    """Amount buttons carry rubles or "custom"; anything else is 0, which the handlers reject."""
+    if value == "custom":
+        return value
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+_callbacks = _CallbackRouter()
+dp.callback_query.register(_callbacks.dispatch)
+_register_metrics("callbacks", _callbacks.stats)
+
+
 # =========================
 # CALLBACKS
 # =========================
-@dp.callback_query(lambda c: c.data == "balance_topup")
-async def balance_topup_callback(callback: types.CallbackQuery):
+@_callbacks.route("balance_topup")
+async def balance_topup_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     user_id = callback.from_user.id
-    awaiting_custom_topup_card.discard(user_id)
-    awaiting_custom_topup_crypto.discard(user_id)
-    await show_topup_amounts(callback.message.chat.id, user_id, need_rub=0)
+    await _leave_topup_state(state)
+    await show_topup_amounts(callback.message.chat.id, user_id, need_rub=0, edit_message=callback.message)
 
 
-@dp.callback_query(lambda c: c.data.startswith("topup_recommend_"))
-async def topup_recommend_callback(callback: types.CallbackQuery):
+@_callbacks.route("topup_recommend_", ("need", _need_field))
+async def topup_recommend_callback(callback: types.CallbackQuery, need: int):
     await callback.answer()
     user_id = callback.from_user.id
-    try:
-        need = int(callback.data.replace("topup_recommend_", "") or 0)
-    except Exception:
-        need = 0
-
     if need <= 0:
-        await show_topup_amounts(callback.message.chat.id, user_id, need_rub=0)
+        await show_topup_amounts(callback.message.chat.id, user_id, need_rub=0, edit_message=callback.message)
         return
 
     text = (
@@ -2036,69 +3945,51 @@ async def topup_recommend_callback(callback: types.CallbackQuery):
         f"Вы выбрали сумму: <b>{need} ₽</b>\n\n"
         "Выберите способ оплаты:"
     )
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text=f"💳 Картой / ЮKassa — {need} ₽", callback_data=f"topup_amount_{need}")],
-            [InlineKeyboardButton(text=f"🪙 Криптой — {need} ₽", callback_data=f"crypto_amount_{need}")],
-            [InlineKeyboardButton(text="◀️ Назад", callback_data=f"back_topup_{need}")],
-        ]
-    )
-    await _send_photo_or_text(
+    kb = topup_methods_kb(need)
+    await _render_screen(
         chat_id=callback.message.chat.id,
         photo_path=PHOTO_TOPUP_MENU,
         text=text,
         reply_markup=kb,
         parse_mode=ParseMode.HTML,
+        edit_message=callback.message,
     )
 
 
-@dp.callback_query(lambda c: c.data == "back_main")
-async def back_main_callback(callback: types.CallbackQuery):
+@_callbacks.route("back_main")
+async def back_main_callback(callback: types.CallbackQuery, state: FSMContext):
     await callback.answer()
     user_id = callback.from_user.id
-    awaiting_custom_topup_card.discard(user_id)
-    awaiting_custom_topup_crypto.discard(user_id)
-    await send_welcome(callback.message.chat.id, user_id)
+    await _leave_topup_state(state)
+    await send_welcome(callback.message.chat.id, user_id, edit_message=callback.message)
 
 
-@dp.callback_query(lambda c: c.data.startswith("back_topup_"))
-async def back_topup_callback(callback: types.CallbackQuery):
+@_callbacks.route("back_topup_", ("need", _need_field))
+async def back_topup_callback(callback: types.CallbackQuery, need: int, state: FSMContext):
     await callback.answer()
     user_id = callback.from_user.id
-    awaiting_custom_topup_crypto.discard(user_id)
-    try:
-        need = int(callback.data.replace("back_topup_", "") or 0)
-    except Exception:
-        need = 0
-    await show_topup_amounts(callback.message.chat.id, user_id, need_rub=need)
+    await _leave_topup_state(state, TopupStates.custom_crypto)
+    await show_topup_amounts(callback.message.chat.id, user_id, need_rub=need, edit_message=callback.message)
 
 
 # =========================
 # TOPUP: CARD
 # =========================
-@dp.callback_query(lambda c: c.data.startswith("topup_amount_"))
-async def topup_amount_callback(callback: types.CallbackQuery):
+@_callbacks.route("topup_amount_", ("amount", _amount_field))
+async def topup_amount_callback(callback: types.CallbackQuery, amount: Any, state: FSMContext):
     await callback.answer()
     user_id = callback.from_user.id
-    amount = callback.data.replace("topup_amount_", "")
 
     if amount == "custom":
-        awaiting_custom_topup_card.add(user_id)
-        awaiting_custom_topup_crypto.discard(user_id)
+        await state.set_state(TopupStates.custom_card)
         await callback.message.answer(
             "Введите сумму пополнения в рублях (например: <b>250</b>).",
             parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[[InlineKeyboardButton(text="Отмена", callback_data="back_main")]]
-            ),
+            reply_markup=_CANCEL_TO_MAIN_KB,
         )
         return
 
-    try:
-        amount_rub = int(amount)
-    except Exception:
-        amount_rub = 0
-
+    amount_rub = amount
     if amount_rub <= 0:
         await callback.message.answer("❌ Некорректная сумма.")
         return
@@ -2117,7 +4008,7 @@ async def topup_amount_callback(callback: types.CallbackQuery):
         await callback.message.answer(f"❌ Не удалось создать инвойс (карта): {e}")
 
 
-async def send_partner_program(chat_id: int, user_id: int) -> None:
+async def send_partner_program(chat_id: int, user_id: int, edit_message: Optional[types.Message] = None) -> None:
     ref_link = await _build_ref_link(user_id)
     link_line = f"<code>{ref_link}</code>" if ref_link else "❌ Не удалось получить ссылку. Укажите BOT_USERNAME."
     ref_balance = _format_rub_from_kopecks(_get_ref_balance_kopecks(user_id))
@@ -2131,65 +4022,37 @@ async def send_partner_program(chat_id: int, user_id: int) -> None:
         f"💰 Ваш реф‑баланс: <b>{ref_balance}</b>\n\n"
         f"Ваша реферальная ссылка:\n{link_line}"
     )
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="💡 Советы", callback_data="ref_tips")],
-            [InlineKeyboardButton(text="📋 Скопировать ссылку", callback_data="ref_copy")],
-            [InlineKeyboardButton(text="💸 Вывести", callback_data="ref_withdraw")],
-        ]
-    )
-    await _send_photo_or_text(
+    await _render_screen(
         chat_id=chat_id,
         photo_path=PHOTO_PARTNER,
         text=text,
-        reply_markup=kb,
+        reply_markup=_PARTNER_KB,
         parse_mode=ParseMode.HTML,
         disable_web_page_preview=True,
+        edit_message=edit_message,
     )
 
 
-@dp.callback_query(lambda c: c.data == "ref_tips")
+@_callbacks.route("ref_tips")
 async def ref_tips(callback: types.CallbackQuery):
     await callback.answer()
     if not callback.message:
         return
-    text = (
-        "💡 <b>Советы для партнёров</b>\n\n"
-        "Мы собрали лучшие советы для начинающих партнёров, очень рекомендуем с ними ознакомиться."
-    )
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [
-                InlineKeyboardButton(
-                    text="📘 Открыть советы",
-                    url="https://telegra.ph/TOP-sposobov-privlekat-klientov-02-07",
-                )
-            ],
-            [InlineKeyboardButton(text="◀️ Назад", callback_data="ref_tips_back")],
-        ]
-    )
-    await _send_photo_or_text(
+    await _render_screen(
         chat_id=callback.message.chat.id,
         photo_path=PHOTO_PARTNER,
-        text=text,
-        reply_markup=kb,
+        text=_REF_TIPS_TEXT,
+        reply_markup=_REF_TIPS_KB,
         parse_mode=ParseMode.HTML,
+        edit_message=callback.message,
     )
 
 
-@dp.callback_query(lambda c: c.data == "ref_tips_back")
+@_callbacks.route("ref_tips_back")
 async def ref_tips_back(callback: types.CallbackQuery):
     await callback.answer()
-    chat_id = None
     if callback.message:
-        chat_id = callback.message.chat.id
-    try:
-        if callback.message:
-            await callback.message.delete()
-    except Exception:
-        pass
-    if chat_id is not None:
-        await send_partner_program(chat_id, callback.from_user.id)
+        await send_partner_program(callback.message.chat.id, callback.from_user.id, edit_message=callback.message)
 
 
 @dp.message(F.text == "💳 Баланс")
@@ -2214,56 +4077,22 @@ async def menu_partner_program(message: types.Message):
 
 @dp.message(F.text == "🆘 Поддержка")
 async def menu_support(message: types.Message):
-    text = (
-        "🆘 <b>Поддержка</b>\n\n"
-        "Напишите менеджеру, он поможет с любыми вопросами:\n"
-        f"@{MANAGER_USERNAME}"
-    )
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="💬 Написать в поддержку", url=f"https://t.me/{MANAGER_USERNAME}")]
-        ]
-    )
     await _send_photo_or_text(
         chat_id=message.chat.id,
         photo_path=PHOTO_SUPPORT,
-        text=text,
-        reply_markup=kb,
+        text=_SUPPORT_TEXT,
+        reply_markup=_SUPPORT_KB,
         parse_mode=ParseMode.HTML,
     )
 
 
 @dp.message(F.text == "📜 Правила")
 async def menu_rules(message: types.Message):
-    text = (
-        "📜 <b>Правила и соглашения</b>\n\n"
-        "Уважаемый пользователь! Ознакомьтесь с нашими правилами и соглашениями магазина.\n\n"
-        "✅ <b>Boost Shop гарантирует:</b>\n"
-        "• Работоспособность аккаунтов в течение 48 часов при АКТИВНОЙ гарантии.\n"
-        "• Продажу аккаунтов только в «одни руки».\n"
-        "• Замену аккаунтов при их невалидности по вине поставщика при АКТИВНОЙ гарантии.\n"
-        "• Возврат средств, если аккаунт заменить невозможно. Возврат осуществляется только на платежные системы:\n"
-        "◦ CryptoBot\n\n"
-        "⏳ Время выдачи товара в нашем магазине — до 24 часов.\n"
-        "⚠️ Обмен или возврат товара, если он вам не подошел или не устроил, невозможен.\n\n"
-        "📋 <b>Общие правила:</b>\n"
-        "• Мы не раздаем товары бесплатно.\n"
-        "• Администрация сервиса оставляет за собой право отказать в обслуживании и поддержке клиенту без объяснения причин.\n"
-        "• Сервис не несет ответственности за ваши действия.\n"
-        "• Совершая покупку, вы автоматически соглашаетесь со всеми правилами сервиса.\n\n"
-        "<b>Обратите внимание:</b>\n"
-        "Наши прокси не гарантируют доступ к ресурсам: Банки, Госуслуги, Авито."
-    )
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="🔐 Политика использования", url="https://telegra.ph/Politika-ispolzovaniya-01-31")]
-        ]
-    )
     await _send_photo_or_text(
         chat_id=message.chat.id,
         photo_path=PHOTO_RULES,
-        text=text,
-        reply_markup=kb,
+        text=_RULES_TEXT,
+        reply_markup=_RULES_KB,
         parse_mode=ParseMode.HTML,
         disable_web_page_preview=True,
     )
@@ -2271,15 +4100,10 @@ async def menu_rules(message: types.Message):
 
 @dp.message(F.text == "🔐 Политика")
 async def menu_policy(message: types.Message):
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[
-            [InlineKeyboardButton(text="🔐 Открыть политику", url="https://telegra.ph/Politika-ispolzovaniya-01-31")]
-        ]
-    )
-    await message.answer("🔐 Политика использования:", reply_markup=kb)
+    await message.answer("🔐 Политика использования:", reply_markup=_POLICY_KB)
 
 
-@dp.callback_query(lambda c: c.data == "ref_copy")
+@_callbacks.route("ref_copy")
 async def ref_copy(callback: types.CallbackQuery):
     await callback.answer()
     ref_link = await _build_ref_link(callback.from_user.id)
@@ -2289,7 +4113,7 @@ async def ref_copy(callback: types.CallbackQuery):
     await callback.message.answer(f"📋 Ваша реферальная ссылка:\n<code>{ref_link}</code>", parse_mode=ParseMode.HTML)
 
 
-@dp.callback_query(lambda c: c.data == "ref_withdraw")
+@_callbacks.route("ref_withdraw")
 async def ref_withdraw(callback: types.CallbackQuery):
     await callback.answer()
     bal = _format_rub_from_kopecks(_get_ref_balance_kopecks(callback.from_user.id))
@@ -2299,22 +4123,20 @@ async def ref_withdraw(callback: types.CallbackQuery):
         f"Напишите менеджеру @{MANAGER_USERNAME} — он подсчитает сумму и пришлёт выплату.\n"
         "Можно отправить скрин/детали для ускорения."
     )
-    kb = InlineKeyboardMarkup(
-        inline_keyboard=[[InlineKeyboardButton(text="◀️ Назад", callback_data="ref_back")]]
-    )
-    await callback.message.answer(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+    await callback.message.answer(text, parse_mode=ParseMode.HTML, reply_markup=_REF_WITHDRAW_KB)
 
 
-@dp.callback_query(lambda c: c.data == "ref_back")
+@_callbacks.route("ref_back")
 async def ref_back(callback: types.CallbackQuery):
     await callback.answer()
-    await send_partner_program(callback.message.chat.id, callback.from_user.id)
+    await send_partner_program(callback.message.chat.id, callback.from_user.id, edit_message=callback.message)
 
 
 @dp.message(F.text)
-async def custom_amount_handler(message: types.Message):
+async def custom_amount_handler(message: types.Message, state: FSMContext):
     user_id = message.from_user.id
     raw = (message.text or "").strip().replace(",", ".")
+    current = await state.get_state()
     menu_texts = {
         "💳 Баланс",
         "🚀 Накрутка и аккаунты",
@@ -2322,11 +4144,11 @@ async def custom_amount_handler(message: types.Message):
         "🆘 Поддержка",
         "📜 Правила",
     }
-    if user_id not in awaiting_custom_topup_card and user_id not in awaiting_custom_topup_crypto:
+    if current not in (TopupStates.custom_card.state, TopupStates.custom_crypto.state):
         if (message.text or "").strip() in menu_texts:
             return
 
-    if user_id in awaiting_custom_topup_card:
+    if current == TopupStates.custom_card.state:
         try:
             rub = Decimal(raw)
         except InvalidOperation:
@@ -2341,14 +4163,14 @@ async def custom_amount_handler(message: types.Message):
             await message.answer(f"❌ Минимальная сумма пополнения картой — {MIN_CARD_TOPUP_RUB} ₽.")
             return
 
-        awaiting_custom_topup_card.discard(user_id)
+        await state.clear()
         try:
             await send_topup_invoice(chat_id=message.chat.id, user_id=user_id, amount_rub=amount_rub, reason="Пополнение баланса")
         except Exception as e:
             await message.answer(f"❌ Не удалось создать инвойс (карта): {e}")
         return
 
-    if user_id in awaiting_custom_topup_crypto:
+    if current == TopupStates.custom_crypto.state:
         try:
             rub = Decimal(raw)
         except InvalidOperation:
@@ -2358,7 +4180,7 @@ async def custom_amount_handler(message: types.Message):
             await message.answer("❌ Введите число больше 0 (например: 250).")
             return
 
-        awaiting_custom_topup_crypto.discard(user_id)
+        await state.clear()
         await start_crypto_topup(message.chat.id, user_id, rub)
         return
 
@@ -2366,16 +4188,11 @@ async def custom_amount_handler(message: types.Message):
 # =========================
 # TOPUP: CRYPTO
 # =========================
-@dp.callback_query(lambda c: c.data.startswith("topup_crypto_menu_"))
-async def topup_crypto_menu_callback(callback: types.CallbackQuery):
+@_callbacks.route("topup_crypto_menu_", ("need", _need_field))
+async def topup_crypto_menu_callback(callback: types.CallbackQuery, need: int, state: FSMContext):
     await callback.answer()
     user_id = callback.from_user.id
-    awaiting_custom_topup_crypto.discard(user_id)
-
-    try:
-        need = int(callback.data.replace("topup_crypto_menu_", "") or 0)
-    except Exception:
-        need = 0
+    await _leave_topup_state(state, TopupStates.custom_crypto)
 
     if not CRYPTO_PAY_TOKEN:
         await callback.message.answer(
@@ -2383,45 +4200,36 @@ async def topup_crypto_menu_callback(callback: types.CallbackQuery):
             "❌ Сейчас не настроена на стороне бота.\n"
             "Нужно подключить Crypto Pay API (@CryptoBot → Crypto Pay → Create App) и установить CRYPTO_PAY_TOKEN.",
             parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[[InlineKeyboardButton(text="◀️ Назад", callback_data="back_main")]]
-            ),
+            reply_markup=_BACK_TO_MAIN_KB,
         )
         return
 
     kb = crypto_amounts_kb(need_rub=need)
-    await _send_photo_or_text(
+    await _render_screen(
         chat_id=callback.message.chat.id,
         photo_path=PHOTO_CRYPTO_MENU,
         text="🪙 <b>Пополнение криптой</b>\n\nВыберите сумму (в рублях). Оплатить можно USDT/TON/BTC/ETH/USDC.",
         reply_markup=kb,
         parse_mode=ParseMode.HTML,
+        edit_message=callback.message,
     )
 
 
-@dp.callback_query(lambda c: c.data.startswith("crypto_amount_"))
-async def crypto_amount_callback(callback: types.CallbackQuery):
+@_callbacks.route("crypto_amount_", ("amount", _amount_field))
+async def crypto_amount_callback(callback: types.CallbackQuery, amount: Any, state: FSMContext):
     await callback.answer()
     user_id = callback.from_user.id
-    amount = callback.data.replace("crypto_amount_", "")
 
     if amount == "custom":
-        awaiting_custom_topup_crypto.add(user_id)
-        awaiting_custom_topup_card.discard(user_id)
+        await state.set_state(TopupStates.custom_crypto)
         await callback.message.answer(
             "Введите сумму пополнения в рублях для крипто-оплаты (например: <b>250</b>).",
             parse_mode=ParseMode.HTML,
-            reply_markup=InlineKeyboardMarkup(
-                inline_keyboard=[[InlineKeyboardButton(text="Отмена", callback_data="back_main")]]
-            ),
+            reply_markup=_CANCEL_TO_MAIN_KB,
         )
         return
 
-    try:
-        amount_rub = Decimal(str(int(amount)))
-    except Exception:
-        amount_rub = Decimal("0")
-
+    amount_rub = Decimal(amount)
     if amount_rub <= 0:
         await callback.message.answer("❌ Некорректная сумма.")
         return
@@ -2460,10 +4268,9 @@ async def start_crypto_topup(chat_id: int, user_id: int, amount_rub: Decimal) ->
     await bot.send_message(chat_id, text, reply_markup=kb, parse_mode=ParseMode.HTML)
 
 
-@dp.callback_query(lambda c: c.data.startswith("crypto_check_"))
-async def crypto_check_callback(callback: types.CallbackQuery):
+@_callbacks.route("crypto_check_", ("invoice_id", int))
+async def crypto_check_callback(callback: types.CallbackQuery, invoice_id: int):
     await callback.answer()
-    invoice_id = int(callback.data.replace("crypto_check_", "") or 0)
     meta = _get_crypto_invoice_meta(invoice_id)
 
     try:
@@ -2523,7 +4330,7 @@ async def send_topup_invoice(chat_id: int, user_id: int, amount_rub: int, reason
         raise RuntimeError("PROVIDER_TOKEN is not set (set env PROVIDER_TOKEN=...)")
 
     # удалить старый инвойс в чате, если был
-    prev = _last_tg_invoice.get(int(user_id))
+    prev = _state_store.get(_last_tg_invoice_key(user_id))
     if prev:
         try:
             await bot.delete_message(chat_id=prev["chat_id"], message_id=prev["message_id"])
@@ -2545,13 +4352,17 @@ async def send_topup_invoice(chat_id: int, user_id: int, amount_rub: int, reason
         start_parameter="topup_balance",
     )
 
-    _last_tg_invoice[int(user_id)] = {
-        "chat_id": int(chat_id),
-        "message_id": int(msg.message_id),
-        "payload": order_id,
-        "amount_kopecks": int(amount_kopecks),
-        "created_at": int(time.time()),
-    }
+    _state_store.set(
+        _last_tg_invoice_key(user_id),
+        {
+            "chat_id": int(chat_id),
+            "message_id": int(msg.message_id),
+            "payload": order_id,
+            "amount_kopecks": int(amount_kopecks),
+            "created_at": int(time.time()),
+        },
+        STATE_INVOICE_TTL_SEC,
+    )
 
 
 @dp.pre_checkout_query()
@@ -2575,31 +4386,33 @@ async def successful_payment_handler(message: types.Message):
     amount = int(p.total_amount)
     user_id = message.from_user.id
     payload = getattr(p, "invoice_payload", "")
-    prev = _last_tg_invoice.get(int(user_id))
+    prev = _state_store.get(_last_tg_invoice_key(user_id))
     if prev and payload and prev.get("payload") == payload:
-        _last_tg_invoice.pop(int(user_id), None)
-
-    new_bal = _add_balance_kopecks(user_id, amount)
+        _state_store.delete(_last_tg_invoice_key(user_id))
+
+    # Зачисление, отметка платежа и уведомления — одной транзакцией
+    with _db_transaction():
+        new_bal = _add_balance_kopecks(user_id, amount)
+        _mark_tg_payment_processed(telegram_charge_id, p.provider_payment_charge_id, user_id, amount)
+
+        text = (
+            "✅ <b>Баланс пополнен!</b>\n\n"
+            f"Сумма: <b>{_format_rub_from_kopecks(amount)}</b>\n"
+            f"Текущий баланс: <b>{_format_rub_from_kopecks(new_bal)}</b>\n\n"
+            "Откройте приложение — баланс отобразится автоматически."
+        )
+        _outbox_enqueue(message.chat.id, text, reply_markup=open_webapp_kb(user_id), priority=SEND_PRIORITY_PAYMENT)
 
-    _mark_tg_payment_processed(telegram_charge_id, p.provider_payment_charge_id, user_id, amount)
+        _notify_manager_bg(
+            "💳 <b>Пополнение картой (Telegram Payments / ЮKassa)</b>\n\n"
+            f"Пользователь: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
+            f"Сумма: <b>{_format_rub_from_kopecks(amount)}</b>",
+            urgent=True,
+        )
 
     # Попытаемся автоматически оформить ожидающую покупку
     await _finalize_pending_order_if_possible(user_id, source="ЮKassa")
 
-    text = (
-        "✅ <b>Баланс пополнен!</b>\n\n"
-        f"Сумма: <b>{_format_rub_from_kopecks(amount)}</b>\n"
-        f"Текущий баланс: <b>{_format_rub_from_kopecks(new_bal)}</b>\n\n"
-        "Откройте приложение — баланс отобразится автоматически."
-    )
-    await message.answer(text, reply_markup=open_webapp_kb(user_id), parse_mode=ParseMode.HTML)
-
-    _notify_manager_bg(
-        "💳 <b>Пополнение картой (Telegram Payments / ЮKassa)</b>\n\n"
-        f"Пользователь: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
-        f"Сумма: <b>{_format_rub_from_kopecks(amount)}</b>"
-    )
-
 
 # =========================
 # WEBAPP DATA
@@ -2649,7 +4462,7 @@ def _build_order_from_webapp(data: Dict[str, Any]) -> Dict[str, Any]:
 async def webapp_data_handler(message: types.Message):
     user_id = message.from_user.id
     try:
-        data = json.loads(message.web_app_data.data)
+        data = _json_loads(message.web_app_data.data)
     except Exception:
         await message.answer("❌ Не удалось прочитать данные из приложения.")
         return
@@ -2675,7 +4488,7 @@ async def webapp_data_handler(message: types.Message):
             order["total_price"] = _kopecks_to_rub_str(amount_kopecks)
 
         try:
-            order_json = json.dumps(order, ensure_ascii=False)
+            order_json = _json_dumps(order)
         except Exception:
             order_json = "{}"
 
@@ -2710,69 +4523,66 @@ async def webapp_data_handler(message: types.Message):
         await message.answer("❌ Сумма заказа слишком большая.")
         return
 
-    # Идемпотентность
-    if _is_order_processed(order["order_id"]):
-        await message.answer(
-            "ℹ️ Этот заказ уже был оплачен ранее.",
-            parse_mode=ParseMode.HTML,
-            reply_markup=open_webapp_kb(user_id, success_order=order),
-        )
-        return
-
-    ok, before, after = _try_debit_balance_kopecks(user_id, amount_kopecks)
-    if not ok:
-        need = max(0, amount_kopecks - before)
-        need_rub = int((need + 99) // 100)
-
+    async with _balance_lock(user_id):
         try:
-            order_json = json.dumps(order, ensure_ascii=False)
+            order_json = _json_dumps(order)
         except Exception:
             order_json = "{}"
-        _set_pending_order(user_id, order["order_id"], amount_kopecks, order_json)
 
-        await show_topup_amounts(message.chat.id, user_id, need_rub=need_rub)
-        await message.answer(
-            "❌ <b>Недостаточно средств</b>\n\n"
-            f"Сохранён заказ <code>{order['order_id']}</code>.\n"
-            "Пополните баланс — бот автоматически оформит покупку.",
-            parse_mode=ParseMode.HTML,
-        )
-        return
+        # Отметка о заказе, списание, история и уведомления — одна транзакция (идемпотентность
+        # и защита от двойного списания из другого процесса)
+        with _db_transaction():
+            status, before, after = _pay_order_from_balance(user_id, order["order_id"], amount_kopecks, order_json)
+            if status == "paid":
+                text = (
+                    "✅ <b>Оплата списана с баланса</b>\n\n"
+                    f"{_order_text_block(order)}\n\n"
+                    f"Списано: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>\n"
+                    f"Баланс: <b>{_format_rub_from_kopecks(after)}</b>\n\n"
+                    f"Менеджер: <b>@{MANAGER_USERNAME}</b>"
+                )
+                mgr_text = (
+                    "🧾 <b>Новый оплаченный заказ</b>\n\n"
+                    f"Покупатель: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
+                    "Оплата: <b>Баланс</b>\n\n"
+                    f"{_order_text_block(order)}"
+                )
 
-    # Оплата с баланса успешна
-    try:
-        order_json = json.dumps(order, ensure_ascii=False)
-    except Exception:
-        order_json = "{}"
-    _mark_order_processed(order["order_id"], user_id, amount_kopecks, order_json)
+                # История заказов (для вкладки «Профиль» в WebApp)
+                try:
+                    _create_order(user_id, order, amount_kopecks)
+                except Exception as e:
+                    logger.warning(f"Failed to store order in history: {e}")
 
-    # История заказов (для вкладки «Профиль» в WebApp)
-    try:
-        _create_order(user_id, order, amount_kopecks)
-    except Exception as e:
-        logger.warning(f"Failed to store order in history: {e}")
+                _outbox_enqueue(
+                    message.chat.id,
+                    text,
+                    reply_markup=open_webapp_kb(user_id, success_order=order),
+                    priority=SEND_PRIORITY_PAYMENT,
+                )
+                _notify_manager_bg(mgr_text, reply_markup=_mgr_confirm_kb(order.get("order_id")))
+                _apply_referral_reward(user_id, order.get("order_id"), amount_kopecks)
 
-    try:
-        await _apply_referral_reward(user_id, order.get("order_id"), amount_kopecks)
-    except Exception:
-        pass
+        if status == "duplicate":
+            await message.answer(
+                "ℹ️ Этот заказ уже был оплачен ранее.",
+                parse_mode=ParseMode.HTML,
+                reply_markup=open_webapp_kb(user_id, success_order=order),
+            )
+            return
 
-    text = (
-        "✅ <b>Оплата списана с баланса</b>\n\n"
-        f"{_order_text_block(order)}\n\n"
-        f"Списано: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>\n"
-        f"Баланс: <b>{_format_rub_from_kopecks(after)}</b>\n\n"
-        f"Менеджер: <b>@{MANAGER_USERNAME}</b>"
-    )
-    await message.answer(text, reply_markup=open_webapp_kb(user_id, success_order=order), parse_mode=ParseMode.HTML)
+        if status == "insufficient":
+            need = max(0, amount_kopecks - before)
+            need_rub = int((need + 99) // 100)
+            _set_pending_order(user_id, order["order_id"], amount_kopecks, order_json)
 
-    mgr_text = (
-        "🧾 <b>Новый оплаченный заказ</b>\n\n"
-        f"Покупатель: {_user_link(user_id, 'профиль')} (ID <code>{user_id}</code>)\n"
-        "Оплата: <b>Баланс</b>\n\n"
-        f"{_order_text_block(order)}"
-    )
-    _notify_manager_bg(mgr_text, reply_markup=_mgr_confirm_kb(order.get("order_id")))
+            await show_topup_amounts(message.chat.id, user_id, need_rub=need_rub)
+            await message.answer(
+                "❌ <b>Недостаточно средств</b>\n\n"
+                f"Сохранён заказ <code>{order['order_id']}</code>.\n"
+                "Пополните баланс — бот автоматически оформит покупку.",
+                parse_mode=ParseMode.HTML,
+            )
 
 
 
@@ -2840,19 +4650,27 @@ ID: <code>{oid}</code>
         await message.answer(text_msg, parse_mode=ParseMode.HTML, reply_markup=kb, disable_web_page_preview=True)
 
 
-@dp.callback_query(lambda c: (c.data or "").startswith("mgr_done:"))
-async def mgr_done(callback: types.CallbackQuery):
+@_callbacks.route("mgr_done:", ("oid", str.strip), sep=":")
+async def mgr_done(callback: types.CallbackQuery, oid: str):
     if not callback.message or not _is_manager_chat(callback.message.chat.id, getattr(callback.from_user, "username", None)):
         await callback.answer("Нет доступа", show_alert=True)
         return
-    oid = str((callback.data or "").split(":", 1)[1] or "").strip()
     if not oid:
         await callback.answer("Некорректный заказ", show_alert=True)
         return
+    # Status change and the user's completion notice are committed together
     try:
-        _set_order_status(oid, "done")
-    except Exception:
-        pass
+        with _db_transaction():
+            _set_order_status(oid, "done")
+            row = _get_order_by_id(oid)
+            if row and int(row.get("user_id") or 0) > 0:
+                _outbox_enqueue(
+                    int(row.get("user_id")),
+                    f"✅ Ваш заказ <code>{oid}</code> выполнен.",
+                    priority=SEND_PRIORITY_NOTIFY,
+                )
+    except Exception as e:
+        logger.error(f"Failed to mark order {oid} as done: {e}")
     try:
         await callback.message.edit_reply_markup(reply_markup=None)
     except Exception:
@@ -2863,19 +4681,6 @@ async def mgr_done(callback: types.CallbackQuery):
     except Exception:
         pass
 
-    # Notify user about completion
-    try:
-        row = _get_order_by_id(oid)
-        if row and int(row.get("user_id") or 0) > 0:
-            uid = int(row.get("user_id"))
-            await bot.send_message(
-                uid,
-                f"✅ Ваш заказ <code>{oid}</code> выполнен.",
-                parse_mode=ParseMode.HTML,
-            )
-    except Exception:
-        pass
-
 
 # =========================
 # TELEGRAM INITDATA VERIFY (for WebApp API)
@@ -2885,10 +4690,63 @@ def _parse_init_data(init_data: str) -> Dict[str, str]:
     return {k: v for k, v in pairs}
 
 
+_INIT_DATA_CACHE_TTL = 3600  # upper bound; entries also expire when their auth_date gets too old
+_init_data_cache = _MemoryStateStore(INIT_DATA_CACHE_SIZE)
+_init_data_stats = {"hits": 0, "misses": 0, "rejected": 0, "expired": 0}
+
+
+@lru_cache(maxsize=8)
+def _init_data_secret(bot_token: str) -> bytes:
+    return hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
+
+
+for _token in (BOT_TOKEN, ACCOUNTS_BOT_TOKEN):
+    if (_token or "").strip():
+        _init_data_secret(_token.strip())
+
+
+def _init_data_stats_snapshot() -> Dict[str, Any]:
+    looked_up = _init_data_stats["hits"] + _init_data_stats["misses"]
+    store = _init_data_cache.stats()
+    return {
+        **_init_data_stats,
+        "cached": store["keys"],
+        "evicted": store["evicted"],
+        "hit_rate": round(_init_data_stats["hits"] / looked_up, 3) if looked_up else 0.0,
+    }
+
+
+_register_metrics("init_data", _init_data_stats_snapshot)
+
+
 def _validate_init_data(init_data: str, bot_token: str) -> Dict[str, Any]:
     """
-    Verifies Telegram WebApp initData (hash) and returns parsed payload.
+    Verifies Telegram WebApp initData (hash, auth_date age) and returns parsed payload.
+
+    The WebApp sends the same initData with every request of a session, so validated strings
+    are cached (keyed by a digest of secret key + initData) until they would become stale.
     """
+    secret_key = _init_data_secret(bot_token)
+    cache_key = hashlib.sha256(secret_key + (init_data or "").encode("utf-8")).hexdigest()
+    cached = _init_data_cache.get(cache_key)
+    if cached is not None:
+        _init_data_stats["hits"] += 1
+        return cached
+    _init_data_stats["misses"] += 1
+    try:
+        payload = _check_init_data(init_data, secret_key)
+    except ValueError:
+        _init_data_stats["rejected"] += 1
+        raise
+    ttl = _INIT_DATA_CACHE_TTL
+    if INIT_DATA_MAX_AGE_SEC > 0:
+        ttl = min(ttl, int(payload["data"]["auth_date"]) + INIT_DATA_MAX_AGE_SEC - int(time.time()))
+    if ttl > 0:
+        _init_data_cache.set(cache_key, payload, ttl)
+    return payload
+
+
+def _check_init_data(init_data: str, secret_key: bytes) -> Dict[str, Any]:
     data = _parse_init_data(init_data)
     recv_hash = data.pop("hash", "")
     if not recv_hash:
@@ -2898,17 +4756,27 @@ def _validate_init_data(init_data: str, bot_token: str) -> Dict[str, Any]:
     check_list = [f"{k}={v}" for k, v in sorted(data.items())]
     data_check_string = "\n".join(check_list)
 
-    secret_key = hmac.new(b"WebAppData", bot_token.encode("utf-8"), hashlib.sha256).digest()
     calc_hash = hmac.new(secret_key, data_check_string.encode("utf-8"), hashlib.sha256).hexdigest()
 
     if not hmac.compare_digest(calc_hash, recv_hash):
         raise ValueError("bad_hash")
 
+    if INIT_DATA_MAX_AGE_SEC > 0:
+        try:
+            auth_date = int(data.get("auth_date") or 0)
+        except ValueError:
+            auth_date = 0
+        if auth_date <= 0:
+            raise ValueError("no_auth_date")
+        if time.time() - auth_date > INIT_DATA_MAX_AGE_SEC:
+            _init_data_stats["expired"] += 1
+            raise ValueError("init_data_expired")
+
     # Parse user object if present
     user = {}
     if "user" in data:
         try:
-            user = json.loads(data["user"])
+            user = _json_loads(data["user"])
         except Exception:
             user = {}
     return {"data": data, "user": user}
@@ -2956,31 +4824,283 @@ def _user_id_from_init_accounts(init_data: str) -> int:
 _MAIN_BOT_USERNAME: Optional[str] = None
 
 
-async def _api_json(request: web.Request, obj: Dict[str, Any], status: int = 200) -> web.Response:
-    return web.json_response(obj, status=status, dumps=lambda o: json.dumps(o, ensure_ascii=False))
+async def _api_json(
+    request: web.Request, obj: Dict[str, Any], status: int = 200, headers: Optional[Dict[str, str]] = None
+) -> web.Response:
+    return web.Response(
+        body=_json_dumpb(obj), status=status, headers=headers, content_type="application/json", charset="utf-8"
+    )
+
+
+_etag_stats = {"not_modified": 0, "full": 0}
+_register_metrics("etag", lambda: dict(_etag_stats))
+
+
+def _conditional(request: web.Request, user_id: int, *variant: Any) -> Tuple[Optional[web.Response], Dict[str, str]]:
+    """
+    ETag from the user's data version plus everything else the response depends on (path,
+    request params, discount settings). Returns a 304 response if the client already has it,
+    otherwise the headers for the full response.
+    """
+    key = repr((request.path, variant, str(DISCOUNT_RATE), DISCOUNT_USER_ID_INT, _MAIN_BOT_USERNAME))
+    etag = f'"{int(user_id)}.{_get_user_version(user_id)}.{hashlib.sha1(key.encode("utf-8")).hexdigest()[:10]}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    sent = request.headers.get("If-None-Match", "")
+    if sent and (sent.strip() == "*" or etag in (t.strip().removeprefix("W/") for t in sent.split(","))):
+        _etag_stats["not_modified"] += 1
+        return web.Response(status=304, headers=headers), headers
+    _etag_stats["full"] += 1
+    return None, headers
+
+
+class _ApiError(Exception):
+    """Request error with its HTTP status; the message is the "error" code in the JSON reply."""
+
+    def __init__(self, error: str, status: int = 400):
+        super().__init__(error)
+        self.status = status
+
+
+async def _api_error(request: web.Request, e: Exception) -> web.Response:
+    return await _api_json(request, {"ok": False, "error": str(e)}, status=getattr(e, "status", 400))
+
+
+async def _request_body(request: web.Request) -> Dict[str, Any]:
+    """
+    JSON object body, read and parsed on first use and kept on the request. Anything that is not
+    a JSON POST reads as {}; oversized bodies raise 413 (client_max_size also stops chunked
+    uploads mid-read), malformed JSON or a non-object raises 400.
+    """
+    if "_json_body" in request:
+        return request["_json_body"]
+    body: Dict[str, Any] = {}
+    if request.method in ("POST", "PUT", "PATCH") and "application/json" in request.headers.get("Content-Type", ""):
+        if (request.content_length or 0) > API_MAX_BODY_BYTES:
+            raise _ApiError("body_too_large", 413)
+        try:
+            raw = await request.read()
+        except web.HTTPRequestEntityTooLarge:
+            raise _ApiError("body_too_large", 413)
+        if raw.strip():
+            try:
+                body = _json_loads(raw)
+            except Exception:
+                raise _ApiError("bad_json")
+            if not isinstance(body, dict):
+                raise _ApiError("bad_json")
+    request["_json_body"] = body
+    return body
 
 
-def _get_initdata_from_request(request: web.Request) -> str:
+async def _get_initdata_from_request(request: web.Request) -> str:
     init_data = request.headers.get("X-Tg-Init-Data", "") or ""
     if not init_data:
         # Allow passing in JSON for debugging
+        body = await _request_body(request)
+        init_data = str(body.get("initData") or "")
+    return init_data
+
+
+try:
+    import brotli  # type: ignore
+except Exception:
+    brotli = None
+
+_http_stats = {"requests": 0, "logged": 0, "compressed": 0, "bytes_before": 0, "bytes_after": 0}
+_register_metrics("http", lambda: dict(_http_stats))
+
+
+def _pick_encoding(accept_encoding: str) -> Optional[str]:
+    """Best coding we support from Accept-Encoding (q=0 means "not acceptable")."""
+    accepted = set()
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.strip().partition(";")
+        q = params.strip()
+        if q.startswith("q="):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name.strip())
+    for coding in ("br", "gzip", "deflate"):
+        if coding in accepted and (coding != "br" or brotli is not None):
+            return coding
+    return None
+
+
+def _compress(body: bytes, coding: str) -> bytes:
+    if coding == "br":
+        return brotli.compress(body, quality=min(API_COMPRESS_LEVEL, 11))
+    wbits = 31 if coding == "gzip" else 15
+    c = zlib.compressobj(API_COMPRESS_LEVEL, zlib.DEFLATED, wbits)
+    return c.compress(body) + c.flush()
+
+
+def _weaken_etag(resp: web.StreamResponse) -> None:
+    """
+    A strong ETag names the identity bytes; the compressed body only matches it weakly.
+    _conditional compares weakly, so W/ tags still revalidate.
+    """
+    etag = resp.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        resp.headers["ETag"] = "W/" + etag
+
+
+@web.middleware
+async def _compress_mw(request: web.Request, handler):
+    resp = await handler(request)
+    _http_stats["requests"] += 1
+    # Streams (SSE) and already encoded or small bodies go out as they are
+    if not isinstance(resp, web.Response) or resp.headers.get("Content-Encoding"):
+        return resp
+    if resp.status == 304:
+        # Same validator (and Vary) the full response would carry for this Accept-Encoding
+        resp.headers["Vary"] = "Accept-Encoding"
+        if _pick_encoding(request.headers.get("Accept-Encoding", "")) is not None:
+            _weaken_etag(resp)
+        return resp
+    body = resp.body
+    if not isinstance(body, (bytes, bytearray)) or len(body) < API_COMPRESS_MIN_BYTES:
+        return resp
+    resp.headers["Vary"] = "Accept-Encoding"
+    coding = _pick_encoding(request.headers.get("Accept-Encoding", ""))
+    if coding is None:
+        return resp
+    packed = _compress(bytes(body), coding)
+    _http_stats["compressed"] += 1
+    _http_stats["bytes_before"] += len(body)
+    _http_stats["bytes_after"] += len(packed)
+    resp.body = packed
+    resp.headers["Content-Encoding"] = coding
+    _weaken_etag(resp)
+    return resp
+
+
+_LOG_REDACTED_QUERY_PARAMS = ("initData",)  # EventSource / GET clients pass their credentials here
+
+
+class _LoggedRequest:
+    """What the access log sees of a request: the same, minus credentials in the query string."""
+
+    def __init__(self, request: web.BaseRequest):
+        self._request = request
+        url = request.rel_url
+        hidden = [k for k in _LOG_REDACTED_QUERY_PARAMS if k in url.query]
+        self.path_qs = str(url.update_query({k: "redacted" for k in hidden})) if hidden else request.path_qs
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._request, name)
+
+
+class _SampledAccessLogger(web.AccessLogger):
+    """
+    Logs API_ACCESS_LOG_SAMPLE of requests, and always server errors and slow requests. Streams
+    (SSE) are open for minutes by design, so their duration doesn't make them "slow".
+    """
+
+    def log(self, request: web.BaseRequest, response: web.StreamResponse, time: float) -> None:
+        slow = time * 1000 >= API_SLOW_REQUEST_MS and isinstance(response, web.Response)
+        if response.status >= 500 or slow or random.random() < API_ACCESS_LOG_SAMPLE:
+            _http_stats["logged"] += 1
+            super().log(_LoggedRequest(request), response, time)
+
+
+class _RateLimiter:
+    """Token buckets keyed by (route class, user or IP); idle (full) buckets are dropped every minute."""
+
+    _PRUNE_EVERY_SEC = 60.0
+
+    def __init__(self, limits: Dict[str, Tuple[float, int]]):
+        self._limits = {cls: (per_min / 60.0, burst) for cls, (per_min, burst) in limits.items() if per_min > 0}
+        self._buckets: Dict[Tuple[str, str], _TokenBucket] = {}
+        self._last_prune = time.monotonic()
+        self.allowed = 0
+        self.limited: Dict[str, int] = collections.Counter()
+
+    def enabled(self, cls: Optional[str]) -> bool:
+        return cls in self._limits
+
+    def hit(self, cls: str, key: str) -> float:
+        """Takes a token; returns 0 if the request may go on, else seconds until it may retry."""
+        now = time.monotonic()
+        if now - self._last_prune >= self._PRUNE_EVERY_SEC:
+            self._last_prune = now
+            for k in [k for k, b in self._buckets.items() if b.idle(now)]:
+                del self._buckets[k]
+        bucket = self._buckets.get((cls, key))
+        if bucket is None:
+            rate, burst = self._limits[cls]
+            bucket = self._buckets[(cls, key)] = _TokenBucket(rate, burst)
+        wait = bucket.wait_time(now)
+        if wait > 0:
+            self.limited[cls] += 1
+            return wait
+        bucket.take(now)
+        self.allowed += 1
+        return 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        return {"allowed": self.allowed, "limited": dict(self.limited), "buckets": len(self._buckets)}
+
+
+_rate_limiter = _RateLimiter(
+    {
+        "write": (API_RATE_WRITE_PER_MIN, API_RATE_WRITE_BURST),
+        "read": (API_RATE_READ_PER_MIN, API_RATE_READ_BURST),
+    }
+)
+_register_metrics("rate_limit", _rate_limiter.stats)
+
+
+def _rate_class(path: str) -> Optional[str]:
+    """Route class for rate limiting; None = not limited (health, metrics, webhook)."""
+    for base in (API_BASE_PATH, ACCOUNTS_API_BASE_PATH):
+        if path.startswith(base + "/"):
+            tail = path[len(base) :]
+            if tail in ("/health", "/metrics"):
+                return None
+            return "write" if tail.startswith("/orders/create") else "read"
+    return None
+
+
+def _client_ip(request: web.Request) -> str:
+    if API_TRUST_PROXY:
+        forwarded = request.headers.get("X-Forwarded-For", "")
+        if forwarded:
+            return forwarded.rsplit(",", 1)[-1].strip()
+    return request.remote or ""
+
+
+def _rate_key(request: web.Request) -> str:
+    """
+    Validated user id when initData checks out (cached, so cheap), else the client IP. Only the
+    header and query are looked at, so limiting never reads the body.
+    """
+    init_data = request.query.get("initData") or request.headers.get("X-Tg-Init-Data", "")
+    if init_data:
+        accounts = request.path.startswith(ACCOUNTS_API_BASE_PATH + "/")
         try:
-            body = request.get("_json_body") or {}
-            init_data = str(body.get("initData") or "")
+            uid = (_user_id_from_init_accounts if accounts else _user_id_from_init)(init_data)
+            return f"u:{uid}"
         except Exception:
-            init_data = ""
-    return init_data
+            pass
+    return f"ip:{_client_ip(request)}"
 
 
 @web.middleware
-async def _json_mw(request: web.Request, handler):
-    if request.method in ("POST", "PUT", "PATCH"):
-        ct = request.headers.get("Content-Type", "")
-        if "application/json" in ct:
-            try:
-                request["_json_body"] = await request.json()
-            except Exception:
-                request["_json_body"] = {}
+async def _rate_limit_mw(request: web.Request, handler):
+    cls = _rate_class(request.path)
+    if _rate_limiter.enabled(cls):
+        wait = _rate_limiter.hit(cls, _rate_key(request))
+        if wait > 0:
+            retry_after = max(1, math.ceil(wait))
+            return await _api_json(
+                request,
+                {"ok": False, "error": "rate_limited", "retry_after": retry_after},
+                status=429,
+                headers={"Retry-After": str(retry_after)},
+            )
     return await handler(request)
 
 
@@ -2989,7 +5109,8 @@ async def _cors_mw(request: web.Request, handler):
     cors_headers = {
         "Access-Control-Allow-Origin": "*",
         "Access-Control-Allow-Methods": "GET,POST,OPTIONS",
-        "Access-Control-Allow-Headers": "Content-Type, X-Tg-Init-Data",
+        "Access-Control-Allow-Headers": "Content-Type, X-Tg-Init-Data, If-None-Match",
+        "Access-Control-Expose-Headers": "ETag, Retry-After",
         "Access-Control-Max-Age": "86400",
     }
     if request.method == "OPTIONS":
@@ -3007,6 +5128,13 @@ async def api_health(request: web.Request) -> web.Response:
     return await _api_json(request, {"ok": True, "ts": int(time.time())})
 
 
+async def api_metrics(request: web.Request) -> web.Response:
+    # Deny by default: queue depths and user counts are not for the public API
+    if not METRICS_TOKEN or not hmac.compare_digest(request.headers.get("X-Metrics-Token", ""), METRICS_TOKEN):
+        return await _api_json(request, {"ok": False, "error": "forbidden"}, status=403)
+    return await _api_json(request, {"ok": True, "ts": int(time.time()), "metrics": _collect_metrics()})
+
+
 async def api_meta(request: web.Request) -> web.Response:
     return await _api_json(
         request,
@@ -3018,62 +5146,289 @@ async def api_meta(request: web.Request) -> web.Response:
     )
 
 
+def _slim_order(o: Dict[str, Any]) -> Dict[str, Any]:
+    """Order list row for the WebApp."""
+    payload = o.get("order") or {}
+    return {
+        "order_id": o["order_id"],
+        "created_at": o["created_at"],
+        "category_name": o.get("category_name") or "—",
+        "status": o.get("status") or "new",
+        "link": payload.get("link") or payload.get("target") or payload.get("url") or "",
+    }
+
+
+def _discount_info(user_id: int) -> Dict[str, Any]:
+    discount_active = _is_discount_user(user_id)
+    discount_rate = float(DISCOUNT_RATE)
+    return {
+        "discount_active": discount_active,
+        "discount_rate": discount_rate,
+        "price_multiplier": discount_rate if discount_active else 1.0,
+    }
+
+
+def _orders_limit(body: Dict[str, Any]) -> int:
+    return max(1, min(200, int(body.get("limit") or 50)))
+
+
+def _field_mask(body: Dict[str, Any], allowed: Tuple[str, ...]) -> Tuple[str, ...]:
+    """Field mask: "fields" as a list or a comma-separated string; all sections by default."""
+    raw = body.get("fields")
+    if raw is None or raw == "":
+        return allowed
+    if isinstance(raw, str):
+        names = raw.split(",")
+    elif isinstance(raw, list) and all(isinstance(n, str) for n in raw):
+        names = raw
+    else:
+        raise _ApiError("bad_fields")
+    fields = tuple(dict.fromkeys(n.strip() for n in names if n.strip()))
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise _ApiError(f"unknown_fields:{','.join(unknown)}")
+    return fields
+
+
+async def _order_changes(
+    request: web.Request,
+    user_id_from_init: Callable[[str], int],
+    list_changes: Callable[..., Tuple[List[Dict[str, Any]], int, bool]],
+) -> web.Response:
+    """
+    GET .../orders/changes?since=<cursor>: orders created or changed after the cursor, so the
+    WebApp syncs in O(changes) instead of re-listing the history. No "since" = full sync. Keep
+    the returned cursor; while has_more is true, ask again right away.
+    """
+    try:
+        user_id = user_id_from_init(request.query.get("initData") or await _get_initdata_from_request(request))
+        raw_since = request.query.get("since", "").strip()
+        try:
+            since = int(raw_since) if raw_since else -1
+        except ValueError:
+            raise ValueError("bad_cursor")
+        limit = _orders_limit(dict(request.query))
+        not_modified, headers = _conditional(request, user_id, since, limit)
+        if not_modified:
+            return not_modified
+        orders, cursor, has_more = list_changes(user_id, since, limit)
+        return await _api_json(
+            request,
+            {"ok": True, "orders": [_slim_order(o) for o in orders], "cursor": str(cursor), "has_more": has_more},
+            headers=headers,
+        )
+    except Exception as e:
+        return await _api_error(request, e)
+
+
+_ORDER_BATCH_FIELDS = ("status", "created_at", "amount", "category_name", "order")
+
+
+def _order_ids(body: Dict[str, Any]) -> List[str]:
+    raw = body.get("order_ids")
+    if raw is None or isinstance(raw, str):
+        names = (raw or "").split(",")
+    elif isinstance(raw, list) and all(isinstance(n, (str, int)) and not isinstance(n, bool) for n in raw):
+        names = raw
+    else:
+        raise _ApiError("bad_order_ids")
+    ids = list(dict.fromkeys(str(n).strip() for n in names if str(n).strip()))
+    if not ids:
+        raise _ApiError("no_order_ids")
+    if len(ids) > API_ORDERS_BATCH_MAX:
+        raise _ApiError(f"too_many_order_ids:{API_ORDERS_BATCH_MAX}")
+    return ids
+
+
+async def _orders_batch(
+    request: web.Request,
+    user_id_from_init: Callable[[str], int],
+    get_orders: Callable[[int, List[str]], Dict[str, Dict[str, Any]]],
+) -> web.Response:
+    """
+    Status and detail for up to API_ORDERS_BATCH_MAX of the user's orders in one call, for the
+    WebApp's status polling. "fields" masks the per-order keys (order_id is always there); leave
+    out "order" to skip the heavy payload. Ids that aren't the user's come back in "missing".
+    """
+    try:
+        user_id = user_id_from_init(await _get_initdata_from_request(request))
+        body = await _request_body(request)
+        ids = _order_ids(body)
+        fields = _field_mask(body, _ORDER_BATCH_FIELDS)
+        not_modified, headers = _conditional(request, user_id, ids, fields)
+        if not_modified:
+            return not_modified
+        found = get_orders(user_id, ids)
+
+        orders: List[Dict[str, Any]] = []
+        for oid in ids:
+            row = found.get(oid)
+            if row is None:
+                continue
+            item: Dict[str, Any] = {"order_id": oid}
+            if "status" in fields:
+                item["status"] = row.get("status") or "new"
+            if "created_at" in fields:
+                item["created_at"] = row.get("created_at")
+            if "amount" in fields:
+                amount_k = int(row.get("amount_kopecks") or 0)
+                item["amount_kopecks"] = amount_k
+                item["amount_rub"] = f"{amount_k/100:.2f}"
+            if "category_name" in fields:
+                item["category_name"] = row.get("category_name") or "—"
+            if "order" in fields:
+                item["order"] = row.get("order") or {}
+            orders.append(item)
+        missing = [oid for oid in ids if oid not in found]
+        return await _api_json(request, {"ok": True, "orders": orders, "missing": missing}, headers=headers)
+    except Exception as e:
+        return await _api_error(request, e)
+
+
+async def _bootstrap(
+    request: web.Request,
+    user_id_from_init: Callable[[str], int],
+    list_orders: Callable[..., List[Dict[str, Any]]],
+    api_base: str,
+    allowed: Tuple[str, ...],
+) -> web.Response:
+    """
+    Everything the WebApp needs on open in one round trip: initData is validated once for all
+    sections. Only the sections named in the field mask are returned.
+    """
+    try:
+        user_id = user_id_from_init(await _get_initdata_from_request(request))
+        body = await _request_body(request)
+        fields = _field_mask(body, allowed)
+        not_modified, headers = _conditional(request, user_id, fields, _orders_limit(body))
+        if not_modified:
+            return not_modified
+        out: Dict[str, Any] = {"ok": True}
+        if "meta" in fields:
+            out["meta"] = {"main_bot_username": _MAIN_BOT_USERNAME or "", "api_base": api_base}
+        if "balance" in fields:
+            bal_k = _get_balance_kopecks(user_id)
+            out["balance"] = {"kopecks": bal_k, "rub": f"{bal_k/100:.2f}"}
+        if "discount" in fields:
+            out["discount"] = _discount_info(user_id)
+        if "orders" in fields:
+            out["orders"] = [_slim_order(o) for o in list_orders(user_id, limit=_orders_limit(body))]
+        return await _api_json(request, out, headers=headers)
+    except Exception as e:
+        return await _api_error(request, e)
+
+
+async def api_bootstrap(request: web.Request) -> web.Response:
+    return await _bootstrap(
+        request, _user_id_from_init, _list_orders, API_BASE_PATH, ("meta", "balance", "discount", "orders")
+    )
+
+
+def _sse(event: str, data: Dict[str, Any]) -> bytes:
+    return b"event: " + event.encode("utf-8") + b"\ndata: " + _json_dumpb(data) + b"\n\n"
+
+
+async def _events_stream(
+    request: web.Request, user_id_from_init: Callable[[str], int], api: str
+) -> web.StreamResponse:
+    """
+    Server-Sent Events: balance / order / order_status pushes for the user's open WebApp.
+    EventSource can't set headers, so initData may also come as ?initData=. Events published in
+    another process (BOT_WORKERS) don't reach this hub; the heartbeat compares the user's data
+    version and sends "changed" when it moved, so the client refetches at most one beat late.
+    """
+    try:
+        user_id = user_id_from_init(request.query.get("initData") or await _get_initdata_from_request(request))
+    except Exception as e:
+        return await _api_json(request, {"ok": False, "error": str(e)}, status=401)
+    if _events.connections >= EVENTS_MAX_CONNECTIONS:
+        return await _api_json(request, {"ok": False, "error": "too_many_connections"}, status=503)
+
+    resp = web.StreamResponse(
+        headers={
+            "Content-Type": "text/event-stream",
+            "Cache-Control": "no-cache",
+            "X-Accel-Buffering": "no",  # nginx: don't buffer the stream
+            "Access-Control-Allow-Origin": "*",
+        }
+    )
+    await resp.prepare(request)
+    queue = _events.subscribe(user_id, api)
+    try:
+        version = _get_user_version(user_id)
+        await resp.write(_sse("hello", {"version": version}))
+        while True:
+            try:
+                item = await asyncio.wait_for(queue.get(), timeout=EVENTS_HEARTBEAT_SEC)
+            except asyncio.TimeoutError:
+                current = _get_user_version(user_id)
+                if current != version:
+                    version = current
+                    await resp.write(_sse("changed", {"version": current}))
+                else:
+                    await resp.write(b": ping\n\n")
+                continue
+            if item is None:
+                break
+            event, data = item
+            version = max(version, int(data.get("version") or 0))
+            await resp.write(_sse(event, data))
+    except ConnectionResetError:
+        pass
+    finally:
+        _events.unsubscribe(user_id, queue)
+    return resp
+
+
+async def api_events(request: web.Request) -> web.StreamResponse:
+    return await _events_stream(request, _user_id_from_init, "main")
+
+
 async def api_balance(request: web.Request) -> web.Response:
     try:
-        init_data = _get_initdata_from_request(request)
+        init_data = await _get_initdata_from_request(request)
         user_id = _user_id_from_init(init_data)
+        not_modified, headers = _conditional(request, user_id)
+        if not_modified:
+            return not_modified
         bal_k = _get_balance_kopecks(user_id)
-        discount_active = _is_discount_user(user_id)
-        discount_rate = float(DISCOUNT_RATE)
-        price_multiplier = discount_rate if discount_active else 1.0
         return await _api_json(
             request,
-            {
-                "ok": True,
-                "balance_kopecks": bal_k,
-                "balance_rub": f"{bal_k/100:.2f}",
-                "discount_active": discount_active,
-                "discount_rate": discount_rate,
-                "price_multiplier": price_multiplier,
-            },
+            {"ok": True, "balance_kopecks": bal_k, "balance_rub": f"{bal_k/100:.2f}", **_discount_info(user_id)},
+            headers=headers,
         )
     except Exception as e:
-        return await _api_json(request, {"ok": False, "error": str(e)}, status=400)
+        return await _api_error(request, e)
 
 
 async def api_orders_list(request: web.Request) -> web.Response:
     try:
-        init_data = _get_initdata_from_request(request)
+        init_data = await _get_initdata_from_request(request)
         user_id = _user_id_from_init(init_data)
-        body = request.get("_json_body") or {}
-        limit = int(body.get("limit") or 50)
-        limit = max(1, min(200, limit))
+        body = await _request_body(request)
+        limit = _orders_limit(body)
+        not_modified, headers = _conditional(request, user_id, limit)
+        if not_modified:
+            return not_modified
         orders = _list_orders(user_id, limit=limit)
-        slim = [
-            {
-                "order_id": o["order_id"],
-                "created_at": o["created_at"],
-                "category_name": o.get("category_name") or "—",
-                "status": o.get("status") or "new",
-                "link": (
-                    (o.get("order") or {}).get("link")
-                    or (o.get("order") or {}).get("target")
-                    or (o.get("order") or {}).get("url")
-                    or ""
-                ),
-            }
-            for o in orders
-        ]
-        return await _api_json(request, {"ok": True, "orders": slim})
+        return await _api_json(request, {"ok": True, "orders": [_slim_order(o) for o in orders]}, headers=headers)
     except Exception as e:
-        return await _api_json(request, {"ok": False, "error": str(e)}, status=400)
+        return await _api_error(request, e)
+
+
+async def api_orders_changes(request: web.Request) -> web.Response:
+    return await _order_changes(request, _user_id_from_init, _list_order_changes)
+
+
+async def api_orders_batch(request: web.Request) -> web.Response:
+    return await _orders_batch(request, _user_id_from_init, _get_orders)
 
 
 async def api_orders_detail(request: web.Request) -> web.Response:
     try:
-        init_data = _get_initdata_from_request(request)
+        init_data = await _get_initdata_from_request(request)
         user_id = _user_id_from_init(init_data)
-        body = request.get("_json_body") or {}
+        body = await _request_body(request)
         order_id = str(body.get("order_id") or "").strip()
         if not order_id:
             raise ValueError("no_order_id")
@@ -3095,23 +5450,20 @@ async def api_orders_detail(request: web.Request) -> web.Response:
             },
         )
     except Exception as e:
-        return await _api_json(request, {"ok": False, "error": str(e)}, status=400)
+        return await _api_error(request, e)
 
 
-async def _send_order_notifications(user_id: int, order: Dict[str, Any], amount_kopecks: int, balance_after: int) -> None:
-    """Sends order confirmation to user and manager via the main bot."""
+def _enqueue_order_notifications(user_id: int, order: Dict[str, Any], amount_kopecks: int, balance_after: int) -> None:
+    """Queues order confirmation to user and manager (sent via the main bot by the outbox)."""
 
     # User confirmation must be sent from the main bot.
-    try:
-        text_user = f"""✅ <b>Покупка оформлена</b>
+    text_user = f"""✅ <b>Покупка оформлена</b>
 
 {_order_text_block(order)}
 
 Списано: <b>{_format_rub_from_kopecks(amount_kopecks)}</b>
 Баланс: <b>{_format_rub_from_kopecks(balance_after)}</b>"""
-        await bot.send_message(user_id, text_user, parse_mode=ParseMode.HTML, disable_web_page_preview=True)
-    except Exception as e:
-        logger.warning(f"Order notify to user failed: {e}")
+    _outbox_enqueue(user_id, text_user, priority=SEND_PRIORITY_PAYMENT)
 
     text_mgr = f"""🧾 <b>Новый заказ</b>
 
@@ -3123,55 +5475,130 @@ async def _send_order_notifications(user_id: int, order: Dict[str, Any], amount_
     _notify_manager_bg(text_mgr, reply_markup=_mgr_confirm_kb(order_id))
 
 
-async def api_orders_create(request: web.Request) -> web.Response:
-    """Creates order and debits balance atomically from DB.
-
-    Returns:
-      result=success + order_id + balance_rub
-      result=insufficient + need_rub + balance_rub
+class _IdempotencyCache:
+    """
+    Response cache for retried requests. A finished request's exact response (status + body) is
+    replayed for the same key until the TTL runs out; a duplicate arriving while the first one is
+    still running waits for it and gets the same response instead of running the handler again.
+    Only responses `keep` accepts are stored, the rest are shared with concurrent duplicates only.
     """
+
+    def __init__(self, ttl: int, max_keys: int, keep: Callable[[int, bytes], bool]):
+        self._ttl = int(ttl)
+        self._keep = keep
+        self._done = _MemoryStateStore(max_keys)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.replayed = 0
+        self.collapsed = 0
+        self.stored = 0
+
+    @staticmethod
+    def _replay(entry: Tuple[int, bytes]) -> web.Response:
+        status, body = entry
+        return web.Response(
+            body=body,
+            status=status,
+            headers={"Idempotent-Replayed": "true"},
+            content_type="application/json",
+            charset="utf-8",
+        )
+
+    async def run(self, key: str, handler: Callable[[], Awaitable[web.Response]]) -> web.Response:
+        while True:
+            entry = self._done.get(key)
+            if entry is not None:
+                self.replayed += 1
+                return self._replay(entry)
+            fut = self._inflight.get(key)
+            if fut is None:
+                break
+            self.collapsed += 1
+            try:
+                return self._replay(await asyncio.shield(fut))
+            except asyncio.CancelledError:
+                if not fut.cancelled():
+                    raise
+                # The request we waited for was cancelled: run it ourselves
+
+        fut = asyncio.get_running_loop().create_future()
+        fut.add_done_callback(lambda f: f.cancelled() or f.exception())
+        self._inflight[key] = fut
+        try:
+            resp = await handler()
+            entry = (resp.status, bytes(resp.body or b""))
+            if self._ttl > 0 and self._keep(*entry):
+                self._done.set(key, entry, self._ttl)
+                self.stored += 1
+            fut.set_result(entry)
+            return resp
+        except Exception as e:
+            fut.set_exception(e)
+            raise
+        finally:
+            if not fut.done():
+                fut.cancel()
+            if self._inflight.get(key) is fut:
+                del self._inflight[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "replayed": self.replayed,
+            "collapsed": self.collapsed,
+            "stored": self.stored,
+            "in_flight": len(self._inflight),
+            **self._done.stats(),
+        }
+
+
+def _is_order_success(status: int, body: bytes) -> bool:
+    # "insufficient" must not be replayed: the retry after a top-up has to go through
     try:
-        init_data = _get_initdata_from_request(request)
-        user_id = _user_id_from_init(init_data)
-        body = request.get("_json_body") or {}
-        order_in = body.get("order") if isinstance(body.get("order"), dict) else {}
-        pay_method = str(body.get("pay_method") or "balance")
+        return status == 200 and _json_loads(body).get("result") == "success"
+    except Exception:
+        return False
 
-        if pay_method != "balance":
-            raise ValueError("unsupported_pay_method")
 
-        # Normalize order and amount
-        order_norm = _build_order_from_webapp(order_in)
-        final_order_id = str(order_norm.get("order_id") or "").strip() or uuid.uuid4().hex
-        order_norm["order_id"] = final_order_id
+_order_idempotency = _IdempotencyCache(ORDER_IDEMPOTENCY_TTL_SEC, ORDER_IDEMPOTENCY_CACHE_SIZE, _is_order_success)
+_register_metrics("order_idempotency", _order_idempotency.stats)
 
-        # Idempotency: if the same order_id was already processed, do not debit again
-        if _is_order_processed(final_order_id):
-            bal_k = _get_balance_kopecks(user_id)
-            return await _api_json(
-                request,
-                {
-                    "ok": True,
-                    "result": "success",
-                    "order_id": final_order_id,
-                    "balance_kopecks": bal_k,
-                    "balance_rub": f"{bal_k/100:.2f}",
-                },
-            )
 
+async def _debit_and_create_order(
+    request: web.Request, user_id: int, order_norm: Dict[str, Any], discount_applied: bool
+) -> web.Response:
+    """
+    Pays order_norm from the user's balance and records it; the body of both orders/create
+    endpoints, run under _order_idempotency.
+    """
+    order_id = order_norm["order_id"]
+    # Per-user lock: parallel requests of this process queue here instead of on the DB
+    async with _balance_lock(user_id):
         total_rub = _parse_decimal_rub(order_norm.get("total_price"))
         amount_kopecks = int((total_rub * 100).to_integral_value())
         if amount_kopecks <= 0:
             raise ValueError("bad_amount")
 
-        discount_applied = bool(body.get("discount_applied") or order_in.get("discount_applied"))
         amount_kopecks = _apply_discount_kopecks(user_id, amount_kopecks, discount_applied=discount_applied)
         if _is_discount_user(user_id):
             order_norm["discount_applied"] = True
             order_norm["total_price"] = _kopecks_to_rub_str(amount_kopecks)
 
-        ok, before, after = _try_debit_balance_kopecks(user_id, amount_kopecks)
-        if not ok:
+        try:
+            order_json = _json_dumps(order_norm)
+        except Exception:
+            order_json = "{}"
+
+        # Mark as processed, debit, create order record (paid, status "new") and queue
+        # notifications (user + manager) in one transaction, together with the
+        # referrer's reward: no other process can pay the same order in between,
+        # and a crash can't lose the credit.
+        with _db_transaction():
+            status, before, after = _pay_order_from_balance(user_id, order_id, amount_kopecks, order_json)
+            if status == "paid":
+                _create_order(user_id, order_norm, amount_kopecks)
+                _enqueue_order_notifications(user_id, order_norm, amount_kopecks, after)
+                _apply_referral_reward(user_id, order_id, amount_kopecks)
+
+        if status == "insufficient":
             need = max(0, amount_kopecks - before)
             need_rub = int((need + 99) // 100)
             return await _api_json(
@@ -3185,39 +5612,47 @@ async def api_orders_create(request: web.Request) -> web.Response:
                 },
             )
 
-        # Mark as processed (idempotency/audit)
-        try:
-            order_json = json.dumps(order_norm, ensure_ascii=False)
-        except Exception:
-            order_json = "{}"
-        _mark_order_processed(final_order_id, user_id, amount_kopecks, order_json)
-
-        # Create order record (paid) and default status "new"
-        _create_order(user_id, order_norm, amount_kopecks)
-
-        # Send notifications (user + manager)
-        try:
-            await _send_order_notifications(user_id, order_norm, amount_kopecks, after)
-        except Exception:
-            pass
-
-        try:
-            await _apply_referral_reward(user_id, final_order_id, amount_kopecks)
-        except Exception:
-            pass
-
+        # "duplicate": the same order_id was already paid, nothing debited again
         return await _api_json(
             request,
             {
                 "ok": True,
                 "result": "success",
-                "order_id": final_order_id,
+                "order_id": order_id,
                 "balance_kopecks": after,
                 "balance_rub": f"{after/100:.2f}",
             },
         )
+
+
+async def api_orders_create(request: web.Request) -> web.Response:
+    """Creates order and debits balance atomically from DB.
+
+    Returns:
+      result=success + order_id + balance_rub
+      result=insufficient + need_rub + balance_rub
+    """
+    try:
+        init_data = await _get_initdata_from_request(request)
+        user_id = _user_id_from_init(init_data)
+        body = await _request_body(request)
+        order_in = body.get("order") if isinstance(body.get("order"), dict) else {}
+        pay_method = str(body.get("pay_method") or "balance")
+
+        if pay_method != "balance":
+            raise ValueError("unsupported_pay_method")
+
+        # Normalize order and amount
+        order_norm = _build_order_from_webapp(order_in)
+        final_order_id = str(order_norm.get("order_id") or "").strip() or uuid.uuid4().hex
+        order_norm["order_id"] = final_order_id
+
+        # Retries of the same order replay the first response; concurrent ones wait for it
+        discount_applied = bool(body.get("discount_applied") or order_in.get("discount_applied"))
+        debit_and_create = partial(_debit_and_create_order, request, user_id, order_norm, discount_applied)
+        return await _order_idempotency.run(f"main:{user_id}:{final_order_id}", debit_and_create)
     except Exception as e:
-        return await _api_json(request, {"ok": False, "error": str(e)}, status=400)
+        return await _api_error(request, e)
 
 
 async def api_accounts_health(request: web.Request) -> web.Response:
@@ -3235,52 +5670,61 @@ async def api_accounts_meta(request: web.Request) -> web.Response:
     )
 
 
+async def api_accounts_bootstrap(request: web.Request) -> web.Response:
+    return await _bootstrap(
+        request, _user_id_from_init_accounts, _list_orders_accounts, ACCOUNTS_API_BASE_PATH, ("meta", "balance", "orders")
+    )
+
+
+async def api_accounts_events(request: web.Request) -> web.StreamResponse:
+    return await _events_stream(request, _user_id_from_init_accounts, "accounts")
+
+
 async def api_accounts_balance(request: web.Request) -> web.Response:
     try:
-        init_data = _get_initdata_from_request(request)
+        init_data = await _get_initdata_from_request(request)
         user_id = _user_id_from_init_accounts(init_data)
+        not_modified, headers = _conditional(request, user_id)
+        if not_modified:
+            return not_modified
         bal_k = _get_balance_kopecks(user_id)
         return await _api_json(
             request,
             {"ok": True, "balance_kopecks": bal_k, "balance_rub": f"{bal_k/100:.2f}"},
+            headers=headers,
         )
     except Exception as e:
-        return await _api_json(request, {"ok": False, "error": str(e)}, status=400)
+        return await _api_error(request, e)
 
 
 async def api_accounts_orders_list(request: web.Request) -> web.Response:
     try:
-        init_data = _get_initdata_from_request(request)
+        init_data = await _get_initdata_from_request(request)
         user_id = _user_id_from_init_accounts(init_data)
-        body = request.get("_json_body") or {}
-        limit = int(body.get("limit") or 50)
-        limit = max(1, min(200, limit))
+        body = await _request_body(request)
+        limit = _orders_limit(body)
+        not_modified, headers = _conditional(request, user_id, limit)
+        if not_modified:
+            return not_modified
         orders = _list_orders_accounts(user_id, limit=limit)
-        slim = [
-            {
-                "order_id": o["order_id"],
-                "created_at": o["created_at"],
-                "category_name": o.get("category_name") or "—",
-                "status": o.get("status") or "new",
-                "link": (
-                    (o.get("order") or {}).get("link")
-                    or (o.get("order") or {}).get("target")
-                    or (o.get("order") or {}).get("url")
-                    or ""
-                ),
-            }
-            for o in orders
-        ]
-        return await _api_json(request, {"ok": True, "orders": slim})
+        return await _api_json(request, {"ok": True, "orders": [_slim_order(o) for o in orders]}, headers=headers)
     except Exception as e:
-        return await _api_json(request, {"ok": False, "error": str(e)}, status=400)
+        return await _api_error(request, e)
+
+
+async def api_accounts_orders_changes(request: web.Request) -> web.Response:
+    return await _order_changes(request, _user_id_from_init_accounts, _list_order_changes_accounts)
+
+
+async def api_accounts_orders_batch(request: web.Request) -> web.Response:
+    return await _orders_batch(request, _user_id_from_init_accounts, _get_orders_accounts)
 
 
 async def api_accounts_orders_detail(request: web.Request) -> web.Response:
     try:
-        init_data = _get_initdata_from_request(request)
+        init_data = await _get_initdata_from_request(request)
         user_id = _user_id_from_init_accounts(init_data)
-        body = request.get("_json_body") or {}
+        body = await _request_body(request)
         order_id = str(body.get("order_id") or "").strip()
         if not order_id:
             raise ValueError("no_order_id")
@@ -3302,15 +5746,15 @@ async def api_accounts_orders_detail(request: web.Request) -> web.Response:
             },
         )
     except Exception as e:
-        return await _api_json(request, {"ok": False, "error": str(e)}, status=400)
+        return await _api_error(request, e)
 
 
 async def api_accounts_orders_create(request: web.Request) -> web.Response:
     """Creates accounts order and debits balance atomically from DB."""
     try:
-        init_data = _get_initdata_from_request(request)
+        init_data = await _get_initdata_from_request(request)
         user_id = _user_id_from_init_accounts(init_data)
-        body = request.get("_json_body") or {}
+        body = await _request_body(request)
         order_in = body.get("order") if isinstance(body.get("order"), dict) else {}
         pay_method = str(body.get("pay_method") or "balance")
 
@@ -3323,101 +5767,529 @@ async def api_accounts_orders_create(request: web.Request) -> web.Response:
         final_order_id = str(order_norm.get("order_id") or "").strip() or uuid.uuid4().hex
         order_norm["order_id"] = final_order_id
 
-        # Idempotency: if the same order_id was already processed, do not debit again
-        if _is_order_processed(final_order_id):
-            bal_k = _get_balance_kopecks(user_id)
-            return await _api_json(
-                request,
-                {
-                    "ok": True,
-                    "result": "success",
-                    "order_id": final_order_id,
-                    "balance_kopecks": bal_k,
-                    "balance_rub": f"{bal_k/100:.2f}",
-                },
-            )
+        # Retries of the same order replay the first response; concurrent ones wait for it
+        discount_applied = bool(body.get("discount_applied") or order_in.get("discount_applied"))
+        debit_and_create = partial(_debit_and_create_order, request, user_id, order_norm, discount_applied)
+        return await _order_idempotency.run(f"accounts:{user_id}:{final_order_id}", debit_and_create)
+    except Exception as e:
+        return await _api_error(request, e)
 
-        total_rub = _parse_decimal_rub(order_norm.get("total_price"))
-        amount_kopecks = int((total_rub * 100).to_integral_value())
-        if amount_kopecks <= 0:
-            raise ValueError("bad_amount")
+# =========================
+# UPDATE SCHEDULER
+# =========================
+class _UpdateScheduler:
+    """
+    Runs update handlers with at most `concurrency` in flight. Every user has a FIFO queue and
+    only its head competes for a slot, so two quick taps of one user never race and a user with
+    a backlog doesn't occupy slots other users could use. submit() waits while `max_pending`
+    updates are queued, which slows down whatever feeds the scheduler.
+    """
 
-        discount_applied = bool(body.get("discount_applied") or order_in.get("discount_applied"))
-        amount_kopecks = _apply_discount_kopecks(user_id, amount_kopecks, discount_applied=discount_applied)
-        if _is_discount_user(user_id):
-            order_norm["discount_applied"] = True
-            order_norm["total_price"] = _kopecks_to_rub_str(amount_kopecks)
+    def __init__(self, concurrency: int, max_pending: int):
+        self._concurrency = max(1, int(concurrency))
+        self._admit = asyncio.Semaphore(max(1, int(max_pending)))
+        self._queues: Dict[Any, "collections.deque"] = {}
+        self._ready: Optional[asyncio.Queue] = None  # keys whose head is waiting for a slot
+        self._workers: List[asyncio.Task] = []
+        self._waits: "collections.deque[float]" = collections.deque(maxlen=2048)
+        self.queued = 0
+        self.in_flight = 0
+        self.max_queued = 0
+        self.processed = 0
+        self.failed = 0
+
+    def _start(self) -> None:
+        if self._ready is None:
+            self._ready = asyncio.Queue()
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self._concurrency)]
+
+    async def submit(self, key: Any, factory: Callable[[], Any]) -> asyncio.Future:
+        """Queues factory() behind earlier updates of `key`; the future resolves when it finished."""
+        self._start()
+        await self._admit.acquire()
+        fut = asyncio.get_running_loop().create_future()
+        queue = self._queues.get(key)
+        if queue is None:
+            queue = self._queues[key] = collections.deque()
+            self._ready.put_nowait(key)
+        queue.append((time.monotonic(), factory, fut))
+        self.queued += 1
+        self.max_queued = max(self.max_queued, self.queued)
+        return fut
+
+    async def _worker(self) -> None:
+        while True:
+            key = await self._ready.get()
+            queue = self._queues[key]
+            enqueued_at, factory, fut = queue.popleft()
+            self.queued -= 1
+            self.in_flight += 1
+            self._waits.append(time.monotonic() - enqueued_at)
+            result = None
+            try:
+                result = await factory()
+                self.processed += 1
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"Update handler error ({key}): {e}")
+            finally:
+                self.in_flight -= 1
+                self._admit.release()
+                if not fut.done():
+                    fut.set_result(result)
+                if queue:
+                    self._ready.put_nowait(key)
+                else:
+                    self._queues.pop(key, None)
+
+    async def drain(self, timeout: float) -> bool:
+        """Waits for queued and running updates; False if some were still left at the timeout."""
+        deadline = time.monotonic() + timeout
+        while (self.queued or self.in_flight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        return not (self.queued or self.in_flight)
+
+    def stats(self) -> Dict[str, Any]:
+        waits = sorted(self._waits)
+
+        def _pct(q: float) -> float:
+            return round(waits[min(len(waits) - 1, int(len(waits) * q))] * 1000, 1) if waits else 0.0
+
+        return {
+            "concurrency": self._concurrency,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queued,
+            "max_queue_depth": self.max_queued,
+            "users_queued": len(self._queues),
+            "processed": self.processed,
+            "failed": self.failed,
+            "wait_ms_p50": _pct(0.5),
+            "wait_ms_p95": _pct(0.95),
+            "wait_ms_max": round(waits[-1] * 1000, 1) if waits else 0.0,
+        }
+
+
+_update_scheduler = _UpdateScheduler(UPDATE_CONCURRENCY, UPDATE_MAX_PENDING)
+_register_metrics("update_scheduler", _update_scheduler.stats)
+
+
+def _update_key(update: types.Update) -> Any:
+    uid = _update_user_id(update)
+    return uid if uid is not None else f"u{update.update_id}"
+
+
+def _update_raw(update: types.Update) -> Dict[str, Any]:
+    """The update as the Bot API sent it, for the pending-update store."""
+    return update.model_dump(mode="json", by_alias=True, exclude_unset=True)
+
+
+async def _schedule_update(update: types.Update) -> asyncio.Future:
+    """Polling mode: queues an update registered with _update_offsets.begin(); done() once it finished."""
+
+    async def _run() -> Any:
+        try:
+            return await dp.feed_update(bot, update)
+        finally:
+            _update_offsets.done(update.update_id)
 
-        ok, before, after = _try_debit_balance_kopecks(user_id, amount_kopecks)
+    return await _update_scheduler.submit(_update_key(update), _run)
+
+
+async def _schedule_raw_update(raw: Dict[str, Any], factory: Callable[[], Any]) -> asyncio.Future:
+    uid = _raw_update_user_id(raw)
+    return await _update_scheduler.submit(uid if uid is not None else f"u{raw.get('update_id')}", factory)
+
+
+async def _poll_updates() -> None:
+    """
+    Long polling for the in-process mode; every update goes through _update_scheduler. Each
+    getUpdates confirms everything fetched so far, so a stuck handler doesn't hold back other
+    users or turn the long poll into a busy loop; _update_offsets keeps the unfinished updates
+    for a restart instead.
+    """
+    allowed = dp.resolve_used_update_types()
+    offset = _update_offsets.next_offset()
+    backoff = 1.0
+    while True:
+        try:
+            updates = await bot.get_updates(offset=offset, limit=100, timeout=25, allowed_updates=allowed)
+            backoff = 1.0
+        except Exception as e:
+            logger.error(f"Polling error: {e}; retry in {backoff:.0f}s")
+            await asyncio.sleep(backoff)
+            backoff = min(backoff * 2, 30.0)
+            continue
+        fresh = [update for update in updates if _update_offsets.is_new(update.update_id)]
+        _update_offsets.begin([_update_raw(update) for update in fresh])
+        for update in fresh:
+            await _schedule_update(update)
+        if updates:
+            offset = updates[-1].update_id + 1
+
+
+# =========================
+# WEBHOOK (BOT_DELIVERY=webhook)
+# =========================
+class _QueuedWebhookHandler(SimpleRequestHandler):
+    """
+    Answers Telegram as soon as the update is queued in _update_scheduler. When too many updates
+    are pending the answer waits, so Telegram (limited by max_connections) slows down.
+    """
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        secret_token: str = "",
+        route: Optional[Callable[[Dict[str, Any]], Any]] = None,
+    ):
+        if not secret_token:
+            # Without it anyone who finds WEBHOOK_PATH could post forged updates (e.g. successful_payment)
+            raise ValueError("webhook handler requires a secret token")
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token)
+        self._route = route  # BOT_WORKERS mode: hand the raw update to its worker process instead
+        self.received = 0
+        self.rejected = 0
+
+    def verify_secret(self, telegram_secret_token: str, bot: Bot) -> bool:
+        ok = bool(self.secret_token) and hmac.compare_digest(telegram_secret_token, self.secret_token)
         if not ok:
-            need = max(0, amount_kopecks - before)
-            need_rub = int((need + 99) // 100)
-            return await _api_json(
-                request,
-                {
-                    "ok": True,
-                    "result": "insufficient",
-                    "need_rub": need_rub,
-                    "balance_kopecks": before,
-                    "balance_rub": f"{before/100:.2f}",
-                },
+            self.rejected += 1
+        return ok
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        self.received += 1
+        if self._route is not None:
+            await self._route(update)
+        else:
+            await _schedule_raw_update(update, partial(self._background_feed_update, bot=bot, update=update))
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def close(self) -> None:
+        # Called on app shutdown. The bot session is shared with the outbox, so it stays open here.
+        await _update_scheduler.drain(timeout=5)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"received": self.received, "rejected": self.rejected}
+
+
+_webhook_handler: Optional[_QueuedWebhookHandler] = None
+
+
+def _check_webhook_config() -> None:
+    if not WEBHOOK_URL:
+        raise RuntimeError("BOT_DELIVERY=webhook requires WEBHOOK_URL")
+    if not re.fullmatch(r"[A-Za-z0-9_-]{1,256}", WEBHOOK_SECRET):
+        raise RuntimeError("BOT_DELIVERY=webhook requires WEBHOOK_SECRET (1-256 characters: A-Z a-z 0-9 _ -)")
+
+
+async def _setup_webhook(route: Optional[Callable[[Dict[str, Any]], Any]] = None) -> None:
+    global _webhook_handler
+    _check_webhook_config()
+    _webhook_handler = _QueuedWebhookHandler(dp, bot, secret_token=WEBHOOK_SECRET, route=route)
+    _register_metrics("webhook", _webhook_handler.stats)
+
+
+# =========================
+# UPDATE OFFSET (polling restarts)
+# =========================
+_UPDATE_OFFSET_KEY = "tg_update_offset"  # settings: next getUpdates offset
+_UPDATE_PENDING_PREFIX = "tg_update:"  # kv_state: raw JSON of a fetched update until it finished
+_UPDATE_REPLAY_FROM_KEY = "tg_update_replay_from"  # kv_state: lowest unfinished update_id
+_UPDATE_PENDING_TTL_SEC = 24 * 3600  # Telegram itself keeps undelivered updates for a day
+
+
+def _pending_updates_save(updates: List[Dict[str, Any]]) -> None:
+    """Stores fetched updates in one transaction, before getUpdates lets Telegram forget them."""
+    if not updates:
+        return
+    expires_at = int(time.time()) + _UPDATE_PENDING_TTL_SEC
+    rows = [(f"{_UPDATE_PENDING_PREFIX}{int(u['update_id'])}", _json_dumps(u), expires_at) for u in updates]
+    with _db_transaction():
+        if _DB_KIND == "mysql":
+            for row in rows:
+                _db_exec(
+                    "INSERT INTO kv_state (`key`, value, expires_at) VALUES (%s, %s, %s) "
+                    "ON DUPLICATE KEY UPDATE value=VALUES(value), expires_at=VALUES(expires_at)",
+                    row,
+                )
+        else:
+            _conn.executemany(
+                "INSERT INTO kv_state (key, value, expires_at) VALUES (?, ?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value=excluded.value, expires_at=excluded.expires_at",
+                rows,
+            )
+
+
+def _pending_updates_finish(update_ids: List[int], replay_from: Optional[int]) -> None:
+    """Forgets finished updates and records the lowest unfinished update_id."""
+    keys = [(f"{_UPDATE_PENDING_PREFIX}{int(i)}",) for i in update_ids]
+    replay = (_UPDATE_REPLAY_FROM_KEY, str(int(replay_from)), int(time.time()) + _UPDATE_PENDING_TTL_SEC)
+    if _DB_KIND == "mysql":
+        for key in keys:
+            _db_exec("DELETE FROM kv_state WHERE `key`=%s", key)
+        if replay_from is not None:
+            _db_exec(
+                "INSERT INTO kv_state (`key`, value, expires_at) VALUES (%s, %s, %s) "
+                "ON DUPLICATE KEY UPDATE value=VALUES(value), expires_at=VALUES(expires_at)",
+                replay,
             )
+        _db_commit()
+    else:
+        with _db_lock:
+            _conn.executemany("DELETE FROM kv_state WHERE key=?", keys)
+            if replay_from is not None:
+                _conn.execute(
+                    "INSERT INTO kv_state (key, value, expires_at) VALUES (?, ?, ?) "
+                    "ON CONFLICT(key) DO UPDATE SET value=excluded.value, expires_at=excluded.expires_at",
+                    replay,
+                )
+            _db_commit()
+
 
-        # Mark as processed (idempotency/audit)
+def _pending_updates_load() -> List[Dict[str, Any]]:
+    """Stored updates from tg_update_replay_from on, oldest first: what the last run didn't finish."""
+    now = int(time.time())
+    # Key range instead of LIKE, so the primary key index is used (";" follows ":")
+    lo, hi = _UPDATE_PENDING_PREFIX, _UPDATE_PENDING_PREFIX[:-1] + ";"
+    if _DB_KIND == "mysql":
+        rows = _db_fetchall(
+            "SELECT value FROM kv_state WHERE `key`>=%s AND `key`<%s AND expires_at>%s", (lo, hi, now)
+        )
+        mark = _db_fetchone("SELECT value FROM kv_state WHERE `key`=%s", (_UPDATE_REPLAY_FROM_KEY,))
+    else:
+        with _db_lock:
+            rows = _conn.execute(
+                "SELECT value FROM kv_state WHERE key>=? AND key<? AND expires_at>?", (lo, hi, now)
+            ).fetchall()
+            mark = _conn.execute("SELECT value FROM kv_state WHERE key=?", (_UPDATE_REPLAY_FROM_KEY,)).fetchone()
+    replay_from = int(mark[0]) if mark else 0
+    updates = []
+    for (value,) in rows:
         try:
-            order_json = json.dumps(order_norm, ensure_ascii=False)
-        except Exception:
-            order_json = "{}"
-        _mark_order_processed(final_order_id, user_id, amount_kopecks, order_json)
+            update = _json_loads(value)
+            if int(update["update_id"]) >= replay_from:
+                updates.append(update)
+        except Exception as e:
+            logger.warning(f"Stored update skipped: {e}")
+    updates.sort(key=lambda u: int(u["update_id"]))
+    return updates
+
+
+def _update_user_id(update: types.Update) -> Optional[int]:
+    """User (or chat) an update belongs to; updates of one user must be handled in order."""
+    try:
+        event = update.event
+    except Exception:
+        return None
+    user = getattr(event, "from_user", None)
+    if user is not None:
+        return int(user.id)
+    chat = getattr(event, "chat", None)
+    if chat is not None:
+        return int(chat.id)
+    return None
+
+
+def _raw_update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """Same as _update_user_id() for an update that is still a raw dict."""
+    for key, event in update.items():
+        if key == "update_id" or not isinstance(event, dict):
+            continue
+        user = event.get("from") or event.get("user")
+        if isinstance(user, dict) and user.get("id") is not None:
+            return int(user["id"])
+        chat = event.get("chat")
+        if isinstance(chat, dict) and chat.get("id") is not None:
+            return int(chat["id"])
+    return None
+
 
-        # Create order record (paid) and default status "new"
-        _create_order(user_id, order_norm, amount_kopecks)
+class _UpdateOffsetTracker:
+    """
+    Polling bookkeeping. getUpdates always asks for the update after the newest one fetched, so
+    a slow handler never holds back anyone else's updates. Telegram forgets what it confirmed,
+    so every fetched update is kept in kv_state from begin() until it finished; a restart
+    replays those (at-least-once: one that was running at a crash is handled again).
+    """
 
-        # Send notifications (user + manager)
+    def __init__(self, flush_interval: float = 1.0):
+        self._pending: set = set()
+        self._pending_heap: List[int] = []  # lazily pruned; its head is the oldest pending update
+        self._finished: List[int] = []  # done, still stored until the next flush
+        self._max_seen = 0
+        self._saved: Optional[int] = None
+        self._saved_replay_from: Optional[int] = None
+        self._last_flush = 0.0
+        self._flush_interval = flush_interval
+        self.replayed = 0
+
+    def load(self) -> List[Dict[str, Any]]:
+        """Reads the persisted offset; returns the updates the last run left unfinished, oldest first."""
+        raw = _get_setting(_UPDATE_OFFSET_KEY)
         try:
-            await _send_order_notifications(user_id, order_norm, amount_kopecks, after)
+            self._saved = int(raw) if raw else None
         except Exception:
-            pass
+            self._saved = None
+        updates = _pending_updates_load()
+        # Everything below the saved offset was fetched already (and confirmed to Telegram)
+        if self._saved:
+            self._max_seen = max(self._max_seen, self._saved - 1)
+        if updates:
+            self._max_seen = max(self._max_seen, int(updates[-1]["update_id"]))
+            self.replayed += len(updates)
+        return updates
+
+    def next_offset(self) -> Optional[int]:
+        """getUpdates offset: right after the newest update fetched, finished or not."""
+        return self._max_seen + 1 if self._max_seen else self._saved
+
+    def is_new(self, update_id: int) -> bool:
+        """False for an update that was already fetched (e.g. replayed, then returned again)."""
+        return int(update_id) > self._max_seen
+
+    def begin(self, updates: List[Dict[str, Any]], stored: bool = False) -> None:
+        """Marks raw updates pending; stores them first unless they come from the store (replay)."""
+        if not stored:
+            _pending_updates_save(updates)
+        for update in updates:
+            update_id = int(update["update_id"])
+            self._pending.add(update_id)
+            heapq.heappush(self._pending_heap, update_id)
+            self._max_seen = max(self._max_seen, update_id)
+
+    def _oldest(self) -> Optional[int]:
+        heap = self._pending_heap
+        while heap and heap[0] not in self._pending:
+            heapq.heappop(heap)
+        return heap[0] if heap else None
+
+    def done(self, update_id: int) -> None:
+        self._pending.discard(int(update_id))
+        self._finished.append(int(update_id))
+        if time.monotonic() - self._last_flush >= self._flush_interval:
+            self.flush()
+
+    def flush(self) -> None:
+        """Drops finished updates from the store and saves the offset and the replay mark."""
+        self._last_flush = time.monotonic()
+        offset = self.next_offset()
+        oldest = self._oldest()
+        replay_from = oldest if oldest is not None else offset
+        if not self._finished and offset == self._saved and replay_from == self._saved_replay_from:
+            return
+        finished, self._finished = self._finished, []
+        try:
+            with _db_transaction():
+                _pending_updates_finish(finished, replay_from)
+                if offset is not None and offset != self._saved:
+                    _set_setting(_UPDATE_OFFSET_KEY, str(offset))
+            self._saved = offset
+            self._saved_replay_from = replay_from
+        except Exception as e:
+            self._finished.extend(finished)
+            logger.warning(f"Update offset persist error: {e}")
 
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "saved_offset": self._saved,
+            "oldest_pending": self._oldest(),
+            "pending": len(self._pending),
+            "last_seen": self._max_seen,
+            "replayed": self.replayed,
+        }
+
+
+_update_offsets = _UpdateOffsetTracker()
+_register_metrics("update_offset", _update_offsets.stats)
+
+
+async def _drain_update_backlog() -> None:
+    """
+    Replays the updates the last run fetched but did not finish, then fetches everything queued
+    while the bot was down, starting from the persisted offset. Pages are stored and confirmed
+    as they come, not after they were handled, so one stuck handler doesn't hold back the
+    backlog; the drain rate is logged once all of it was handled.
+    """
+    stored = _update_offsets.load()
+    offset = _update_offsets.next_offset()
+    try:
+        pending = (await bot.get_webhook_info()).pending_update_count
+    except Exception:
+        pending = None
+    logger.info(f"Update backlog: {pending if pending is not None else '?'} pending, resuming from offset {offset}")
+    allowed = dp.resolve_used_update_types()
+    started = time.monotonic()
+    futures: List[asyncio.Future] = []
+    if stored:
+        # Fetched by the last run but not finished: Telegram won't return them again
+        logger.warning(f"Replaying {len(stored)} updates the previous run did not finish")
+        _update_offsets.begin(stored, stored=True)
+        for raw in stored:
+            futures.append(await _schedule_update(types.Update.model_validate(raw, context={"bot": bot})))
+    while True:
         try:
-            await _apply_referral_reward(user_id, final_order_id, amount_kopecks)
-        except Exception:
-            pass
+            updates = await bot.get_updates(offset=offset, limit=100, timeout=0, allowed_updates=allowed)
+        except Exception as e:
+            logger.error(f"Backlog fetch error: {e}")
+            break
+        if not updates:
+            break
+        fresh = [update for update in updates if _update_offsets.is_new(update.update_id)]
+        _update_offsets.begin([_update_raw(update) for update in fresh])
+        for update in fresh:
+            futures.append(await _schedule_update(update))
+        offset = updates[-1].update_id + 1
+    if not futures:
+        return
+    total = len(futures)
+
+    def _report(_: asyncio.Future) -> None:
+        elapsed = max(time.monotonic() - started, 1e-6)
+        logger.info(f"Update backlog drained: {total} updates in {elapsed:.1f}s ({total / elapsed:.1f} updates/s)")
+
+    asyncio.gather(*futures).add_done_callback(_report)
 
-        return await _api_json(
-            request,
-            {
-                "ok": True,
-                "result": "success",
-                "order_id": final_order_id,
-                "balance_kopecks": after,
-                "balance_rub": f"{after/100:.2f}",
-            },
-        )
-    except Exception as e:
-        return await _api_json(request, {"ok": False, "error": str(e)}, status=400)
 
 async def start_api_server() -> web.AppRunner:
-    app = web.Application(middlewares=[_cors_mw, _json_mw])
+    app = web.Application(middlewares=[_compress_mw, _cors_mw, _rate_limit_mw], client_max_size=API_MAX_BODY_BYTES)
     base = API_BASE_PATH
     base_accounts = ACCOUNTS_API_BASE_PATH
 
     app.router.add_get(f"{base}/health", api_health)
+    app.router.add_get(f"{base}/metrics", api_metrics)
+    app.router.add_post(f"{base}/bootstrap", api_bootstrap)
+    app.router.add_get(f"{base}/events", api_events)
     app.router.add_post(f"{base}/meta", api_meta)
     app.router.add_post(f"{base}/balance", api_balance)
     app.router.add_post(f"{base}/orders/list", api_orders_list)
     app.router.add_post(f"{base}/orders/detail", api_orders_detail)
+    app.router.add_post(f"{base}/orders/batch", api_orders_batch)
+    app.router.add_get(f"{base}/orders/changes", api_orders_changes)
     app.router.add_post(f"{base}/orders/create", api_orders_create)
 
     # Accounts WebApp (separate orders)
     app.router.add_get(f"{base_accounts}/health", api_accounts_health)
+    app.router.add_post(f"{base_accounts}/bootstrap", api_accounts_bootstrap)
+    app.router.add_get(f"{base_accounts}/events", api_accounts_events)
     app.router.add_post(f"{base_accounts}/meta", api_accounts_meta)
     app.router.add_post(f"{base_accounts}/balance", api_accounts_balance)
     app.router.add_post(f"{base_accounts}/orders/list", api_accounts_orders_list)
     app.router.add_post(f"{base_accounts}/orders/detail", api_accounts_orders_detail)
+    app.router.add_post(f"{base_accounts}/orders/batch", api_accounts_orders_batch)
+    app.router.add_get(f"{base_accounts}/orders/changes", api_accounts_orders_changes)
     app.router.add_post(f"{base_accounts}/orders/create", api_accounts_orders_create)
 
-    runner = web.AppRunner(app)
+    if _webhook_handler is not None:
+        _webhook_handler.register(app, path=WEBHOOK_PATH)
+
+    async def _close_event_streams(_app: web.Application) -> None:
+        _events.close_all()
+
+    app.on_shutdown.append(_close_event_streams)
+
+    runner = web.AppRunner(app, keepalive_timeout=API_KEEPALIVE_SEC, access_log_class=_SampledAccessLogger)
     await runner.setup()
     site = web.TCPSite(runner, API_HOST, API_PORT)
     await site.start()
@@ -3425,21 +6297,268 @@ async def start_api_server() -> web.AppRunner:
     return runner
 
 
+# =========================
+# WORKERS (BOT_WORKERS > 0)
+# =========================
+class _WorkerPool:
+    """
+    Supervisor side: `main.py --worker i` processes fed with NDJSON updates over stdin. A worker
+    writes the update_id of every update it finished to stdout; until then the supervisor keeps
+    the update and resends it to a restarted worker. When polling, the caller registers updates
+    with _update_offsets before routing them, and an ack marks them done there.
+    """
+
+    def __init__(self, size: int, track_offsets: bool = True):
+        self.size = max(1, int(size))
+        self._track_offsets = track_offsets  # polling only; with a webhook Telegram keeps no offset
+        self._procs: List[Optional[asyncio.subprocess.Process]] = [None] * self.size
+        self._locks = [asyncio.Lock() for _ in range(self.size)]
+        self._unacked: List[Dict[int, bytes]] = [{} for _ in range(self.size)]
+        self._readers: List[Optional[asyncio.Task]] = [None] * self.size
+        self._routed = [0] * self.size
+        self._acked = [0] * self.size
+        self._resent = 0
+        self._restarts = 0
+        self._stopping = False
+        self._monitor_task: Optional[asyncio.Task] = None
+
+    async def _spawn(self, index: int) -> None:
+        """Starts worker `index` and resends what its predecessor did not ack. Caller holds the lock."""
+        proc = await asyncio.create_subprocess_exec(
+            sys.executable,
+            os.path.abspath(__file__),
+            "--worker",
+            str(index),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+        )
+        self._procs[index] = proc
+        self._readers[index] = asyncio.create_task(self._read_acks(index, proc))
+        logger.info(f"Worker {index} started (pid {proc.pid})")
+        unacked = self._unacked[index]
+        if unacked:
+            logger.warning(f"Worker {index}: resending {len(unacked)} unfinished updates")
+            for update_id in sorted(unacked):
+                await self._write(index, unacked[update_id])
+            self._resent += len(unacked)
+
+    async def _read_acks(self, index: int, proc: asyncio.subprocess.Process) -> None:
+        while True:
+            line = await proc.stdout.readline()
+            if not line:
+                return
+            try:
+                update_id = int(line)
+            except ValueError:
+                logger.warning(f"Worker {index}: unexpected output {line[:100]!r}")
+                continue
+            if self._unacked[index].pop(update_id, None) is not None:
+                self._acked[index] += 1
+                if self._track_offsets:
+                    _update_offsets.done(update_id)
+
+    async def _write(self, index: int, line: bytes) -> bool:
+        proc = self._procs[index]
+        if proc is None or proc.returncode is not None or proc.stdin is None:
+            return False
+        try:
+            proc.stdin.write(line)
+            await proc.stdin.drain()
+            return True
+        except (BrokenPipeError, ConnectionResetError) as e:
+            logger.warning(f"Worker {index} pipe error: {e}")
+            return False
+
+    async def start(self) -> None:
+        for i in range(self.size):
+            async with self._locks[i]:
+                await self._spawn(i)
+        self._monitor_task = asyncio.create_task(self._monitor())
+
+    async def _monitor(self) -> None:
+        while not self._stopping:
+            await asyncio.sleep(1)
+            for i, proc in enumerate(self._procs):
+                if proc is not None and proc.returncode is not None and not self._stopping:
+                    logger.error(f"Worker {i} exited with code {proc.returncode}, restarting")
+                    self._restarts += 1
+                    async with self._locks[i]:
+                        await self._spawn(i)
+
+    def shard(self, key: int) -> int:
+        return hash(key) % self.size
+
+    async def route(self, update: Dict[str, Any]) -> None:
+        """
+        Sends the update to the worker that owns its user, so one user's updates stay in order.
+        Nothing is dropped: if the worker is down the update waits in _unacked and goes to its
+        replacement. A full pipe (the worker's scheduler is saturated) makes this wait.
+        """
+        update_id = int(update["update_id"])
+        uid = _raw_update_user_id(update)
+        index = self.shard(uid if uid is not None else update_id)
+        line = _json_dumpb(update) + b"\n"
+        async with self._locks[index]:
+            self._unacked[index][update_id] = line
+            self._routed[index] += 1
+            await self._write(index, line)
+
+    async def stop(self, timeout: float = 15) -> None:
+        self._stopping = True
+        if self._monitor_task:
+            self._monitor_task.cancel()
+        for proc in self._procs:
+            if proc is not None and proc.stdin is not None:
+                proc.stdin.close()  # EOF: the worker finishes queued updates and exits
+        for i, proc in enumerate(self._procs):
+            if proc is None:
+                continue
+            try:
+                await asyncio.wait_for(proc.wait(), timeout=timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"Worker {i} did not exit in {timeout}s, killing")
+                proc.kill()
+            if self._readers[i] is not None:
+                try:
+                    await asyncio.wait_for(self._readers[i], timeout=1)
+                except (asyncio.TimeoutError, asyncio.CancelledError):
+                    pass
+        left = sum(len(u) for u in self._unacked)
+        if left:
+            logger.warning(f"{left} updates not acked at shutdown; they are replayed on the next start")
+        if self._track_offsets:
+            _update_offsets.flush()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": self.size,
+            "routed": list(self._routed),
+            "acked": list(self._acked),
+            "unacked": [len(u) for u in self._unacked],
+            "resent": self._resent,
+            "restarts": self._restarts,
+        }
+
+
+async def _get_raw_updates(offset: Optional[int], timeout: int, allowed: List[str]) -> List[Dict[str, Any]]:
+    """getUpdates without building aiogram objects: the supervisor only forwards the JSON."""
+    session = await bot.session.create_session()
+    payload: Dict[str, Any] = {"limit": 100, "timeout": timeout, "allowed_updates": allowed}
+    if offset is not None:
+        payload["offset"] = offset
+    async with session.post(
+        bot.session.api.api_url(token=bot.token, method="getUpdates"),
+        json=payload,
+        timeout=aiohttp.ClientTimeout(total=timeout + 30),
+    ) as resp:
+        data = await resp.json(content_type=None)
+    if not data.get("ok"):
+        raise RuntimeError(f"getUpdates failed: {data.get('description')}")
+    return list(data.get("result") or [])
+
+
+async def _supervisor_poll(pool: _WorkerPool) -> None:
+    """
+    The only getUpdates consumer in BOT_WORKERS mode; hands each update to its worker. Like
+    _poll_updates it polls from the newest update fetched, so one wedged worker doesn't stall
+    the others; what the workers haven't acked stays in _update_offsets (and _unacked) instead.
+    """
+    stored = _update_offsets.load()
+    if stored:
+        logger.warning(f"Replaying {len(stored)} updates the previous run did not finish")
+        _update_offsets.begin(stored, stored=True)
+        for update in stored:
+            await pool.route(update)
+    offset = _update_offsets.next_offset()
+    allowed = dp.resolve_used_update_types()
+    while True:
+        try:
+            updates = await _get_raw_updates(offset, timeout=25, allowed=allowed)
+        except Exception as e:
+            logger.error(f"Polling error: {e}")
+            await asyncio.sleep(1)
+            continue
+        fresh = [update for update in updates if _update_offsets.is_new(update["update_id"])]
+        _update_offsets.begin(fresh)
+        for update in fresh:
+            await pool.route(update)
+        if updates:
+            offset = int(updates[-1]["update_id"]) + 1
+
+
+async def _worker_main(index: int) -> None:
+    """Worker process: handles the NDJSON updates the supervisor writes to stdin, acks them on stdout."""
+    global logger
+    logger = logging.getLogger(f"{__name__}.worker{index}")
+    logger.info("Worker starting...")
+    if SEND_GLOBAL_RATE > 0:
+        _send_scheduler.set_global_rate(SEND_GLOBAL_RATE / (max(1, BOT_WORKERS) + 1))
+    outbox_task = asyncio.create_task(outbox_dispatcher())
+    janitor_task = asyncio.create_task(state_janitor())
+
+    reader = asyncio.StreamReader(limit=16 * 1024 * 1024)
+    loop = asyncio.get_running_loop()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), sys.stdin)
+    acks = sys.stdout.buffer
+
+    async def _handle(raw: Dict[str, Any]) -> Any:
+        try:
+            return await dp.feed_raw_update(bot, raw)
+        finally:
+            acks.write(b"%d\n" % int(raw["update_id"]))
+            acks.flush()
+
+    await dp.emit_startup(bot=bot)
+    try:
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            try:
+                raw = _json_loads(line)
+            except Exception as e:
+                logger.error(f"Bad update line: {e}")
+                continue
+            await _schedule_raw_update(raw, partial(_handle, raw))
+        await _update_scheduler.drain(timeout=30)
+    finally:
+        await dp.emit_shutdown(bot=bot)
+        outbox_task.cancel()
+        janitor_task.cancel()
+        await _post_commit.drain(timeout=5)
+        await bot.session.close()
+        logger.info("Worker stopped")
+
+
 # =========================
 # RUN
 # =========================
 async def main():
     logger.info("Bot starting...")
 
-    # Safety: ensure no webhook is set
-    try:
-        await bot.delete_webhook(drop_pending_updates=True)
-    except Exception:
-        pass
+    webhook_mode = BOT_DELIVERY == "webhook"
+    if webhook_mode:
+        # Fail before starting workers or taking traffic
+        _check_webhook_config()
+    pool: Optional[_WorkerPool] = None
+    if BOT_WORKERS > 0:
+        pool = _WorkerPool(BOT_WORKERS, track_offsets=not webhook_mode)
+        await pool.start()
+        _register_metrics("workers", pool.stats)
+    if webhook_mode:
+        await _setup_webhook(route=pool.route if pool else None)
+    else:
+        # Switch back from a webhook if one was set, but keep the updates queued meanwhile
+        try:
+            await bot.delete_webhook(drop_pending_updates=False)
+        except Exception:
+            pass
 
     watcher_task = None
     if CRYPTO_PAY_TOKEN:
         watcher_task = asyncio.create_task(crypto_invoices_watcher())
+    outbox_task = asyncio.create_task(outbox_dispatcher())
+    janitor_task = asyncio.create_task(state_janitor())
 
     # Resolve main bot username for deep-links
     global _MAIN_BOT_USERNAME
@@ -3454,13 +6573,44 @@ async def main():
         api_runner = await start_api_server()
     except Exception as e:
         logger.error(f"API server failed to start: {e}")
+        if webhook_mode:
+            raise
 
     try:
-        tasks = [asyncio.create_task(dp.start_polling(bot))]
-        await asyncio.gather(*tasks)
+        if webhook_mode:
+            await bot.set_webhook(
+                url=f"{WEBHOOK_URL}{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=dp.resolve_used_update_types(),
+            )
+            logger.info(f"Webhook set: {WEBHOOK_URL}{WEBHOOK_PATH} (max_connections={WEBHOOK_MAX_CONNECTIONS})")
+            await dp.emit_startup(bot=bot)
+            try:
+                await asyncio.Event().wait()
+            finally:
+                await dp.emit_shutdown(bot=bot)
+        elif pool is not None:
+            await _supervisor_poll(pool)
+        else:
+            await _drain_update_backlog()
+            await dp.emit_startup(bot=bot)
+            try:
+                await _poll_updates()
+            finally:
+                await dp.emit_shutdown(bot=bot)
     finally:
+        if pool is not None:
+            await pool.stop()
+        elif not webhook_mode:
+            if not await _update_scheduler.drain(timeout=10):
+                logger.warning("Updates still pending at shutdown; they are replayed on the next start")
+            _update_offsets.flush()
         if watcher_task:
             watcher_task.cancel()
+        outbox_task.cancel()
+        janitor_task.cancel()
+        await _post_commit.drain(timeout=5)
         if api_runner:
             try:
                 await api_runner.cleanup()
@@ -3471,4 +6621,7 @@ async def main():
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    if "--worker" in sys.argv:
+        asyncio.run(_worker_main(int(sys.argv[sys.argv.index("--worker") + 1])))
+    else:
+        asyncio.run(main())
@@ -0,0 +1,19 @@
+"""
+main.py reads its configuration from the environment at import time: point it at a throwaway
+SQLite database and a dummy bot token before any test imports it.
+"""
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+REPO = Path(__file__).resolve().parent.parent
+TEST_DIR = Path(tempfile.mkdtemp(prefix="tests-"))
+
+os.environ.update(
+    BOT_TOKEN="123456:ABCdefGhIJKlmnoPQRstuVWXyz",
+    DB_BACKEND="sqlite",
+    MYSQL_HOST="",
+    DB_PATH=str(TEST_DIR / "test.db"),
+)
+sys.path.insert(0, str(REPO))
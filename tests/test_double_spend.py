@@ -0,0 +1,88 @@
+"""
+Several processes, each with several threads, pay and debit against one SQLite file at once.
+Every order id is tried by every thread, and there is more demand than balance: the balance
+may only pay for what processed_orders recorded, each order at most once, and never go negative.
+"""
+import multiprocessing
+import threading
+import uuid
+
+import main
+
+PROCS = 4
+THREADS = 4
+PRICE = 1000  # kopecks
+AFFORDABLE = 30
+ORDERS = 60
+DEBITS_EACH = 20  # bare debits per thread, of PRICE each
+
+
+def _worker(pay_user: int, debit_user: int, order_ids, barrier, results) -> None:
+    """Child process: THREADS threads, each pays every order and tries DEBITS_EACH debits."""
+    paid, debited, errors = [], [], []
+    lock = threading.Lock()
+    start = threading.Barrier(THREADS)
+
+    def run(n: int) -> None:
+        start.wait()
+        try:
+            _run(n)
+        except Exception as e:
+            errors.append(repr(e))
+
+    def _run(n: int) -> None:
+        # Threads walk the orders from different ends, processes race on the same ids
+        ids = order_ids if n % 2 == 0 else list(reversed(order_ids))
+        for i, order_id in enumerate(ids):
+            status, before, after = main._pay_order_from_balance(pay_user, order_id, PRICE, "{}")
+            assert after >= 0 and (status != "paid" or before - after == PRICE), (status, before, after)
+            if status == "paid":
+                with lock:
+                    paid.append(order_id)
+            if i < DEBITS_EACH:
+                ok, before, after = main._try_debit_balance_kopecks(debit_user, PRICE)
+                assert after >= 0 and (not ok or before - after == PRICE), (ok, before, after)
+                if ok:
+                    with lock:
+                        debited.append(1)
+
+    barrier.wait()
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(THREADS)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    results.put((paid, len(debited), errors))
+
+
+def test_concurrent_payments_never_double_spend():
+    pay_user, debit_user = 770001, 770002
+    main._set_balance_kopecks(pay_user, AFFORDABLE * PRICE)
+    main._set_balance_kopecks(debit_user, AFFORDABLE * PRICE)
+    order_ids = [f"test-{n}-{uuid.uuid4().hex[:8]}" for n in range(ORDERS)]
+
+    ctx = multiprocessing.get_context("spawn")
+    barrier = ctx.Barrier(PROCS)
+    results = ctx.Queue()
+    procs = [
+        ctx.Process(target=_worker, args=(pay_user, debit_user, order_ids, barrier, results)) for _ in range(PROCS)
+    ]
+    for p in procs:
+        p.start()
+    outcomes = [results.get(timeout=120) for _ in procs]
+    for p in procs:
+        p.join(timeout=30)
+        assert p.exitcode == 0
+
+    assert [e for _, _, errors in outcomes for e in errors] == []
+    paid = [order_id for order_paid, _, _ in outcomes for order_id in order_paid]
+    debits = sum(n for _, n, _ in outcomes)
+    with main._db_lock:
+        row = main._conn.execute("SELECT COUNT(*) FROM processed_orders WHERE user_id=?", (pay_user,)).fetchone()
+    processed = row[0]
+
+    # Demand exceeds the balance in both cases, so exactly AFFORDABLE go through
+    assert len(paid) == len(set(paid)) == processed == AFFORDABLE
+    assert main._get_balance_kopecks(pay_user) == 0
+    assert debits == AFFORDABLE
+    assert main._get_balance_kopecks(debit_user) == 0
@@ -0,0 +1,135 @@
+"""
+Polling must not stall behind one stuck handler: getUpdates moves on past it (more than a page of
+later updates still gets fetched and handled), and the stuck update is kept for a restart.
+"""
+import asyncio
+
+import pytest
+from aiogram import types
+
+import main
+
+STUCK = 1
+BACKLOG = 250  # more than two getUpdates pages behind the stuck update
+
+
+def _update(update_id: int) -> types.Update:
+    # The stuck update's user has nothing else queued: a user's updates run in order
+    user = {"id": 1 if update_id == STUCK else 1000 + update_id % 7, "is_bot": False, "first_name": "test"}
+    message = {"message_id": update_id, "date": 0, "chat": {"id": user["id"], "type": "private"}, "from": user}
+    return types.Update(update_id=update_id, message={**message, "text": "x"})
+
+
+class FakeTelegram:
+    """getUpdates over a fixed list; feed_update blocks on STUCK until released."""
+
+    def __init__(self, updates):
+        self.updates = updates
+        self.offsets = []
+        self.handled = []
+        self.release = asyncio.Event()
+
+    async def get_updates(self, offset=None, limit=100, timeout=0, allowed_updates=None):
+        self.offsets.append((offset, timeout))
+        page = [u for u in self.updates if offset is None or u.update_id >= offset][:limit]
+        if not page:
+            await asyncio.sleep(min(timeout, 0.05))
+        return page
+
+    async def get_webhook_info(self):
+        raise RuntimeError("not needed")
+
+    async def feed_update(self, bot, update):
+        if update.update_id == STUCK:
+            await self.release.wait()
+        self.handled.append(update.update_id)
+
+
+@pytest.fixture
+def telegram(monkeypatch):
+    fake = FakeTelegram([_update(i) for i in range(1, BACKLOG + 1)])
+    monkeypatch.setattr(main.bot, "get_updates", fake.get_updates)
+    monkeypatch.setattr(main.bot, "get_webhook_info", fake.get_webhook_info)
+    monkeypatch.setattr(main.dp, "feed_update", fake.feed_update)
+    monkeypatch.setattr(main, "_update_scheduler", main._UpdateScheduler(16, 1000))
+    monkeypatch.setattr(main, "_update_offsets", main._UpdateOffsetTracker())
+    with main._db_lock:
+        main._conn.execute("DELETE FROM kv_state")
+        main._conn.execute("DELETE FROM settings WHERE key=?", (main._UPDATE_OFFSET_KEY,))
+        main._db_commit()
+    return fake
+
+
+async def _until(predicate, timeout: float = 5.0) -> None:
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not predicate():
+        assert asyncio.get_running_loop().time() < deadline, "timed out"
+        await asyncio.sleep(0.01)
+
+
+def _stored_ids():
+    return [u["update_id"] for u in main._pending_updates_load()]
+
+
+def test_backlog_drain_is_not_held_back_by_a_stuck_handler(telegram):
+    async def run():
+        await asyncio.wait_for(main._drain_update_backlog(), timeout=5)
+        await _until(lambda: len(telegram.handled) == BACKLOG - 1)
+        assert STUCK not in telegram.handled
+        # Every page was fetched right after the previous one, not after it was handled
+        assert [o for o, _ in telegram.offsets] == [None, 101, 201, BACKLOG + 1]
+        main._update_offsets.flush()
+        assert _stored_ids() == [STUCK]
+        assert main._get_setting(main._UPDATE_OFFSET_KEY) == str(BACKLOG + 1)
+
+        telegram.release.set()
+        await _until(lambda: len(telegram.handled) == BACKLOG)
+        main._update_offsets.flush()
+        assert _stored_ids() == []
+
+    asyncio.run(run())
+
+
+def test_polling_keeps_long_polls_while_a_handler_is_stuck(telegram):
+    async def run():
+        poller = asyncio.create_task(main._poll_updates())
+        try:
+            await _until(lambda: len(telegram.handled) == BACKLOG - 1)
+            await _until(lambda: len(telegram.offsets) >= 6)
+        finally:
+            poller.cancel()
+        assert STUCK not in telegram.handled
+        offsets = [o for o, _ in telegram.offsets]
+        assert offsets[:4] == [None, 101, 201, BACKLOG + 1]
+        assert set(offsets[3:]) == {BACKLOG + 1}
+        assert {t for _, t in telegram.offsets} == {25}
+        telegram.release.set()
+
+    asyncio.run(run())
+
+
+def test_restart_replays_the_unfinished_update(telegram, monkeypatch):
+    async def crash():
+        await main._drain_update_backlog()
+        await _until(lambda: len(telegram.handled) == BACKLOG - 1)
+        main._update_offsets.flush()
+
+    asyncio.run(crash())
+    assert STUCK not in telegram.handled
+
+    # Next start: a fresh tracker, Telegram has nothing new
+    telegram.handled.clear()
+    telegram.release = asyncio.Event()
+    telegram.release.set()
+    telegram.updates = []
+    monkeypatch.setattr(main, "_update_scheduler", main._UpdateScheduler(16, 1000))
+    monkeypatch.setattr(main, "_update_offsets", main._UpdateOffsetTracker())
+
+    async def restart():
+        await main._drain_update_backlog()
+        await _until(lambda: telegram.handled == [STUCK])
+        assert main._update_offsets.next_offset() == BACKLOG + 1
+        main._update_offsets.flush()
+        assert _stored_ids() == []
+
+    asyncio.run(restart())